@@ -0,0 +1,268 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.utils.http import http_date, parse_http_date_safe
+from pycon2013_socketio.chat import metrics
+from StringIO import StringIO
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+
+
+class Asset(object):
+    """A static file, held in memory, ready to be sent: as it is, and
+    gzipped (if that makes it any smaller).
+
+    Each asset also has a hashed name, with a hash of its content worked
+    into it (`chat/js/chat.js` becomes `chat/js/chat.0123456789ab.js`). The
+    content at a hashed name never changes, so browsers may cache it
+    forever; see `asset_url`.
+    """
+
+    # Types worth compressing. Images are compressed already.
+    COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                    'application/x-javascript', 'image/svg+xml')
+
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.mtime = int(os.stat(filename).st_mtime)
+        with open(filename, 'rb') as asset_file:
+            self.content = asset_file.read()
+        self.content_type = (
+            mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        )
+        self.last_modified = http_date(self.mtime)
+
+    def seal(self):
+        """Work out everything that depends on the asset's final content:
+        its hash, its hashed name, and its gzipped content."""
+
+        digest = hashlib.md5(self.content).hexdigest()[0:12]
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gzip"' % digest
+        root, ext = posixpath.splitext(self.name)
+        self.hashed_name = '%s.%s%s' % (root, digest, ext)
+
+        self.gzipped = None
+        if self.content_type.startswith(self.COMPRESSIBLE):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+                gz.write(self.content)
+            if len(buf.getvalue()) < len(self.content):
+                self.gzipped = buf.getvalue()
+
+    def changed(self):
+        """Return whether the file on disk has changed since we read it."""
+
+        try:
+            return int(os.stat(self.filename).st_mtime) != self.mtime
+        except OSError:
+            return True
+
+
+class AssetRegistry(object):
+    """Every static file the staticfiles finders can find, held in memory
+    (see `Asset`), by name and by hashed name.
+
+    Everything is read, hashed and compressed once, up front, so that
+    serving an asset costs a dictionary lookup, and never touches the disk.
+    If `reload` is set (it is, by default, when `DEBUG` is), each request
+    does check whether its file has changed, and if it has, everything is
+    read again; so editing a stylesheet doesn't mean restarting the server.
+
+    Stylesheets are rewritten to refer to the hashed names of the images
+    (and anything else) they use, the way Django's `CachedStaticFilesStorage`
+    does it, so that those can be cached forever, too.
+    """
+
+    # The same files `collectstatic` ignores.
+    IGNORE_PATTERNS = ['CVS', '.*', '*~']
+
+    CSS_URL = re.compile(r'''url\((['"]?)([^'"()]+)\1\)''')
+
+    def __init__(self, reload=False):
+        self.reload = reload
+        self.load()
+
+    def load(self):
+        """(Re-)read every static file."""
+
+        assets = {}
+        for finder in finders.get_finders():
+            for path, storage in finder.list(self.IGNORE_PATTERNS):
+                name = path.replace(os.sep, '/')
+
+                # As with `collectstatic`, the first finder to find a name
+                #   wins.
+                if name not in assets:
+                    assets[name] = Asset(name, storage.path(path))
+
+        # Images first, then stylesheets (which need the images' hashed
+        #   names).
+        for asset in assets.values():
+            if asset.content_type != 'text/css':
+                asset.seal()
+        for asset in assets.values():
+            if asset.content_type == 'text/css':
+                self._rewrite_css(asset, assets)
+                asset.seal()
+
+        self.assets = assets
+        self.hashed = dict([
+            (asset.hashed_name, asset) for asset in assets.values()
+        ])
+
+    def find(self, name):
+        """Return the asset at `name` (either its own name or its hashed
+        name), and whether that was its hashed name; or `(None, False)`."""
+
+        asset = self.hashed.get(name)
+        hashed = asset is not None
+        if not hashed:
+            asset = self.assets.get(name)
+        if asset is not None and self.reload and asset.changed():
+            self.load()
+            return self.find(name)
+        return asset, hashed
+
+    def url(self, name):
+        """Return the URL of the asset at `name`, by its hashed name if
+        there is such an asset."""
+
+        asset = self.assets.get(name)
+        if asset is not None and self.reload and asset.changed():
+            self.load()
+            asset = self.assets.get(name)
+        return settings.STATIC_URL + (asset.hashed_name if asset else name)
+
+    def _rewrite_css(self, asset, assets):
+        directory = posixpath.dirname(asset.name)
+
+        def replace(match):
+            quote, url = match.groups()
+            name = posixpath.normpath(posixpath.join(directory, url))
+            if url.startswith(('/', '#')) or ':' in url or name not in assets:
+                return match.group(0)
+            return 'url(%s%s%s)' % (
+                quote,
+                posixpath.relpath(assets[name].hashed_name, directory),
+                quote,
+            )
+
+        asset.content = self.CSS_URL.sub(
+            replace, asset.content.decode('utf-8'),
+        ).encode('utf-8')
+
+
+class StaticAssetsMiddleware(object):
+    """WSGI middleware that serves static files (anything under
+    `STATIC_URL`) from memory (see `AssetRegistry`), and passes everything
+    else on to the application it wraps.
+
+    Browsers that accept gzip get the gzipped copy. Every response carries
+    an `ETag` and a `Last-Modified` header, and a browser that already has
+    the right version gets a bodiless 304. Anything asked for by its hashed
+    name is cached for a year; anything else has to be revalidated each
+    time (cheaply, thanks to the 304s).
+
+    Anything we don't know about (including requests for hashed names of
+    versions we no longer have) goes on to the application.
+    """
+
+    FOREVER = 'public, max-age=31536000'
+    REVALIDATE = 'public, max-age=0, must-revalidate'
+
+    def __init__(self, application):
+        self.application = application
+
+        # Read everything now, rather than on the first request.
+        get_assets()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD') or \
+                not path.startswith(settings.STATIC_URL):
+            return self.application(environ, start_response)
+
+        asset, hashed = get_assets().find(path[len(settings.STATIC_URL):])
+        if asset is None:
+            return self.application(environ, start_response)
+
+        use_gzip = asset.gzipped is not None and \
+            'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+        etag = asset.gzip_etag if use_gzip else asset.etag
+        headers = [
+            ('Content-Type', asset.content_type),
+            ('Cache-Control', self.FOREVER if hashed else self.REVALIDATE),
+            ('ETag', etag),
+            ('Last-Modified', asset.last_modified),
+        ]
+        if asset.gzipped is not None:
+            headers.append(('Vary', 'Accept-Encoding'))
+
+        # Does the browser have this version already? An ETag, if it sent
+        #   one, is the better test.
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            not_modified = etag in if_none_match or if_none_match == '*'
+        else:
+            since = parse_http_date_safe(
+                environ.get('HTTP_IF_MODIFIED_SINCE', ''),
+            )
+            not_modified = since is not None and since >= asset.mtime
+        if not_modified:
+            _responses['304'].inc()
+            start_response(str('304 Not Modified'), _str_headers(headers))
+            return []
+
+        body = asset.gzipped if use_gzip else asset.content
+        if use_gzip:
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        _responses['200'].inc()
+        start_response(str('200 OK'), _str_headers(headers))
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
+
+
+def _str_headers(headers):
+    # WSGI wants native strings.
+    return [(str(key), str(value)) for key, value in headers]
+
+
+# How many static files have been served in full, and how many browsers
+#   were told they already had them.
+_responses = dict([
+    (status, metrics.counter('chat_static_responses_total', status=status))
+    for status in ('200', '304')
+])
+
+# The registry is created on first use, from the `CHAT_STATIC_RELOAD`
+#   setting (under a lock, like the broker).
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_assets():
+    """Return the process-wide asset registry."""
+
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = AssetRegistry(reload=settings.CHAT_STATIC_RELOAD)
+    return _registry
+
+
+def asset_url(name):
+    """Return the URL of the static file at `name`, by its hashed name
+    (so that it can be cached forever) if it's one we serve."""
+
+    if not settings.CHAT_STATIC_ASSETS:
+        return settings.STATIC_URL + name
+    return get_assets().url(name)
@@ -0,0 +1,424 @@
+from __future__ import unicode_literals
+from collections import deque
+from django.conf import settings
+from django.utils.importlib import import_module
+from gevent.event import Event
+from gevent.queue import Queue
+from pycon2013_socketio.chat import metrics, wire
+from pycon2013_socketio.chat.connections import get_redis, get_ring
+from redis.exceptions import ConnectionError
+import gevent
+import logging
+import math
+import os
+import threading
+import time
+
+
+# How long after an event was created it reaches `dispatch`, and how long
+#   handing it to every local socket in the room takes.
+_delivery_lag = metrics.histogram('chat_delivery_lag_seconds')
+_dispatch_time = metrics.histogram('chat_dispatch_seconds')
+
+
+class BaseBroker(object):
+    """The thing that carries room events from whoever publishes them to
+    every socket that is in the room.
+
+    There is one broker per process. It keeps a routing table mapping each
+    channel to the set of local namespaces that are interested in it, and
+    hands each published event (decoded from JSON exactly once, as a
+    `WireEvent`) to every one of them, by calling their `deliver` method.
+
+    It also holds each room's backlog: a capped list of recent events,
+    newest first, that `Room.get_backlog` serves joins from; each room's
+    event sequence counter; and short-lived markers (see `set_marker`).
+
+    Subclasses decide how events actually travel, by implementing
+    `publish`, `_channel_added` and `_channel_removed`, and the backlog,
+    sequence and marker methods.
+    """
+
+    def __init__(self):
+        self.routes = {}
+
+    def publish(self, channel, payload, backlog_key=None, backlog_size=None):
+        """Publish a JSON `payload` to `channel`.
+
+        If `backlog_key` is given, also push the payload onto that backlog
+        (trimming it to `backlog_size`), but only if the backlog is already
+        there; a missing backlog means "not cached".
+        """
+
+        raise NotImplementedError
+
+    def get_backlog(self, key, size):
+        """Return up to `size` payloads from the backlog, newest first, or
+        `None` if the backlog is not cached."""
+
+        raise NotImplementedError
+
+    def fill_backlog(self, key, payloads, size):
+        """Replace the backlog with the given payloads (newest first)."""
+
+        raise NotImplementedError
+
+    def next_sequence(self, key, seed):
+        """Increment the counter at `key`, and return its new value.
+
+        If the counter doesn't exist yet (it has never been used, or the
+        broker has been restarted since), it is first set to `seed()`, so
+        that it carries on from wherever the database left off.
+        """
+
+        raise NotImplementedError
+
+    def set_marker(self, key, timeout):
+        """Set a marker at `key`, which disappears after `timeout`
+        seconds."""
+
+        raise NotImplementedError
+
+    def pop_marker(self, key):
+        """Remove the marker at `key`, and return whether it was there.
+
+        Only one caller can ever get `True` back for the same marker, even
+        if several (in several processes) try at the same moment.
+        """
+
+        raise NotImplementedError
+
+    def subscribe(self, channel, namespace):
+        """Route events published to `channel` to `namespace`."""
+
+        if channel in self.routes:
+            self.routes[channel].add(namespace)
+            return
+        self.routes[channel] = set([namespace])
+        self._channel_added(channel)
+
+    def unsubscribe(self, channel, namespace):
+        """Stop routing events published to `channel` to `namespace`."""
+
+        namespaces = self.routes.get(channel)
+        if namespaces is None:
+            return
+        namespaces.discard(namespace)
+        if not namespaces:
+            del self.routes[channel]
+            self._channel_removed(channel)
+
+    def unsubscribe_all(self, namespace):
+        """Remove `namespace` from every channel it is routed from."""
+
+        for channel in [k for k, v in self.routes.items() if namespace in v]:
+            self.unsubscribe(channel, namespace)
+
+    def _channel_added(self, channel):
+        """Called when the first local namespace subscribes to `channel`."""
+
+    def _channel_removed(self, channel):
+        """Called when the last local namespace unsubscribes from `channel`."""
+
+    def dispatch(self, channel, payload):
+        """Decode a payload published to `channel`, and hand it to every
+        namespace subscribed to it."""
+
+        # Payloads may be in either wire encoding; see `chat/wire.py`.
+        try:
+            data = wire.loads(payload)
+        except ValueError:
+            logging.getLogger('socketio').warning(
+                'Discarding malformed message on %s.', channel,
+            )
+            return
+
+        # If the topic changed (in this process or any other), our cached
+        #   copy of the room is out of date.
+        # (This is imported here because the models need the broker.)
+        if data.type == 'topic_set':
+            from pycon2013_socketio.chat.models import Room
+            Room.objects.invalidate(data.room)
+
+        # How long did it take the event to get here?
+        _delivery_lag.observe(max(time.time() - data.created_at, 0))
+
+        # Hand the event off to every namespace in the room.
+        # Copy the set first; a namespace may leave while we iterate.
+        # One namespace failing doesn't stop the rest getting the event.
+        with _dispatch_time.time():
+            for namespace in list(self.routes.get(channel, ())):
+                try:
+                    namespace.deliver(data)
+                except Exception:
+                    logging.getLogger('socketio').error(
+                        'Exception while delivering to %r.', namespace,
+                        exc_info=True,
+                    )
+
+
+class RedisBroker(BaseBroker):
+    """A broker that sends events through Redis pub/sub, so that they reach
+    sockets in every process (and on every machine).
+
+    Each process holds exactly one subscription connection to each Redis
+    node, no matter how many sockets it has. Subscriptions are incremental:
+    the first local socket to join a room costs one SUBSCRIBE, and the last
+    one to leave costs one UNSUBSCRIBE. Redis only sends each message to us
+    once, no matter how many of our sockets are in the room.
+
+    If there are several Redis nodes (`REDIS_NODES`), each channel -- and
+    every other key -- goes to the node it hashes to, both for publishing
+    and for subscribing; see `HashRing` in `chat/connections.py`.
+
+    Backlogs are Redis lists.
+    """
+
+    def __init__(self):
+        super(RedisBroker, self).__init__()
+        self._confirmations = {}
+
+        # One subscriber per node, created when we first need it.
+        self.subscribers = {}
+
+        # The sequence counters this process has made sure are seeded.
+        self._seeded = set()
+
+    def publish(self, channel, payload, backlog_key=None, backlog_size=None):
+        # The publish and the backlog push go in the same round trip.
+        # We use LPUSHX, which only pushes if the list already exists.
+        # (The backlog key has the same hash tag as the channel, so it's
+        #   on the same node.)
+        pipe = get_redis(channel).pipeline(transaction=False)
+        pipe.publish(channel, payload)
+        if backlog_key:
+            pipe.lpushx(backlog_key, payload)
+            pipe.ltrim(backlog_key, 0, backlog_size - 1)
+        pipe.execute()
+
+    def get_backlog(self, key, size):
+        return get_redis(key).lrange(key, 0, size - 1) or None
+
+    def fill_backlog(self, key, payloads, size):
+        if not payloads:
+            return
+        pipe = get_redis(key).pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.rpush(key, *payloads)
+        pipe.ltrim(key, 0, size - 1)
+        pipe.execute()
+
+    def next_sequence(self, key, seed):
+        # Seeding costs a database query, so only check that the counter
+        #   exists the first time this process uses it. SETNX never
+        #   overwrites a counter that another process has already moved on.
+        if key in self._seeded:
+            return get_redis(key).incr(key)
+        pipe = get_redis(key).pipeline(transaction=True)
+        pipe.setnx(key, seed())
+        pipe.incr(key)
+        self._seeded.add(key)
+        return pipe.execute()[-1]
+
+    def set_marker(self, key, timeout):
+        get_redis(key).setex(key, value=1, time=int(math.ceil(timeout)))
+
+    def pop_marker(self, key):
+        return bool(get_redis(key).delete(key))
+
+    def subscribe(self, channel, namespace, timeout=1.0):
+        """Route messages published to `channel` to `namespace`.
+
+        If this is a new channel for this process, we also wait (up to
+        `timeout` seconds) for Redis to confirm the subscription, so that
+        anything published after this method returns is guaranteed to
+        reach us.
+        """
+
+        if channel in self.routes:
+            self.routes[channel].add(namespace)
+            return
+
+        confirmed = self._confirmations.setdefault(channel, Event())
+        super(RedisBroker, self).subscribe(channel, namespace)
+        confirmed.wait(timeout)
+
+    def _channel_added(self, channel):
+        self._subscriber(channel).subscribe(channel)
+
+    def _channel_removed(self, channel):
+        self._subscriber(channel).unsubscribe(channel)
+
+    def _subscriber(self, channel):
+        """Return the subscriber for the node that `channel` is on."""
+
+        node = get_ring().get_node(channel)
+        if node not in self.subscribers:
+            self.subscribers[node] = Subscriber(self, node)
+        return self.subscribers[node]
+
+
+class Subscriber(object):
+    """A `RedisBroker`'s subscription connection to one Redis node, and
+    the greenlet that listens on it, handing whatever arrives to the
+    broker's `dispatch`."""
+
+    def __init__(self, broker, node):
+        self.broker = broker
+        self.node = node
+        self.channels = set()
+        self.pubsub = get_redis(node=node).pubsub()
+
+        # `pubsub.listen` returns as soon as the subscription count drops
+        #   to zero, and redis-py hands the connection back to the pool when
+        #   that happens -- which would mean tearing down and restarting the
+        #   listener every time the last room in the process empties out.
+        # Instead, we stay subscribed to a private control channel for the
+        #   life of the process, so the count never reaches zero.
+        self.control_channel = 'subscriber_%d' % os.getpid()
+        self.pubsub.subscribe(self.control_channel)
+        self._greenlet = gevent.spawn(self._run)
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        self.pubsub.subscribe(channel)
+
+    def unsubscribe(self, channel):
+        self.channels.discard(channel)
+        self.pubsub.unsubscribe(channel)
+
+    def _run(self):
+        """Listen forever, reconnecting to Redis if the connection drops."""
+
+        while True:
+            try:
+                self._listen()
+            except ConnectionError:
+                logging.getLogger('socketio').warning(
+                    'Lost the Redis subscription to %s; reconnecting.',
+                    self.node, exc_info=True,
+                )
+
+            # Throw away the dead connection and subscribe again to
+            #   everything we were subscribed to before.
+            gevent.sleep(1)
+            self.pubsub.reset()
+            try:
+                self.pubsub.subscribe(
+                    [self.control_channel] + list(self.channels),
+                )
+            except ConnectionError:
+                pass
+
+    def _listen(self):
+        for block in self.pubsub.listen():
+            # Sanity Check: Is this a real block?
+            if not block or 'type' not in block:
+                continue
+
+            # Subscription confirmations wake up anyone waiting in
+            #   `subscribe`; that's all we need them for.
+            if block['type'] == 'subscribe':
+                confirmed = self.broker._confirmations.pop(
+                    block['channel'], None,
+                )
+                if confirmed is not None:
+                    confirmed.set()
+                continue
+
+            if block['type'] != 'message' or not isinstance(
+              block['data'], (str, unicode),
+            ):
+                continue
+
+            # Whatever goes wrong with one message (a malformed payload, a
+            #   namespace that blows up) must not take the listener down
+            #   with it; it's the only one the process has.
+            try:
+                self.broker.dispatch(block['channel'], block['data'])
+            except Exception:
+                logging.getLogger('socketio').error(
+                    'Exception while dispatching to %s.', block['channel'],
+                    exc_info=True,
+                )
+
+
+class MemoryBroker(BaseBroker):
+    """A broker that never leaves the process.
+
+    Published events go onto a gevent queue, and a single greenlet takes
+    them off and fans them out directly to the subscribed namespaces. There
+    is no network round trip at all, which makes this the fastest option,
+    but it only works if the whole site is a single process.
+
+    Backlogs are kept in memory, too.
+    """
+
+    def __init__(self):
+        super(MemoryBroker, self).__init__()
+        self.queue = Queue()
+        self.backlogs = {}
+        self.sequences = {}
+        self.markers = {}
+        self._greenlet = gevent.spawn(self._run)
+
+    def publish(self, channel, payload, backlog_key=None, backlog_size=None):
+        self.queue.put((channel, payload))
+        if backlog_key in self.backlogs:
+            self.backlogs[backlog_key].appendleft(payload)
+
+    def get_backlog(self, key, size):
+        backlog = self.backlogs.get(key)
+        if not backlog:
+            return None
+        return list(backlog)[0:size]
+
+    def fill_backlog(self, key, payloads, size):
+        if payloads:
+            self.backlogs[key] = deque(payloads, size)
+
+    def next_sequence(self, key, seed):
+        if key not in self.sequences:
+            self.sequences[key] = seed()
+        self.sequences[key] += 1
+        return self.sequences[key]
+
+    def set_marker(self, key, timeout):
+        self.markers[key] = time.time() + timeout
+
+    def pop_marker(self, key):
+        return self.markers.pop(key, 0) > time.time()
+
+    def _run(self):
+        while True:
+            channel, payload = self.queue.get()
+            try:
+                self.dispatch(channel, payload)
+            except Exception:
+                logging.getLogger('socketio').error(
+                    'Exception while dispatching to %s.', channel,
+                    exc_info=True,
+                )
+
+
+# The broker is created on first use, from the `CHAT_BROKER` setting.
+# Creating it may talk to Redis (and therefore yield to other greenlets), so
+#   it's done under a lock; otherwise a crowd of sockets joining rooms at
+#   once would each create their own.
+_broker = None
+_broker_lock = threading.Lock()
+
+
+metrics.gauge('chat_broker_channels',
+              lambda: len(_broker.routes) if _broker else 0)
+
+
+def get_broker():
+    """Return the process-wide broker."""
+
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            module_name, class_name = settings.CHAT_BROKER.rsplit('.', 1)
+            _broker = getattr(import_module(module_name), class_name)()
+    return _broker
@@ -0,0 +1,218 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from gevent.queue import Empty, LifoQueue
+from pycon2013_socketio.chat import metrics
+from redis import ConnectionPool, Redis
+from redis.exceptions import ConnectionError
+import bisect
+import hashlib
+import os
+import re
+
+
+class PooledConnectionPool(ConnectionPool):
+    """A Redis connection pool that is shared by the entire process.
+
+    The stock redis-py pool simply raises an error once `max_connections`
+    is exceeded. This one instead blocks (cooperatively; it is a gevent
+    queue underneath) until a connection is returned to the pool, or until
+    `timeout` seconds have elapsed.
+
+    It also keeps a few counters around, so we can see how hard the pool
+    is being worked: `checkouts` is the number of times a connection was
+    handed out, `waits` is the number of times a caller had to wait for
+    one, and `timeouts` is the number of times that wait gave up.
+    """
+
+    def __init__(self, max_connections=20, timeout=5, **connection_kwargs):
+        self.timeout = timeout
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        super(PooledConnectionPool, self).__init__(
+            max_connections=max_connections,
+            **connection_kwargs
+        )
+
+        # Fill the queue with placeholders; a `None` in the queue means
+        #   "you may create a new connection". This way we only open as
+        #   many sockets as we actually need, up to `max_connections`.
+        self._pool = LifoQueue(self.max_connections)
+        for i in range(0, self.max_connections):
+            self._pool.put_nowait(None)
+
+    def _checkpid(self):
+        # If we have been forked, none of our parent's sockets are ours
+        #   to use; start over with a fresh pool.
+        if self.pid != os.getpid():
+            self.disconnect()
+            self.__init__(self.max_connections, self.timeout,
+                          connection_class=self.connection_class,
+                          **self.connection_kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        """Check a connection out of the pool, waiting for one to be
+        released if all of them are busy."""
+
+        self._checkpid()
+        try:
+            connection = self._pool.get_nowait()
+        except Empty:
+            self.waits += 1
+            try:
+                connection = self._pool.get(timeout=self.timeout)
+            except Empty:
+                self.timeouts += 1
+                raise ConnectionError('No Redis connection available.')
+
+        if connection is None:
+            connection = self.make_connection()
+        self._in_use_connections.add(connection)
+        self.checkouts += 1
+        return connection
+
+    def release(self, connection):
+        """Return a connection to the pool."""
+
+        self._checkpid()
+        if connection.pid == self.pid:
+            self._in_use_connections.discard(connection)
+            self._pool.put_nowait(connection)
+
+    def disconnect(self):
+        """Disconnect every connection the pool has created."""
+
+        for connection in self._in_use_connections:
+            connection.disconnect()
+        while not self._pool.empty():
+            connection = self._pool.get_nowait()
+            if connection is not None:
+                connection.disconnect()
+
+    def stats(self):
+        """Return a dictionary describing the current state of the pool."""
+
+        return {
+            'size': self.max_connections,
+            'in_use': len(self._in_use_connections),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+        }
+
+
+class HashRing(object):
+    """A consistent hash ring, which decides which Redis node each key
+    lives on.
+
+    Each node is hashed onto the ring at `replicas` points, and a key
+    belongs to the first node point at or after the key's own hash. Adding
+    or removing a node only moves the keys between it and its neighbours
+    (about 1/N of them), rather than reshuffling everything.
+
+    If a key contains a "hash tag" -- a part in curly braces, as in
+    `room_{lobby}` -- only that part is hashed, so that every key with
+    the same tag lands on the same node. (Redis Cluster does the same.)
+    That's how a room's channel, backlog and sequence counter stay
+    together, and can share a pipeline.
+    """
+
+    TAG = re.compile(r'\{([^{}]+)\}')
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        ring = []
+        for node in self.nodes:
+            for i in range(0, replicas):
+                ring.append((self._hash('%s-%d' % (node, i)), node))
+        ring.sort()
+        self.points = [point for point, node in ring]
+        self.owners = [node for point, node in ring]
+
+    def get_node(self, key):
+        """Return the node that `key` lives on."""
+
+        # With only one node, there's nothing to decide.
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+
+        match = self.TAG.search(key)
+        if match:
+            key = match.group(1)
+        index = bisect.bisect(self.points, self._hash(key))
+        return self.owners[index % len(self.owners)]
+
+    def _hash(self, value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[0:8], 16)
+
+
+def parse_node(node):
+    """Parse a node, as given in `REDIS_NODES` ("host:port/db", where the
+    port and database are optional), into a dictionary of connection
+    arguments."""
+
+    host, _, db = node.partition('/')
+    host, _, port = host.partition(':')
+    return {
+        'host': host,
+        'port': int(port or 6379),
+        'db': int(db or 0),
+    }
+
+
+# The ring and the pools are created lazily, the first time anyone asks for
+#   them, so that merely importing this module doesn't require Redis
+#   settings. There is one pool per node.
+_ring = None
+_pools = {}
+
+
+def get_ring():
+    """Return the hash ring over the Redis nodes in `REDIS_NODES`."""
+
+    global _ring
+    if _ring is None:
+        _ring = HashRing(settings.REDIS_NODES)
+    return _ring
+
+
+def get_pool(node=None):
+    """Return the process-wide connection pool for a Redis node (by
+    default, the first one)."""
+
+    if node is None:
+        node = get_ring().nodes[0]
+    if node not in _pools:
+        _pools[node] = PooledConnectionPool(
+            password=settings.REDIS_PASSWORD,
+            max_connections=int(settings.REDIS_POOL_SIZE),
+            timeout=float(settings.REDIS_POOL_TIMEOUT),
+            **parse_node(node)
+        )
+    return _pools[node]
+
+
+def get_pools():
+    """Return the connection pools for every Redis node."""
+
+    return [get_pool(node) for node in get_ring().nodes]
+
+
+metrics.gauge('chat_redis_connections_in_use',
+              lambda: sum([p.stats()['in_use'] for p in _pools.values()]))
+
+
+def get_redis(key=None, node=None):
+    """Return a Redis client backed by a process-wide connection pool.
+
+    If `key` is given, the client talks to the node that key lives on (see
+    `HashRing`); if `node` is given, to that node; otherwise, to the first
+    node. Everything that isn't sharded lives on the first node.
+
+    Redis client objects are cheap; the connections are what is expensive,
+    and those are all shared through the pools.
+    """
+
+    if key is not None:
+        node = get_ring().get_node(key)
+    return Redis(connection_pool=get_pool(node))
@@ -0,0 +1,392 @@
+from __future__ import unicode_literals
+from gevent import monkey; monkey.patch_all()  # this *must* run first
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from gevent.event import Event as Flag
+from gevent.pool import Pool
+from optparse import make_option
+from pycon2013_socketio.chat import wire
+from pycon2013_socketio.chat.connections import get_pools
+from pycon2013_socketio.chat.server import ChatServer
+from pycon2013_socketio.chat.writer import stop_writer
+from socketio import packet
+import gevent
+import httplib
+import json
+import logging
+import resource
+import time
+
+
+class QueryCounter(logging.Handler):
+    """Count the queries Django logs (which it does whenever DEBUG is on)."""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.count = 0
+
+    def createLock(self):
+        # Queries may run on the database threads (see `chat/offload.py`),
+        #   where gevent's patched locks don't work; use a real one.
+        self.lock = monkey.get_original('thread', 'allocate_lock')()
+
+    def emit(self, record):
+        self.count += 1
+
+
+class BenchClient(object):
+    """A minimal socket.io 0.9 client, speaking the xhr-polling transport.
+
+    It's just enough of the protocol to connect to the `/chat` namespace,
+    emit events, and receive them; everything it receives is handed to
+    the `on_event` callback as `(client, name, args)`. Room events in the
+    compact encoding are unpacked into dictionaries first.
+
+    If a `transport_port` is given, the handshake goes to `port`, and every
+    poll and post after it goes to `transport_port` -- as if a load balancer
+    had sent them to a different process.
+    """
+
+    def __init__(self, host, port, on_event, transport_port=None):
+        self.host = host
+        self.port = port
+        self.transport_port = transport_port or port
+        self.on_event = on_event
+        self.sessid = None
+        self.room = None
+        self.waiting = {}
+        self._poller = None
+
+    def connect(self):
+        """Do the socket.io handshake, and connect to the chat namespace."""
+
+        # The handshake gives us our session ID.
+        response = self._request('GET', '/socket.io/1/')
+        self.sessid = response.split(':')[0]
+
+        # Long-poll for messages for as long as we're connected.
+        # We keep a dedicated HTTP connection around for polling, since
+        #   we're going to be doing it constantly.
+        self._poll_connection = httplib.HTTPConnection(self.host,
+                                                       self.transport_port)
+        self._poller = gevent.spawn(self._poll)
+
+        # Connect to the `/chat` namespace.
+        self._send(packet.encode({'type': 'connect', 'endpoint': '/chat'}))
+
+    def disconnect(self):
+        """Disconnect the whole socket, and stop polling."""
+
+        self._send(packet.encode({'type': 'disconnect', 'endpoint': ''}))
+        if self._poller is not None:
+            self._poller.kill()
+
+    def emit(self, name, *args):
+        """Send an event to the chat namespace."""
+
+        self._send(packet.encode({
+            'type': 'event',
+            'name': name,
+            'args': list(args),
+            'endpoint': '/chat',
+        }))
+
+    def call(self, reply, name, *args, **kwargs):
+        """Send an event to the chat namespace, and wait (up to `timeout`
+        seconds) for the server to send back the `reply` event."""
+
+        # Start waiting before we send, or the reply could beat us here.
+        flag = self.waiting.setdefault(reply, Flag())
+        self.emit(name, *args)
+        received = flag.wait(kwargs.get('timeout', 10))
+        del self.waiting[reply]
+        return received
+
+    @property
+    def _url(self):
+        return '/socket.io/1/xhr-polling/%s' % self.sessid
+
+    def _request(self, method, path, body=None, port=None):
+        connection = httplib.HTTPConnection(self.host, port or self.port)
+        try:
+            connection.request(method, path, body)
+            return connection.getresponse().read()
+        finally:
+            connection.close()
+
+    def _send(self, message):
+        self._request('POST', self._url, message.encode('utf-8'),
+                      port=self.transport_port)
+
+    def _poll(self):
+        while True:
+            try:
+                self._poll_connection.request('GET', self._url)
+                response = self._poll_connection.getresponse()
+                payload = response.read().decode('utf-8')
+                if response.getheader('connection') == 'close':
+                    self._poll_connection.close()
+            except (httplib.HTTPException, IOError):
+                self._poll_connection.close()
+                gevent.sleep(0.1)
+                continue
+
+            for message in self._decode_payload(payload):
+                pkt = packet.decode(message)
+                if pkt['type'] != 'event':
+                    continue
+
+                # Batched room events are unpacked, just as the browser
+                #   does it.
+                if pkt['name'] == 'room_events':
+                    for event in pkt['args'][0]:
+                        event = self._unpack(event)
+                        self.on_event(self, '%s_event' % event['room'],
+                                      [event])
+                elif pkt['name'].endswith('_event') and pkt['args']:
+                    self.on_event(self, pkt['name'],
+                                  [self._unpack(pkt['args'][0])])
+                else:
+                    self.on_event(self, pkt['name'], pkt['args'])
+                if pkt['name'] in self.waiting:
+                    self.waiting[pkt['name']].set()
+
+    def _unpack(self, event):
+        if isinstance(event, list):
+            return wire.unpack(event)
+        return event
+
+    def _decode_payload(self, payload):
+        # Multiple messages in one response are framed as
+        #   \ufffd[length]\ufffd[message]
+        if not payload.startswith('\ufffd'):
+            return [payload]
+        messages = []
+        while payload:
+            length_end = payload.find('\ufffd', 1)
+            length = int(payload[1:length_end])
+            messages.append(payload[length_end + 1:length_end + 1 + length])
+            payload = payload[length_end + 1 + length:]
+        return messages
+
+
+class Command(BaseCommand):
+    help = ' '.join((
+        'Benchmarks the chat server: starts a socket.io server in this',
+        'process, connects a crowd of simulated clients to it, has them',
+        'chat, and reports throughput, latency and resource usage as JSON.',
+    ))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host',
+            default='127.0.0.1',
+            dest='host',
+            help='Interface for the benchmark server (default: 127.0.0.1).',
+        ),
+        make_option('--port',
+            default=8765,
+            dest='port',
+            help='Port for the benchmark server (default: 8765).',
+            type='int',
+        ),
+        make_option('--clients',
+            default=100,
+            dest='clients',
+            help='Number of simulated clients (default: 100).',
+            type='int',
+        ),
+        make_option('--rooms',
+            default=5,
+            dest='rooms',
+            help='Number of rooms to spread clients across (default: 5).',
+            type='int',
+        ),
+        make_option('--messages',
+            default=10,
+            dest='messages',
+            help='Statements sent by each client (default: 10).',
+            type='int',
+        ),
+        make_option('--concurrency',
+            default=100,
+            dest='concurrency',
+            help='Clients connecting at the same time (default: 100).',
+            type='int',
+        ),
+        make_option('--encoding',
+            choices=wire.FORMATS,
+            default='json',
+            dest='encoding',
+            help='Encoding for room events, json or compact (default: json).',
+        ),
+        make_option('--output',
+            default=None,
+            dest='output',
+            help=' '.join((
+                'Append the results, as one line of JSON, to this file',
+                '(as well as printing them).',
+            )),
+        ),
+    )
+
+    def handle(self, *args, **options):
+        """Run the benchmark."""
+
+        # The benchmark is meant to be run against a throwaway database
+        #   (SQLite is the obvious choice); make sure the tables are there.
+        call_command('syncdb', interactive=False, verbosity=0)
+
+        # The simulated clients chat as fast as they can, which is exactly
+        #   what flood protection is there to stop; it's the server we want
+        #   to measure, so turn it off.
+        settings.CHAT_RATE_LIMITS = {}
+
+        # Count every query Django runs.
+        queries = QueryCounter()
+        db_logger = logging.getLogger('django.db.backends')
+        db_logger.addHandler(queries)
+        db_logger.setLevel(logging.DEBUG)
+
+        # Start the server, in this process.
+        server = ChatServer(
+            (options['host'], options['port']),
+            get_wsgi_application(),
+            resource='socket.io',
+            policy_server=False,
+            log=None,
+        )
+        server.start()
+
+        # Connect all of the clients, and have each of them join a room.
+        latencies = []
+        received = [0]
+
+        def on_event(client, name, args):
+            # We only care about the statements sent during the benchmark.
+            if not name.endswith('_event') or not args:
+                return
+            message = args[0].get('message', '')
+            if args[0].get('type') == 'statement' and \
+                    message.startswith('bench '):
+                received[0] += 1
+                latencies.append(time.time() - float(message.split()[1]))
+
+        memory_before = self._rss()
+        clients = []
+        pool = Pool(options['concurrency'])
+        for i in range(0, options['clients']):
+            client = BenchClient(options['host'], options['port'], on_event)
+            clients.append(client)
+            pool.spawn(self._join, client, i, options['rooms'],
+                       options['encoding'])
+        pool.join()
+        memory_per_connection = (self._rss() - memory_before) / len(clients)
+
+        # Now everyone chats.
+        # Each statement should be delivered to every client in the room it
+        #   was said in; count how many deliveries that ought to be.
+        room_sizes = {}
+        for i in range(0, len(clients)):
+            room_sizes[i % options['rooms']] = room_sizes.get(
+                i % options['rooms'], 0,
+            ) + 1
+        statements = len(clients) * options['messages']
+        expected = sum([
+            size * size * options['messages'] for size in room_sizes.values()
+        ])
+
+        received[0] = 0
+        queries.count = 0
+        redis_checkouts = self._redis_checkouts()
+        start = time.time()
+        for client in clients:
+            pool.spawn(self._chat, client, options['messages'])
+        pool.join()
+
+        # Wait for the deliveries to trickle in; give up once nothing has
+        #   arrived for a few seconds.
+        last_received, last_change = received[0], time.time()
+        while received[0] < expected and time.time() - last_change < 5:
+            gevent.sleep(0.05)
+            if received[0] != last_received:
+                last_received, last_change = received[0], time.time()
+        duration = time.time() - start
+
+        # Make sure anything written behind has actually been written, so
+        #   that it's counted.
+        stop_writer()
+        db_queries = queries.count
+        redis_round_trips = self._redis_checkouts() - redis_checkouts
+
+        # Say goodbye.
+        for client in clients:
+            pool.spawn(self._leave, client)
+        pool.join()
+        server.stop()
+
+        # Report.
+        latencies.sort()
+        results = {
+            'timestamp': time.time(),
+            'clients': len(clients),
+            'encoding': options['encoding'],
+            'rooms': options['rooms'],
+            'statements': statements,
+            'deliveries': received[0],
+            'deliveries_expected': expected,
+            'duration': duration,
+            'messages_per_second': received[0] / duration,
+            'latency_ms': {
+                'p50': self._percentile(latencies, 50) * 1000,
+                'p99': self._percentile(latencies, 99) * 1000,
+                'max': self._percentile(latencies, 100) * 1000,
+            },
+            'memory_per_connection_kb': memory_per_connection / 1024.0,
+            'redis_round_trips_per_message': (
+                float(redis_round_trips) / statements
+            ),
+            'db_queries_per_message': float(db_queries) / statements,
+        }
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        if options['output']:
+            with open(options['output'], 'a') as output:
+                output.write(json.dumps(results, sort_keys=True) + '\n')
+
+    def _join(self, client, i, rooms, encoding):
+        client.room = 'bench_%d' % (i % rooms)
+        client.connect()
+        client.call('nick_set', 'nick', 'bench_%d' % i)
+        client.call('encoding_set', 'encoding', encoding)
+        client.call('room_joined', 'join', client.room)
+
+    def _chat(self, client, messages):
+        # Each statement carries the time it was sent, so whoever receives
+        #   it can work out how long it took to get there.
+        for i in range(0, messages):
+            client.call('statement_ok', 'statement', client.room,
+                        'bench %f' % time.time())
+
+    def _leave(self, client):
+        client.call('room_left', 'leave', client.room, timeout=2)
+        client.disconnect()
+
+    def _redis_checkouts(self):
+        # Every checkout is a round trip, on whichever node it was.
+        return sum([redis_pool.checkouts for redis_pool in get_pools()])
+
+    def _rss(self):
+        """Return the resident set size of this process, in bytes."""
+
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize()
+        except IOError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _percentile(self, values, percentile):
+        if not values:
+            return 0.0
+        index = int(round((len(values) - 1) * percentile / 100.0))
+        return values[index]
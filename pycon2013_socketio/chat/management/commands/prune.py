@@ -0,0 +1,81 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from pycon2013_socketio.chat.retention import Pruner, get_policies
+import gevent
+import signal
+
+
+class Command(BaseCommand):
+    help = ' '.join((
+        'Deletes events that are older than their retention period (see the',
+        'CHAT_RETENTION_* settings), a batch at a time, optionally archiving',
+        'them to gzipped JSON-lines files first. With --loop, keeps doing so',
+        'until it is stopped.',
+    ))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+            action='store_true',
+            default=False,
+            dest='loop',
+            help='Keep pruning, every --interval seconds, until stopped.',
+        ),
+        make_option('--interval',
+            default=300,
+            dest='interval',
+            help='Seconds between runs, with --loop (default: 300).',
+            type='int',
+        ),
+        make_option('--batch-size',
+            default=1000,
+            dest='batch_size',
+            help='Events deleted per query (default: 1000).',
+            type='int',
+        ),
+        make_option('--pause',
+            default=100,
+            dest='pause',
+            help='Milliseconds to wait between batches (default: 100).',
+            type='int',
+        ),
+        make_option('--archive',
+            default=settings.CHAT_RETENTION_ARCHIVE_DIR or None,
+            dest='archive',
+            help=' '.join((
+                'Write events to gzipped JSON-lines files in this directory',
+                'before deleting them.',
+            )),
+        ),
+    )
+
+    def handle(self, *args, **options):
+        """Prune events, once or forever."""
+
+        pruner = Pruner(get_policies(),
+            archive_dir=options['archive'],
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+        )
+
+        # Just once? Then we're done as soon as that's done.
+        if not options['loop']:
+            pruner.prune()
+            self._report(pruner)
+            return
+
+        # Otherwise, prune in a background greenlet until we're told to stop.
+        # We're only ever interrupted between batches (the greenlet only
+        #   yields there), so a batch is never half-archived.
+        greenlet = gevent.spawn(pruner.run_forever, options['interval'])
+        gevent.signal(signal.SIGTERM, greenlet.kill)
+        gevent.signal(signal.SIGINT, greenlet.kill)
+        greenlet.join()
+        self._report(pruner)
+
+    def _report(self, pruner):
+        for event_type, deleted in sorted(pruner.deleted.items()):
+            self.stdout.write('Deleted %d %s events.' % (deleted, event_type))
+        if pruner.archived:
+            self.stdout.write('Archived %d events.' % pruner.archived)
@@ -0,0 +1,55 @@
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+from pycon2013_socketio.chat.models import Event, SearchTerm
+
+
+class Command(BaseCommand):
+    help = ' '.join((
+        'Rebuilds the search index, a batch of events at a time. New',
+        'events are indexed as they are saved; this is for the ones that',
+        'were saved before there was an index (or that failed to make it',
+        'in).',
+    ))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            default=1000,
+            dest='batch_size',
+            help='Events indexed per batch (default: 1000).',
+            type='int',
+        ),
+    )
+
+    def handle(self, *args, **options):
+        """Rebuild the index."""
+
+        # Walk through the events in ID order, a batch at a time; like the
+        #   pruner, we never select more than a batch's worth of rows.
+        # Each batch's index entries are thrown away and written again in a
+        #   transaction of its own. We never empty the whole index at once:
+        #   searches would come up empty until we were done, and anything
+        #   the server indexed in the meantime would be lost, or written
+        #   twice.
+        events = Event.objects.filter(
+            event_type__in=Event.BACKLOG_TYPES,
+        ).order_by('id')
+        last_id = 0
+        indexed = 0
+        terms = 0
+        while True:
+            batch = list(events.filter(
+                id__gt=last_id,
+            )[0:options['batch_size']])
+            if not batch:
+                break
+            with transaction.commit_on_success():
+                SearchTerm.objects.filter(
+                    event__in=[ev.id for ev in batch],
+                ).delete()
+                terms += SearchTerm.objects.index(batch)
+            indexed += len(batch)
+            last_id = batch[-1].id
+
+        self.stdout.write('Indexed %d events (%d terms).' % (indexed, terms))
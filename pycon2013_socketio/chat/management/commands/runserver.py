@@ -1,27 +1,14 @@
 from __future__ import unicode_literals
-from gevent import monkey, spawn; monkey.patch_all()  # this *must* run first
+from gevent import monkey; monkey.patch_all()  # this *must* run first
+from django.conf import settings
 from django.contrib.staticfiles.management.commands import runserver
-from django.utils.autoreload import code_changed, restart_with_reloader
 from optparse import make_option
-from signal import SIGINT
-from socketio.server import SocketIOServer
+from pycon2013_socketio.chat.assets import StaticAssetsMiddleware
+from pycon2013_socketio.chat.reloader import restart, watch
+from pycon2013_socketio.chat.server import ChatServer, drain
 import django
 import os
-import subprocess
 import sys
-import time
-
-
-# Make reload tracking that Django's original runserver has
-# work; the SocketIO server piece breaks it otherwise.
-_server_should_reload = False
-def reload_watcher():
-    global _server_should_reload
-    while True:
-        _server_should_reload = code_changed()
-        if _server_should_reload:
-            os.kill(os.getpid(), SIGINT)
-        time.sleep(1)
 
 
 class Command(runserver.Command):
@@ -46,6 +33,15 @@ class Command(runserver.Command):
             )),
             type='int',
         ),
+        make_option('--drain-timeout',
+            default=2,
+            dest='drain_timeout',
+            help=' '.join((
+                'Seconds the server is given to disconnect its sockets',
+                'before it reloads or stops (default: 2).',
+            )),
+            type='float',
+        ),
     )
     
     
@@ -58,6 +54,11 @@ class Command(runserver.Command):
         
         # Import the WSGI handler.
         application = self.get_handler(*args, **kwargs)
+
+        # Serve static files from memory, in front of everything else (see
+        #   `chat/assets.py`).
+        if settings.CHAT_STATIC_ASSETS:
+            application = StaticAssetsMiddleware(application)
         
         # Print nice things to the console; make it look mostly like
         # the traditional Django dev server.
@@ -81,7 +82,7 @@ class Command(runserver.Command):
         #   is "socket.io", and this is probably the best choice. It's possible
         #   to use something else, but it has to match everywhere and most
         #   likely won't be very DRY unless you jump a lot of hoops.
-        socket_io_server = SocketIOServer(
+        socket_io_server = ChatServer(
             (kwargs['host'], kwargs['port']),
             application,
             resource='socket.io',
@@ -89,28 +90,35 @@ class Command(runserver.Command):
         )
         
         # Set up the socket io server to actually serve; use the
-        # auto-reloader if desired.
-        use_reloader = kwargs['use_reloader']
-        if use_reloader:
-            spawn(reload_watcher)
+        #   auto-reloader if desired. Django's own reloader doesn't get on
+        #   with the SocketIO server, so we have our own (see
+        #   `chat.reloader`).
+        if kwargs['use_reloader']:
+            watch(lambda: self.reload(socket_io_server, kwargs))
         
         # Run the socket.io server within a try/except block
-        # (so that if it is shut down, it can be restarted).
+        # (so that if it is shut down, it can be cleaned up after).
         try:
             socket_io_server.serve_forever()
         except KeyboardInterrupt:
-            global _server_should_reload
-            if _server_should_reload:
-                # Set my "should reload" variable back to False.
-                _server_should_reload = False
-                
-                # Kill the server.
-                socket_io_server.kill()
-                socket_io_server = None
-                
-                # Now, reload a new server.
-                print '\nReloading server...'
-                restart_with_reloader()
-            else:
-                print '\r\n\n'
-                sys.exit(0)
\ No newline at end of file
+            # Shut down the same way `serve` does: disconnect everyone, so
+            #   that their departures are announced and their presence
+            #   entries cleared out, and make sure everything that's been
+            #   queued for the database actually gets written, before we go
+            #   away.
+            print '\r\nDraining...'
+            drain(socket_io_server, timeout=kwargs['drain_timeout'])
+            print '\r\n\n'
+            sys.exit(0)
+
+    def reload(self, socket_io_server, kwargs):
+        """Drain the server, and start it again, with whatever code has
+        changed."""
+
+        print '\nReloading server...'
+
+        # Disconnect everyone (they'll reconnect to the new server as soon
+        #   as it's up), and write out anything waiting to be written.
+        drain(socket_io_server, timeout=kwargs['drain_timeout'],
+              wait_for_leaves=False)
+        restart()
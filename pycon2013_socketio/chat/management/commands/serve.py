@@ -0,0 +1,257 @@
+from __future__ import unicode_literals
+from gevent import monkey; monkey.patch_all()  # this *must* run first
+from django.conf import settings
+from django.contrib.staticfiles.handlers import StaticFilesHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.utils.importlib import import_module
+from gevent.event import Event
+from optparse import make_option
+from pycon2013_socketio.chat.assets import StaticAssetsMiddleware
+from pycon2013_socketio.chat.brokers import MemoryBroker
+from pycon2013_socketio.chat.presence import MemoryPresence
+from pycon2013_socketio.chat.server import drain, make_server
+from pycon2013_socketio.chat.sessions import MemorySessionStore
+import django
+import errno
+import gevent
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+
+class Command(BaseCommand):
+    help = ' '.join((
+        'Starts the socket.io server in production mode: a master process',
+        'that pre-forks several worker processes, all sharing the same',
+        'listening socket. Send SIGHUP to restart the workers one at a',
+        'time, and SIGTERM (or SIGINT) to drain them and shut down.',
+    ))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host',
+            default='127.0.0.1',
+            dest='host',
+            help='Designates the interface to listen on (default: 127.0.0.1).',
+        ),
+        make_option('--port',
+            default=8000,
+            dest='port',
+            help='Designates the port to run the server (default: 8000).',
+            type='int',
+        ),
+        make_option('--workers',
+            default=multiprocessing.cpu_count(),
+            dest='workers',
+            help='Number of worker processes (default: one per CPU).',
+            type='int',
+        ),
+        make_option('--drain-timeout',
+            default=10,
+            dest='drain_timeout',
+            help=' '.join((
+                'Seconds a stopping worker is given to disconnect its',
+                'sockets before it is killed (default: 10).',
+            )),
+            type='int',
+        ),
+    )
+
+    def handle(self, *args, **options):
+        """Run the master process."""
+
+        # Anything kept in memory is kept in one worker, and the others
+        #   never see it: rooms would be split between the workers, `who`
+        #   would only list the sockets in one of them, and polls that
+        #   landed on the wrong one would get a 404. So with more than one
+        #   worker, the broker, presence and sessions must all go through
+        #   Redis.
+        if options['workers'] > 1:
+            for setting, local in (
+                ('CHAT_BROKER', MemoryBroker),
+                ('CHAT_PRESENCE', MemoryPresence),
+                ('CHAT_SESSION_STORE', MemorySessionStore),
+            ):
+                module_name, class_name = getattr(settings,
+                                                  setting).rsplit('.', 1)
+                cls = getattr(import_module(module_name), class_name)
+                if issubclass(cls, local):
+                    raise CommandError(' '.join((
+                        '%s is %s, which keeps everything in one process.',
+                        'With more than one worker, use the Redis one',
+                        '(or --workers=1).',
+                    )) % (setting, class_name))
+
+        self.options = options
+        self.application = StaticFilesHandler(get_wsgi_application())
+
+        # Static files are read (and gzipped) here, once, and every worker
+        #   inherits them (see `chat/assets.py`).
+        if settings.CHAT_STATIC_ASSETS:
+            self.application = StaticAssetsMiddleware(self.application)
+
+        # Bind the listening socket here, in the master. Every worker
+        #   inherits it when it is forked, and the kernel hands each
+        #   incoming connection to whichever worker accepts it first.
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((options['host'], options['port']))
+        self.listener.listen(1024)
+        self.listener.setblocking(0)
+
+        # Workers must not share the master's database connection.
+        for connection in connections.all():
+            connection.close()
+
+        print "Django version {version}, using settings '{settings}'.".format(
+            settings=os.environ['DJANGO_SETTINGS_MODULE'],
+            version=django.get_version(),
+        )
+        print 'SocketIO server is listening on port %d with %d workers.' % (
+            options['port'], options['workers'],
+        )
+        print 'Master process is %d. Quit the server with CONTROL-C.' % (
+            os.getpid(),
+        )
+
+        # The master only ever does three things: notice that it has been
+        #   signalled, notice that a worker has died, and start (or stop)
+        #   workers in response.
+        self.workers = set()
+        self._should_stop = False
+        self._should_restart = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+
+        for i in range(0, options['workers']):
+            self._spawn_worker()
+
+        while not self._should_stop:
+            # Replace any worker that died on us.
+            for pid in self._reap():
+                print 'Worker %d exited; starting a new one.' % pid
+                self._spawn_worker()
+
+            # Restart workers one at a time, so there is never a moment
+            #   where nobody is accepting connections.
+            if self._should_restart:
+                self._should_restart = False
+                for pid in list(self.workers):
+                    self._spawn_worker()
+                    self._stop_worker(pid)
+
+            time.sleep(0.5)
+
+        # Shut everything down.
+        print '\nDraining workers...'
+        for pid in list(self.workers):
+            self._stop_worker(pid, wait=False)
+        self._wait_for(self.workers.copy())
+        sys.exit(0)
+
+    def _stop(self, signum, frame):
+        self._should_stop = True
+
+    def _restart(self, signum, frame):
+        self._should_restart = True
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return pid
+
+        # We're the child; we never return from here.
+        try:
+            self._run_worker()
+        finally:
+            os._exit(0)
+
+    def _stop_worker(self, pid, wait=True):
+        """Ask a worker to drain and exit; if `wait` is set, wait for it
+        to do so."""
+
+        self.workers.discard(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            return
+        if wait:
+            self._wait_for(set([pid]))
+
+    def _wait_for(self, pids):
+        """Wait for the given workers to exit, killing any that outstay the
+        drain timeout."""
+
+        deadline = time.time() + self.options['drain_timeout'] + 5
+        while pids and time.time() < deadline:
+            for pid in list(pids):
+                try:
+                    finished, status = os.waitpid(pid, os.WNOHANG)
+                except OSError:
+                    finished = pid
+                if finished:
+                    pids.discard(pid)
+            time.sleep(0.1)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+    def _reap(self):
+        """Return the PIDs of any workers that have exited unexpectedly."""
+
+        dead = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            if pid in self.workers:
+                self.workers.discard(pid)
+                dead.append(pid)
+        return dead
+
+    def _run_worker(self):
+        """Serve requests until told to stop, then drain and return."""
+
+        # Give the worker a fresh gevent hub, rather than the one it
+        #   inherited from the master.
+        gevent.reinit()
+
+        # Session IDs come from `random`, and every worker inherited the
+        #   master's random state; reseed, or they'd all hand out the same
+        #   ones, which matters once sessions are shared between workers.
+        random.seed()
+
+        # Room events reach the other workers through the broker (which
+        #   `handle` has made sure goes through Redis).
+        # The Flash policy server is left off, since it binds its own port,
+        #   and only one process can do that.
+        server = make_server(self.listener, self.application,
+                             policy_server=False)
+
+        # The master tells us to stop with SIGTERM; SIGINT (as from
+        #   CONTROL-C, which goes to the whole process group) and SIGHUP are
+        #   left for the master to deal with.
+        stopping = Event()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        gevent.signal(signal.SIGTERM, stopping.set)
+
+        server.start()
+        stopping.wait()
+        drain(server, timeout=self.options['drain_timeout'])
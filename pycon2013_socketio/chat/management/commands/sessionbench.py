@@ -0,0 +1,191 @@
+from __future__ import unicode_literals
+from gevent import monkey; monkey.patch_all()  # this *must* run first
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from gevent.pool import Pool
+from optparse import make_option
+from pycon2013_socketio.chat.management.commands.chatbench import BenchClient
+from pycon2013_socketio.chat.server import ChatServer
+import gevent
+import json
+import os
+import random
+import signal
+import socket
+import time
+
+
+class Command(BaseCommand):
+    help = ' '.join((
+        'Benchmarks the Redis session store: how much longer a round trip',
+        'takes when a client\'s polls and posts go to a different process',
+        'from the one that owns its session (and are relayed to it), than',
+        'when they go to the owner itself. Reports the results as JSON.',
+    ))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host',
+            default='127.0.0.1',
+            dest='host',
+            help='Interface for the benchmark servers (default: 127.0.0.1).',
+        ),
+        make_option('--port',
+            default=8770,
+            dest='port',
+            help=' '.join((
+                'Port for the server that owns the sessions; the other',
+                'server uses the next one up (default: 8770).',
+            )),
+            type='int',
+        ),
+        make_option('--clients',
+            default=10,
+            dest='clients',
+            help='Number of simulated clients (default: 10).',
+            type='int',
+        ),
+        make_option('--round-trips',
+            default=100,
+            dest='round_trips',
+            help='Round trips made by each client (default: 100).',
+            type='int',
+        ),
+        make_option('--output',
+            default=None,
+            dest='output',
+            help=' '.join((
+                'Append the results, as one line of JSON, to this file',
+                '(as well as printing them).',
+            )),
+        ),
+    )
+
+    def handle(self, *args, **options):
+        """Run the benchmark."""
+
+        call_command('syncdb', interactive=False, verbosity=0)
+        settings.CHAT_RATE_LIMITS = {}
+        settings.CHAT_SESSION_STORE = (
+            'pycon2013_socketio.chat.sessions.RedisSessionStore'
+        )
+        application = get_wsgi_application()
+
+        # The other server runs in a process of its own, since a session
+        #   store is shared by everything in its process.
+        for connection in connections.all():
+            connection.close()
+        relay_port = options['port'] + 1
+        pid = os.fork()
+        if not pid:
+            try:
+                self._run_relay(options['host'], relay_port, application)
+            finally:
+                os._exit(0)
+
+        server = ChatServer((options['host'], options['port']), application,
+                            resource='socket.io', policy_server=False,
+                            log=None)
+        server.start()
+        try:
+            self._wait_for(options['host'], relay_port)
+            results = {
+                'timestamp': time.time(),
+                'clients': options['clients'],
+                'round_trips': options['clients'] * options['round_trips'],
+            }
+
+            # Each client's session lives in this process. In the first run,
+            #   the clients poll and post here, too; in the second, they
+            #   poll and post to the other process, which relays everything
+            #   to this one.
+            for name, port in (('owner', options['port']),
+                               ('relayed', relay_port)):
+                results[name] = self._bench(options, port)
+            results['overhead_ms'] = {
+                'p50': results['relayed']['p50'] - results['owner']['p50'],
+                'mean': results['relayed']['mean'] - results['owner']['mean'],
+            }
+        finally:
+            server.stop()
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        if options['output']:
+            with open(options['output'], 'a') as output:
+                output.write(json.dumps(results, sort_keys=True) + '\n')
+
+    def _run_relay(self, host, port, application):
+        """Serve (in a forked child) until told to stop."""
+
+        gevent.reinit()
+        random.seed()
+        server = ChatServer((host, port), application, resource='socket.io',
+                            policy_server=False, log=None)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        gevent.signal(signal.SIGTERM, server.stop)
+        server.serve_forever()
+
+    def _wait_for(self, host, port, timeout=10):
+        """Wait until something is listening on `port`."""
+
+        deadline = time.time() + timeout
+        while True:
+            try:
+                socket.create_connection((host, port)).close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                gevent.sleep(0.05)
+
+    def _bench(self, options, transport_port):
+        """Have each client make its round trips, and summarize how long
+        they took (in milliseconds)."""
+
+        clients = [
+            BenchClient(options['host'], options['port'],
+                        lambda client, name, args: None,
+                        transport_port=transport_port)
+            for i in range(0, options['clients'])
+        ]
+        pool = Pool(len(clients))
+        for client in clients:
+            pool.spawn(client.connect)
+        pool.join()
+
+        # A nick change is a post, and the reply comes down in a poll.
+        timings = []
+        for i, client in enumerate(clients):
+            pool.spawn(self._round_trips, client, 'bench_%d' % i,
+                       options['round_trips'], timings)
+        pool.join()
+
+        for client in clients:
+            pool.spawn(client.disconnect)
+        pool.join()
+
+        timings.sort()
+        return {
+            'p50': self._percentile(timings, 50) * 1000,
+            'p99': self._percentile(timings, 99) * 1000,
+            'mean': sum(timings) / max(len(timings), 1) * 1000,
+            'failed': options['clients'] * options['round_trips'] -
+                      len(timings),
+        }
+
+    def _round_trips(self, client, name, round_trips, timings):
+        for i in range(0, round_trips):
+            start = time.time()
+            if client.call('nick_set', 'nick', '%s_%d' % (name, i),
+                           timeout=5):
+                timings.append(time.time() - start)
+
+    def _percentile(self, values, percentile):
+        if not values:
+            return 0.0
+        index = int(round((len(values) - 1) * percentile / 100.0))
+        return values[index]
@@ -0,0 +1,140 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from optparse import make_option
+from pycon2013_socketio.chat import wire
+from pycon2013_socketio.chat.models import Event
+from socketio import packet
+import json
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = ' '.join((
+        'Benchmarks the wire encodings for room events: for each one, how',
+        'long it takes to encode an event for the broker, decode it again,',
+        'and wrap it in a socket.io packet (and back), and how many bytes',
+        'the event takes up on each hop. Reports the results as JSON.',
+    ))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--events',
+            default=10000,
+            dest='events',
+            help='Number of events to encode (default: 10000).',
+            type='int',
+        ),
+        make_option('--message-length',
+            default=40,
+            dest='message_length',
+            help='Length of each statement, in characters (default: 40).',
+            type='int',
+        ),
+        make_option('--output',
+            default=None,
+            dest='output',
+            help=' '.join((
+                'Append the results, as one line of JSON, to this file',
+                '(as well as printing them).',
+            )),
+        ),
+    )
+
+    def handle(self, *args, **options):
+        """Run the benchmark."""
+
+        # Make up some events. They're never saved; we only need them to
+        #   look like the real thing. Most events are statements.
+        now = timezone.now()
+        events = []
+        for i in range(0, options['events']):
+            event_type = random.choice(
+                ('statement',) * 7 + ('user_joined', 'user_left', 'topic_set'),
+            )
+            events.append(dict(
+                id=i + 1,
+                sequence=i + 1,
+                room_id='bench',
+                event_type=event_type,
+                user_name='user_%08x' % random.getrandbits(32),
+                message=''.join([
+                    random.choice('abcdefghijklmnopqrstuvwxyz ')
+                    for j in range(0, options['message_length'])
+                ]),
+                created=now,
+            ))
+
+        results = {
+            'timestamp': time.time(),
+            'events': len(events),
+            'message_length': options['message_length'],
+        }
+        original_format = settings.CHAT_WIRE_FORMAT
+        try:
+            for encoding in wire.FORMATS:
+                settings.CHAT_WIRE_FORMAT = encoding
+                results[encoding] = self._bench(events, encoding)
+        finally:
+            settings.CHAT_WIRE_FORMAT = original_format
+
+        # How does compact compare?
+        results['compact_vs_json'] = dict([
+            (key, results['compact'][key] / results['json'][key])
+            for key in results['json'] if results['json'][key]
+        ])
+
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        if options['output']:
+            with open(options['output'], 'a') as output:
+                output.write(json.dumps(results, sort_keys=True) + '\n')
+
+    def _bench(self, events, encoding):
+        """Push the events through every step of the trip from `Event.save`
+        to the browser, in the given encoding, timing each step."""
+
+        count = float(len(events))
+        instances = [Event(**kwargs) for kwargs in events]
+        compact = encoding == 'compact'
+
+        # Publishing: the event is encoded for the broker.
+        start = time.time()
+        payloads = [event.serialize() for event in instances]
+        encode = time.time() - start
+
+        # Dispatching: each process that receives it decodes it once.
+        start = time.time()
+        decoded = [wire.loads(payload) for payload in payloads]
+        decode = time.time() - start
+
+        # Delivering: the event is wrapped in a socket.io packet for each
+        #   socket it goes to.
+        start = time.time()
+        packets = [packet.encode({
+            'type': 'event',
+            'name': '%s_event' % data.room,
+            'args': [data.packed() if compact else data.as_dict()],
+            'endpoint': '/chat',
+        }) for data in decoded]
+        packet_encode = time.time() - start
+
+        # Receiving: the browser decodes the packet (and, for the compact
+        #   encoding, turns the event back into a dictionary).
+        start = time.time()
+        for message in packets:
+            args = packet.decode(message)['args']
+            if compact:
+                wire.unpack(args[0])
+        packet_decode = time.time() - start
+
+        return {
+            'broker_bytes_per_event': sum(map(len, payloads)) / count,
+            'socketio_bytes_per_event': sum(
+                [len(message.encode('utf-8')) for message in packets],
+            ) / count,
+            'broker_encode_us': encode / count * 1e6,
+            'broker_decode_us': decode / count * 1e6,
+            'socketio_encode_us': packet_encode / count * 1e6,
+            'socketio_decode_us': packet_decode / count * 1e6,
+        }
@@ -0,0 +1,300 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from greenlet import greenlet
+import bisect
+import gc
+import gevent
+import logging
+import time
+
+
+class Histogram(object):
+    """A histogram of durations (in seconds, unless other `buckets` are
+    given), kept in this process.
+
+    Observations are counted into fixed buckets, so recording one costs a
+    binary search and a few additions, and the histogram never grows,
+    however many observations it gets. That makes it cheap enough to leave
+    on all the time.
+    """
+
+    # The upper bounds of the buckets, in seconds.
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, labels, buckets=None):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Record one observation."""
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """Return a context manager that records how long its block takes."""
+
+        return _Timer(self)
+
+    def percentile(self, percentile):
+        """Return (roughly) the given percentile of the observations: the
+        upper bound of the bucket it falls in. (Anything past the last
+        bucket is reported as the last bucket's bound.)"""
+
+        if not self.count:
+            return 0.0
+        target = self.count * percentile / 100.0
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            if running >= target:
+                return bound
+        return self.buckets[-1]
+
+    def as_dict(self):
+        return {
+            'labels': self.labels,
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': dict(zip(
+                [str(bound) for bound in self.buckets] + ['+Inf'],
+                self.counts,
+            )),
+        }
+
+
+class Counter(object):
+    """A count of how many times something has happened in this process."""
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+
+# Every histogram and counter in the process, by name and labels; and every
+#   gauge, by name. A gauge is a function, called whenever metrics are
+#   reported, that returns the current value of something.
+_histograms = {}
+_counters = {}
+_gauges = {}
+
+# The greenlet that logs a summary every `CHAT_METRICS_LOG_INTERVAL` seconds;
+#   see `start_logger`.
+_logger = None
+
+# The greenlet that measures how long the event loop is blocked for; see
+#   `start_hub_probe`.
+_hub_probe = None
+
+
+def histogram(name, buckets=None, **labels):
+    """Return the histogram with the given name and labels, creating it if
+    this is the first we've heard of it.
+
+    Looking a histogram up costs a little; on hot paths, look it up once,
+    ahead of time, and hang on to it.
+    """
+
+    key = (name, tuple(sorted(labels.items())))
+    if key not in _histograms:
+        _histograms[key] = Histogram(name, labels, buckets=buckets)
+    return _histograms[key]
+
+
+def counter(name, **labels):
+    """Return the counter with the given name and labels, creating it if
+    this is the first we've heard of it."""
+
+    key = (name, tuple(sorted(labels.items())))
+    if key not in _counters:
+        _counters[key] = Counter(name, labels)
+    return _counters[key]
+
+
+def gauge(name, function):
+    """Register a gauge: `function` is called, with no arguments, for the
+    current value whenever metrics are reported."""
+
+    _gauges[name] = function
+
+
+def count_greenlets():
+    """Return the number of live greenlets in the process.
+
+    This has to look at every object in the process, so it's for reporting
+    only; don't call it on a hot path.
+    """
+
+    return len([
+        obj for obj in gc.get_objects()
+        if isinstance(obj, greenlet) and obj and not obj.dead
+    ])
+
+
+gauge('chat_greenlets', count_greenlets)
+
+
+def snapshot():
+    """Return every metric in the process, as a dictionary."""
+
+    gauges = {}
+    for name, function in _gauges.items():
+        try:
+            gauges[name] = function()
+        except Exception:
+            gauges[name] = None
+
+    histograms = {}
+    for (name, labels), hist in sorted(_histograms.items()):
+        histograms.setdefault(name, []).append(hist.as_dict())
+
+    counters = {}
+    for (name, labels), count in sorted(_counters.items()):
+        counters.setdefault(name, []).append({
+            'labels': count.labels,
+            'value': count.value,
+        })
+
+    return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+
+def prometheus():
+    """Return every metric in the process, in the Prometheus text format."""
+
+    lines = []
+    for name, function in sorted(_gauges.items()):
+        try:
+            value = function()
+        except Exception:
+            continue
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %s' % (name, value))
+
+    seen = set()
+    for (name, labels), count in sorted(_counters.items()):
+        if name not in seen:
+            lines.append('# TYPE %s counter' % name)
+            seen.add(name)
+        lines.append('%s%s %d' % (name, _labels(labels), count.value))
+
+    for (name, labels), hist in sorted(_histograms.items()):
+        if name not in seen:
+            lines.append('# TYPE %s histogram' % name)
+            seen.add(name)
+        running = 0
+        for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+            running += count
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(labels + (('le', bound),)), running,
+            ))
+        lines.append('%s_sum%s %f' % (name, _labels(labels), hist.sum))
+        lines.append('%s_count%s %d' % (name, _labels(labels), hist.count))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join([
+        '%s="%s"' % (key, value) for key, value in labels
+    ])
+
+
+def start_logger():
+    """Start logging a summary of the metrics every
+    `CHAT_METRICS_LOG_INTERVAL` seconds, if that is set, and if we aren't
+    already.
+
+    This is called when the first socket connects, rather than when this
+    module is imported, so that the greenlet is started in whichever
+    process is actually serving sockets (see `manage.py serve`).
+    """
+
+    global _logger
+    interval = float(settings.CHAT_METRICS_LOG_INTERVAL)
+    if _logger is None and interval:
+        _logger = gevent.spawn(_log_forever, interval)
+
+
+def start_hub_probe():
+    """Start measuring how responsive the event loop is, if
+    `CHAT_HUB_PROBE_INTERVAL` is set, and if we aren't already.
+
+    Like `start_logger`, this is called when the first socket connects.
+    """
+
+    global _hub_probe
+    interval = float(settings.CHAT_HUB_PROBE_INTERVAL) / 1000
+    if _hub_probe is None and interval:
+        _hub_probe = gevent.spawn(_probe_forever, interval,
+            float(settings.CHAT_HUB_BLOCKED_WARNING) / 1000,
+        )
+
+
+def _probe_forever(interval, warning):
+    """Sleep for `interval` seconds, over and over, recording how much
+    longer than that each sleep actually took.
+
+    A greenlet only wakes up late if something else was holding on to the
+    event loop -- a blocking database call, say, or a long computation --
+    so that's how long every other socket in the process had to wait, too.
+    Anything over `warning` seconds is logged.
+    """
+
+    log = logging.getLogger('socketio')
+    lag = histogram('chat_hub_lag_seconds')
+    while True:
+        start = time.time()
+        gevent.sleep(interval)
+        late = max(time.time() - start - interval, 0)
+        lag.observe(late)
+        if warning and late > warning:
+            log.warning('The event loop was blocked for %.0f ms.',
+                        late * 1000)
+
+
+def _log_forever(interval):
+    """Log a one-line summary of the metrics every `interval` seconds."""
+
+    log = logging.getLogger('socketio')
+    while True:
+        gevent.sleep(interval)
+        parts = []
+        for (name, labels), hist in sorted(_histograms.items()):
+            if not hist.count:
+                continue
+            parts.append('%s%s n=%d p50=%.1fms p99=%.1fms' % (
+                name, _labels(labels), hist.count,
+                hist.percentile(50) * 1000, hist.percentile(99) * 1000,
+            ))
+        for (name, labels), count in sorted(_counters.items()):
+            parts.append('%s%s=%d' % (name, _labels(labels), count.value))
+        for name, function in sorted(_gauges.items()):
+            try:
+                parts.append('%s=%s' % (name, function()))
+            except Exception:
+                pass
+        log.info('Metrics: %s', '; '.join(parts))
@@ -1,8 +1,72 @@
 from __future__ import unicode_literals
 from django.conf import settings
-from django.db import models
-from redis import Redis
+from django.db import connection, models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from pycon2013_socketio.chat import metrics, offload, wire
+from pycon2013_socketio.chat.brokers import get_broker
+from pycon2013_socketio.chat.search import tokenize
+from pycon2013_socketio.chat.writer import get_writer
+from uuid import uuid4
 import json
+import time
+
+
+# The in-process room cache; see `RoomManager`.
+_room_cache = {}
+
+# How long saving and publishing events takes.
+_save_time = metrics.histogram('chat_db_write_seconds', op='save')
+_publish_time = metrics.histogram('chat_publish_seconds')
+
+# How long searches take.
+_search_time = metrics.histogram('chat_search_seconds')
+
+
+class RoomManager(models.Manager):
+    def get_cached(self, slug):
+        """Return the room with the given slug, from the in-process room
+        cache if we have it.
+
+        Rooms are looked up on nearly every chat event, and almost never
+        change, so there's no reason to go to the database for them every
+        time. Cached rooms are dropped when they are saved in this process,
+        when a topic change for them comes through the broker from any
+        process, and in any case after `CHAT_ROOM_CACHE_TTL` seconds.
+
+        Raises `Room.DoesNotExist` if there is no such room.
+        """
+
+        room, expires = _room_cache.get(slug, (None, 0))
+        if expires > time.time():
+            return room
+
+        # Like every database call on the chat path, this runs on the
+        #   database thread pool, if there is one (see `chat/offload.py`).
+        room = offload.run(self.get, id=slug)
+        self.cache(room)
+        return room
+
+    def get_or_create_cached(self, slug):
+        """Like `get_cached`, but create the room if it does not exist."""
+
+        try:
+            return self.get_cached(slug)
+        except self.model.DoesNotExist:
+            room, new = offload.run(self.get_or_create, id=slug)
+            self.cache(room)
+            return room
+
+    def cache(self, room):
+        """Put a room in the in-process room cache."""
+
+        expires = time.time() + float(settings.CHAT_ROOM_CACHE_TTL)
+        _room_cache[room.id] = (room, expires)
+
+    def invalidate(self, slug):
+        """Drop a room from the in-process room cache."""
+
+        _room_cache.pop(slug, None)
 
 
 class Room(models.Model):
@@ -14,6 +78,8 @@ class Room(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
+    objects = RoomManager()
+
     class Meta:
         ordering = ('id',)
 
@@ -23,9 +89,231 @@ class Room(models.Model):
             'topic': self.topic,
         }.iteritems()
 
+    def save(self, *args, **kwargs):
+        """Save the room, and drop any stale copy of it from the cache."""
+
+        return_value = offload.run(super(Room, self).save, *args, **kwargs)
+        Room.objects.invalidate(self.id)
+        return return_value
+
+    # Everything the broker keeps for a room has the room's slug in braces,
+    #   so that (if Redis is sharded) it all lives on the same node; see
+    #   `HashRing` in `chat/connections.py`.
     @property
     def redis_key(self):
-        return 'room_%s' % self.id
+        return 'room_{%s}' % self.id
+
+    @property
+    def backlog_key(self):
+        return 'backlog_{%s}' % self.id
+
+    @property
+    def sequence_key(self):
+        return 'sequence_{%s}' % self.id
+
+    def leaving_key(self, user_name):
+        return 'leaving_{%s}_%s' % (self.id, user_name)
+
+    def next_sequence(self):
+        """Return the next number in this room's event sequence.
+
+        Every event in a room gets a number, one higher than the last, so a
+        client that has been away can tell us exactly what it last saw. The
+        counter lives in the broker, so it works across processes (and
+        before events are saved; see `EventManager.record`).
+        """
+
+        def seed():
+            return offload.run(Event.objects.filter(room=self).aggregate,
+                models.Max('sequence'),
+            )['sequence__max'] or 0
+        return get_broker().next_sequence(self.sequence_key, seed)
+
+    def get_backlog(self):
+        """Return the most recent statements and topic changes in this room,
+        oldest first, as `WireEvent`s ready to send down to the browser (see
+        `chat/wire.py`).
+
+        These are served from a capped list (newest first) held by the
+        broker -- in Redis, usually -- which `Event.save` keeps up to date.
+        If the list isn't there (nobody has asked for this room since Redis
+        started, say), we fall back to the database, and then warm the list
+        for the next person.
+        """
+
+        size = int(settings.CHAT_BACKLOG_SIZE)
+        broker = get_broker()
+
+        # Try the cache first.
+        cached = broker.get_backlog(self.backlog_key, size)
+        if cached:
+            return [wire.loads(payload) for payload in reversed(cached)]
+
+        # Cache miss; go to the database.
+        payloads = [ev.serialize() for ev in offload.run(list,
+            Event.objects.filter(
+                event_type__in=Event.BACKLOG_TYPES,
+                room=self,
+            ).order_by('-created')[0:size],
+        )]
+
+        # Warm the cache. `Event.save` only ever pushes onto a list that
+        #   already exists, so it's on us to create it.
+        broker.fill_backlog(self.backlog_key, payloads, size)
+
+        return [wire.loads(payload) for payload in reversed(payloads)]
+
+    def get_events_since(self, last_seen):
+        """Return the statements and topic changes in this room that came
+        after sequence number `last_seen`, oldest first, along with whether
+        that is all of them.
+
+        This is what a reconnecting client gets instead of the whole
+        backlog. It comes out of the backlog cache, so it costs no more than
+        a regular join. If the client has missed more than the backlog
+        holds, we send what we have, and say that it is incomplete; the
+        client can fill the gap with `history` if it wants to.
+        """
+
+        backlog = self.get_backlog()
+        missed = [ev for ev in backlog if (ev.seq or 0) > last_seen]
+        complete = (len(missed) < len(backlog) or
+                    len(backlog) < int(settings.CHAT_BACKLOG_SIZE))
+        return missed, complete
+
+
+class EventManager(models.Manager):
+    def record(self, **kwargs):
+        """Create a new event, and publish it to the room.
+
+        Ordinarily this is exactly the same as `create`. However, if
+        write-behind is turned on (`CHAT_WRITE_BEHIND`), the event is
+        published immediately and then handed off to a background
+        greenlet, which writes events to the database in batches. That
+        keeps the database off of the chat delivery path entirely.
+        """
+
+        if not settings.CHAT_WRITE_BEHIND:
+            return self.create(**kwargs)
+
+        event = self.model(**kwargs)
+        event.prepare()
+        event.publish()
+        get_writer().put(event)
+        return event
+
+    def history(self, room, before_id=None, before_timestamp=None,
+                limit=None):
+        """Return a page of a room's history (statements and topic changes),
+        newest first, along with the cursor for the page before it.
+
+        The cursor is the `id` and/or `created` timestamp of the oldest event
+        the caller already has; we return the `limit` events just before
+        that. With no cursor at all, we return the most recent events.
+
+        This is keyset pagination: rather than an OFFSET, which makes the
+        database walk (and throw away) every event it skips, we ask for
+        events older than the cursor, which the `(room, event_type,
+        created)` index can seek to directly. Fetching the thousandth page
+        costs the same as fetching the first.
+
+        The returned cursor is a dictionary with `before_id` and
+        `before_timestamp` keys, or `None` if there is nothing older.
+
+        The arguments may be strings, straight off of the wire; `limit`
+        defaults to `CHAT_BACKLOG_SIZE`, and is capped at
+        `CHAT_HISTORY_MAX_LIMIT`. Raises `ValueError` if any of them
+        doesn't make sense.
+        """
+
+        before_id, before_timestamp, limit = self.parse_page(
+            before_id, before_timestamp, limit,
+        )
+        events = self.filter(
+            event_type__in=self.model.BACKLOG_TYPES,
+            room=room,
+        )
+
+        # Events can share a timestamp, so if we have both halves of the
+        #   cursor, break ties on the ID.
+        if before_timestamp:
+            older = models.Q(created__lt=before_timestamp)
+            if before_id:
+                older |= models.Q(created=before_timestamp, id__lt=before_id)
+            events = events.filter(older)
+
+        # Ask for one more than we need, so we know if there's another page.
+        events = offload.run(list,
+            events.order_by('-created', '-id')[0:limit + 1],
+        )
+        return self.paginate(events, limit)
+
+    def parse_page(self, before_id, before_timestamp, limit):
+        """Make sense of the arguments for a page of events (see `history`),
+        and return them as `(before_id, before_timestamp, limit)`.
+
+        If we were only given an ID, we look up its timestamp; it's a single
+        primary key lookup. Raises `ValueError` if any of them doesn't make
+        sense.
+        """
+
+        limit = int(limit or settings.CHAT_BACKLOG_SIZE)
+        limit = max(min(limit, int(settings.CHAT_HISTORY_MAX_LIMIT)), 1)
+        before_id = int(before_id) if before_id else None
+        if isinstance(before_timestamp, basestring):
+            before_timestamp = parse_datetime(before_timestamp)
+            if before_timestamp is None:
+                raise ValueError('Invalid timestamp.')
+            if timezone.is_naive(before_timestamp):
+                before_timestamp = timezone.make_aware(before_timestamp,
+                                                       timezone.utc)
+
+        if before_id and not before_timestamp:
+            try:
+                before_timestamp = offload.run(self.get, id=before_id).created
+            except self.model.DoesNotExist:
+                before_id = None
+        return before_id, before_timestamp, limit
+
+    def paginate(self, events, limit):
+        """Given up to `limit + 1` events, newest first, return the first
+        `limit` of them, along with the cursor for the page before those
+        (or `None`, if that was everything)."""
+
+        if len(events) <= limit:
+            return events, None
+        events = events[0:limit]
+        return events, {
+            'before_id': events[-1].id,
+            'before_timestamp': events[-1].created.isoformat(),
+        }
+
+    def bulk_created(self, events):
+        """Add a batch of events, just written by the write-behind writer
+        (see `chat/writer.py`), to the search index.
+
+        This is kept apart from the write itself, which the writer retries
+        if it fails; retrying the write because indexing failed would save
+        the events twice. If this fails, the events are still there, and
+        `manage.py reindex` will pick them up.
+        """
+
+        offload.run(self._index_written, events)
+
+    def _index_written(self, events):
+        # `bulk_create` doesn't give us back the IDs of the rows it wrote;
+        #   read them back by the keys we gave the events (see `prepare`).
+        #   Only the events that are going in the index need them.
+        events = [ev for ev in events
+                  if ev.event_type in Event.BACKLOG_TYPES]
+        missing = [ev.uuid for ev in events
+                   if ev.id is None and ev.uuid is not None]
+        if missing:
+            ids = dict(self.filter(uuid__in=missing).values_list('uuid', 'id'))
+            for ev in events:
+                if ev.id is None:
+                    ev.id = ids.get(ev.uuid)
+        SearchTerm.objects.index(events)
 
 
 class Event(models.Model):
@@ -40,17 +328,57 @@ class Event(models.Model):
         ('topic_set', 'Topic Set'),
     ), db_index=True)
     message = models.TextField()
-    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Note: `default` rather than `auto_now_add`. Events can be published
+    #   before they are saved (see `EventManager.record`), and the timestamp
+    #   they are published with must be the one that ends up in the
+    #   database, since clients page back through history with it.
+    created = models.DateTimeField(default=timezone.now, db_index=True)
     modified = models.DateTimeField(auto_now=True)
 
+    # The event's place in the room's sequence; see `Room.next_sequence`.
+    # (Events from before sequence numbers existed don't have one.)
+    sequence = models.PositiveIntegerField(null=True, blank=True)
+
+    # A unique key for the event, made up before it is saved (see
+    #   `prepare`). Events written in bulk (see `chat/writer.py`) don't get
+    #   their IDs back from the database; this is how we find them again.
+    # (Events from before keys existed don't have one.)
+    uuid = models.CharField(max_length=32, unique=True, null=True,
+                            editable=False)
+
+    # The event types that are worth replaying to someone joining a room.
+    BACKLOG_TYPES = ('statement', 'topic_set')
+
+    # The JSON representation of the event, once it has been computed.
+    _payload = None
+
+    objects = EventManager()
+
     class Meta:
         ordering = ('-created',)
 
+        # This is the index that `EventManager.history` (and the backlog)
+        #   walk down.
+        # The other is how `Room.next_sequence` finds where a room's
+        #   sequence left off.
+        index_together = [
+            ('room', 'event_type', 'created'),
+            ('room', 'sequence'),
+        ]
+
     def __iter__(self):
         # Most of the time, just send down a rough dictionary representation
         # of the object.
+        # Note: `room_id` rather than `room.id`, which could cost us a query.
+        # The `id` and `created` keys are what clients send back to us
+        #   (see `EventManager.history`) to ask for older events. If the
+        #   event was published before it was saved, `id` is None, and
+        #   `created` has to do on its own.
         answer = {
-            'room': self.room.id,
+            'id': self.id,
+            'created': self.created.isoformat(),
+            'seq': self.sequence,
+            'room': self.room_id,
             'type': self.event_type,
             'user': self.user_name,
             'message': self.message,
@@ -61,7 +389,7 @@ class Event(models.Model):
         # message, as well as an extra `topic` key with just the new topic.
         if self.event_type == 'topic_set':
             answer['topic'] = self.message
-            answer['message'] = '{user} set the topic to "{topic}".'.format(
+            answer['message'] = wire.TOPIC_MESSAGE.format(
                 topic=self.message,
                 user=self.user_name,
             )
@@ -69,8 +397,8 @@ class Event(models.Model):
         # Okay, done.
         return answer.iteritems()
 
-    def save(self, *args, **kwargs):
-        """Save the event, and publish the event in Redis."""
+    def prepare(self):
+        """Fill in everything the event needs before it can be published."""
 
         # If this is a user_joined or user_left event,
         # set a consistent message.
@@ -79,17 +407,206 @@ class Event(models.Model):
         if self.event_type == 'user_left':
             self.message = '%s has left the room.' % self.user_name
 
+        # Number the event, and give it its key.
+        if self.sequence is None:
+            self.sequence = self.room.next_sequence()
+        if self.uuid is None:
+            self.uuid = uuid4().hex
+
+        # If we're publishing before saving (see `EventManager.record`),
+        #   `modified` hasn't been set yet; set it ourselves.
+        if self.modified is None:
+            self.modified = self.created
+
+    def save(self, *args, **kwargs):
+        """Save the event, and publish the event to the room."""
+
         # Perform a standard save.
-        return_value = super(Event, self).save(*args, **kwargs)
-
-        # Create a Redis object.
-        redis = Redis(
-            host=settings.REDIS_HOST,
-            port=int(settings.REDIS_PORT),
-            db=int(settings.REDIS_DB),
-            password=settings.REDIS_PASSWORD,
+        self.prepare()
+        new = self.id is None
+        with _save_time.time():
+            return_value = offload.run(super(Event, self).save,
+                                       *args, **kwargs)
+
+        # Publish the event to the room.
+        self.publish()
+
+        # Add it to the search index. Events don't change once they have
+        #   happened, so this is only ever needed the first time.
+        # The postings are written in the background, by the writer (see
+        #   `chat/writer.py`), so saving a statement costs no more queries
+        #   than it ever did, and the sender doesn't wait for the index.
+        if new:
+            writer = get_writer()
+            for posting in SearchTerm.objects.postings([self]):
+                writer.put(posting)
+        return return_value
+
+    def serialize(self):
+        """Return the JSON representation of the event.
+
+        This is what gets published to Redis, cached in the room's backlog
+        and, eventually, sent down to the browser. Events don't change once
+        they have happened, so we only ever build it once.
+
+        If `CHAT_WIRE_FORMAT` is "compact", this is the compact encoding
+        (see `chat/wire.py`) instead of the full dictionary.
+        """
+
+        if self._payload is None:
+            if settings.CHAT_WIRE_FORMAT == 'compact':
+                self._payload = json.dumps(self.pack(), separators=(',', ':'))
+            else:
+                self._payload = json.dumps(dict(self))
+        return self._payload
+
+    def pack(self):
+        """Return the compact encoding of the event (see `chat/wire.py`)."""
+
+        return wire.pack(self.id, self.sequence, self.room_id,
+                         self.event_type, self.user_name, self.message,
+                         self.created)
+
+    def publish(self):
+        """Publish the event to the room, through the broker."""
+
+        # If this is the sort of event that goes in the backlog, the broker
+        #   adds it to the room's backlog cache at the same time (in the same
+        #   round trip, for Redis). It only does so if the backlog is already
+        #   cached; a missing backlog means "not cached", and
+        #   `Room.get_backlog` will fill it from the database when it is
+        #   next needed.
+        backlog_key = None
+        if self.event_type in self.BACKLOG_TYPES:
+            backlog_key = self.room.backlog_key
+        with _publish_time.time():
+            get_broker().publish(self.room.redis_key, self.serialize(),
+                backlog_key=backlog_key,
+                backlog_size=int(settings.CHAT_BACKLOG_SIZE),
+            )
+
+
+class SearchTermManager(models.Manager):
+    def index(self, events):
+        """Add events (statements and topic changes; nothing else is worth
+        searching) to the search index, and return how many entries that
+        took.
+
+        The events have to have been saved, and have their IDs; any that
+        don't are skipped. (Events written by the write-behind writer come
+        out of `bulk_create` without them; see `EventManager.bulk_created`.)
+        """
+
+        postings = self.postings(events)
+        self.bulk_create(postings)
+        return len(postings)
+
+    def postings(self, events):
+        """Return the (unsaved) index entries for events (statements and
+        topic changes) that have been saved.
+
+        This is all done in memory; nothing is read from, or written to,
+        the database.
+        """
+
+        postings = []
+        for ev in events:
+            if ev.id is None or ev.event_type not in Event.BACKLOG_TYPES:
+                continue
+            for term in tokenize(ev.message):
+                postings.append(self.model(
+                    term=term,
+                    event_id=ev.id,
+                    room_id=ev.room_id,
+                    user_name=ev.user_name,
+                    created=ev.created,
+                ))
+        return postings
+
+    def search(self, query, room=None, user_name=None, before_id=None,
+               before_timestamp=None, limit=None):
+        """Return a page of the events (statements and topic changes) that
+        contain every word in `query`, newest first, along with the cursor
+        for the page before it, just as `EventManager.history` does.
+
+        `room` (a slug) and `user_name` narrow the search to one room, or
+        to what one user said. Raises `ValueError` if there's nothing in
+        `query` to search for, or if the cursor doesn't make sense.
+
+        We walk down the postings for one of the query's terms, newest
+        first, along one of the indexes below, and check each against the
+        others with a primary key lookup (`EXISTS`), until we have a page's
+        worth. For a one-word search, that's a single index range scan, and
+        it reads no more rows than it returns, however many events there
+        are. We start from the longest term, on the grounds that it is
+        probably the rarest; the fewer postings we walk, the better.
+        """
+
+        terms = tokenize(query)
+        if not terms:
+            raise ValueError('Nothing to search for.')
+        before_id, before_timestamp, limit = Event.objects.parse_page(
+            before_id, before_timestamp, limit,
         )
 
-        # Publish the event in Redis.
-        redis.publish(self.room.redis_key, json.dumps(dict(self)))
-        return return_value
\ No newline at end of file
+        terms.sort(key=len, reverse=True)
+        postings = self.filter(term=terms[0])
+        if room:
+            postings = postings.filter(room=room)
+        if user_name:
+            postings = postings.filter(user_name=user_name)
+        if before_timestamp:
+            older = models.Q(created__lt=before_timestamp)
+            if before_id:
+                older |= models.Q(created=before_timestamp,
+                                  event__lt=before_id)
+            postings = postings.filter(older)
+
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        for term in terms[1:]:
+            postings = postings.extra(where=[' '.join((
+                'EXISTS (SELECT 1 FROM %s other' % table,
+                'WHERE other.event_id = %s.event_id' % table,
+                'AND other.term = %s)',
+            ))], params=[term])
+
+        # Ask for one more than we need, so we know if there's another page.
+        with _search_time.time():
+            postings = offload.run(list, postings.select_related(
+                'event',
+            ).order_by('-created', '-event__id')[0:limit + 1])
+        return Event.objects.paginate([p.event for p in postings], limit)
+
+
+class SearchTerm(models.Model):
+    """One entry in the search index: a term (see `chat/search.py`), and
+    one event that it appears in.
+
+    This is an inverted index in an ordinary table, so it works the same
+    on every database Django does. The event's room, user and timestamp are
+    copied in, so that searching within a room (or by a user), and paging
+    back through the results, are all answered by the index alone.
+    Entries are added as events are saved (see `Event.save` and
+    `EventManager.bulk_created`), and go when their events do.
+    """
+
+    term = models.CharField(max_length=40)
+    event = models.ForeignKey(Event)
+    room = models.ForeignKey(Room)
+    user_name = models.CharField(max_length=30)
+    created = models.DateTimeField()
+
+    objects = SearchTermManager()
+
+    class Meta:
+        # The first three are the ones `SearchTermManager.search` walks
+        #   down: for everything, within a room, and by a user.
+        # The unique index is how it checks for the other terms.
+        index_together = [
+            ('term', 'created'),
+            ('term', 'room', 'created'),
+            ('term', 'user_name', 'created'),
+        ]
+        unique_together = [
+            ('event', 'term'),
+        ]
@@ -1,47 +1,194 @@
 from __future__ import unicode_literals
 from django.conf import settings
-from pycon2013_socketio.chat.models import Room, Event
-from redis import Redis
+from pycon2013_socketio.chat.models import Room, Event, SearchTerm
+from pycon2013_socketio.chat import metrics, signals, wire
+from pycon2013_socketio.chat.brokers import get_broker
+from pycon2013_socketio.chat.presence import get_presence
+from pycon2013_socketio.chat.ratelimit import TokenBucket, get_limiter
+from pycon2013_socketio.chat.signals import Coalescer
+from collections import deque
+from gevent.pool import Group
 from socketio.namespace import BaseNamespace
-import json
+import gevent
+import logging
 import random
 import signal
+import time
+
+
+# Departures that are waiting out their grace period before they are
+#   announced; see `ChatNamespace.recv_disconnect`.
+pending_leaves = Group()
+
+# Every chat connection in the process.
+connections = set()
+metrics.gauge('chat_connections', lambda: len(connections))
+
+# How far behind the browsers are: the number of packets waiting in each
+#   socket's queue, seen every time a room event is delivered, and right now
+#   at the worst (and all together).
+_queue_depth = metrics.histogram('chat_outbound_queue_depth',
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+metrics.gauge('chat_outbound_queue_depth_max', lambda: max([
+    conn.socket.client_queue.qsize() for conn in list(connections)
+] or [0]))
+metrics.gauge('chat_outbound_queue_depth_total', lambda: sum([
+    conn.socket.client_queue.qsize() for conn in list(connections)
+]))
+# Ephemeral signals dropped on their way to browsers that are falling
+#   behind; see `ChatNamespace.deliver`.
+_dropped_signals = metrics.counter('chat_signals_dropped_total')
+# Room events thrown away, and how often each slow consumer policy has had
+#   to kick in; see `ChatNamespace._hold`.
+_dropped_events = metrics.counter('chat_dropped_events_total')
+_slow_consumers = dict([
+    (policy, metrics.counter('chat_slow_consumer_total', policy=policy))
+    for policy in ('drop_oldest', 'collapse', 'disconnect')
+])
+metrics.gauge('chat_outbound_held', lambda: sum([
+    len(conn._held) for conn in list(connections)
+]))
 
 
 class ChatNamespace(BaseNamespace):
     def initialize(self):
-        # Initialize a Redis PubSub object.
-        self.redis_pubsub = Redis(
-            host=settings.REDIS_HOST,
-            port=int(settings.REDIS_PORT),
-            db=int(settings.REDIS_DB),
-            password=settings.REDIS_PASSWORD,
-        ).pubsub()
-
         # Just in case, create a default user name.
         self.user_name = 'user_'
         for i in range(0, 8):
             self.user_name += random.choice('0123456789abcdef')
 
-        # Keep a list of all of the rooms of which I am a member.
-        # This is important because of how Redis' subscription mechanism works;
-        #   subscribing is a one-shot deal. If you subscribe to "foo", and then
-        #   later subscribe to "bar", the list of channels to which you are
-        #   subscribed is: `["bar"]`, not `["foo", "bar"]`
-        # We could set up our chat JavaScript API to track this, and likely
-        #   that would be better application design. However, that would cover
-        #   over this gotcha instead of making it plain, so I'm tracking it
-        #   here instead.
-        self._subscribed_rooms = []
+        # Keep a set of the slugs of all of the rooms of which I am a member.
+        # We don't talk to Redis directly; there is a single broker
+        #   for the whole process (see `chat/brokers.py`) which hands us
+        #   the events for our rooms. We still need to know which rooms we
+        #   are in, though, so we only subscribe once per room, and so we can
+        #   announce our departure from each of them if the connection
+        #   goes away.
+        self._rooms = set()
+
+        # Room events on their way down to the browser.
+        # If batching is on (`CHAT_EMIT_BATCH_WINDOW`), events are held here
+        #   for a short while, and then sent down together in one packet.
+        self._outbox = []
+        self._flusher = None
+        self._batch_window = settings.CHAT_EMIT_BATCH_WINDOW / 1000.0
+        self._batch_size = int(settings.CHAT_EMIT_BATCH_SIZE)
+
+        # Room events go down as JSON dictionaries, unless the browser asks
+        #   for the compact encoding instead; see `on_encoding`.
+        self._compact = False
+
+        # Room events that we are holding back from a browser that isn't
+        #   keeping up, and counts (per room) of those we gave up on; see
+        #   `deliver` and `_hold`.
+        self._held = deque()
+        self._missed = {}
+        self._releaser = None
+        self._outbound_limit = int(settings.CHAT_OUTBOUND_LIMIT)
+        self._kicked = False
+
+        # This connection's own token buckets, one per rate-limited event;
+        #   see `_allow`.
+        self._buckets = {}
+
+        # Ephemeral signals waiting out their coalescing window, one
+        #   `Coalescer` per signal type and room; see `on_signal`.
+        self._coalescers = {}
+
+        connections.add(self)
+        metrics.start_logger()
+        metrics.start_hub_probe()
+
+    def process_event(self, packet):
+        """Dispatch an event from the browser to its `on_` method, and
+        record how long that took (see `chat/metrics.py`)."""
+
+        # Only events that we actually handle get their own histogram;
+        #   otherwise, anyone could make us create as many as they liked.
+        name = packet['name']
+        if not hasattr(self, 'on_%s' % name):
+            name = 'unknown'
+
+        # Flood protection: refuse the event outright if it's coming in
+        #   faster than its limit (see `CHAT_RATE_LIMITS`).
+        # A join that carries the last event seen in the room is a browser
+        #   coming back after its connection dropped, and rejoining every
+        #   room it was in, all at once; those are counted separately, with
+        #   a burst big enough for that.
+        limit_name = name
+        if name == 'join' and len(packet.get('args', ())) > 1:
+            limit_name = 'rejoin'
+        limit = settings.CHAT_RATE_LIMITS.get(limit_name)
+        if limit is not None and not self._allow(limit_name, *limit):
+            _rate_limited[limit_name].inc()
+            self.emit('error', {
+                'event': name,
+                'reason': 'Too many %s events; slow down.' % name,
+            })
+            return
+
+        start = time.time()
+        try:
+            return super(ChatNamespace, self).process_event(packet)
+        finally:
+            _handler_seconds[name].observe(time.time() - start)
+
+    def _allow(self, name, rate, burst):
+        """Return whether this connection may send a `name` event right now
+        (at up to `rate` per second, in bursts of up to `burst`), taking a
+        token from its buckets if so.
+
+        There are two buckets: this connection's own, and its client's
+        (shared by all of the connections from the same address, through
+        the process-wide limiter). The connection's is checked first; it's
+        the cheap one.
+
+        The shared bucket goes by address, not by user name, since anyone
+        can call themselves whatever they like: keyed on the name, a client
+        could dodge its limit by changing name, or use up somebody else's
+        by taking theirs.
+        """
+
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self._buckets[name] = TokenBucket(rate, burst)
+        if not bucket.take():
+            return False
+        client = self.environ.get('REMOTE_ADDR') or self.socket.sessid
+        return get_limiter().allow('%s:%s' % (name, client), rate, burst)
 
     def on_nick(self, user_name):
         """Set this connection's username."""
 
+        # If we're already in some rooms, we're listed there under our old
+        #   name; move ourselves over to the new one.
+        presence = get_presence()
+        for room_slug in self._rooms:
+            presence.leave(room_slug, self.socket.sessid, self.user_name)
+            presence.join(room_slug, self.socket.sessid, user_name)
+
         self.user_name = user_name
         self.emit('nick_set', {
             'reason': 'Username set successfully.',    
         })
 
+    def on_encoding(self, encoding):
+        """Choose how room events are sent down to this connection:
+        "json" (the default) or "compact" (see `chat/wire.py`)."""
+
+        if encoding not in wire.FORMATS:
+            self.emit('error', {
+                'reason': 'Unknown encoding %s.' % encoding,
+            })
+            return
+
+        self._compact = encoding == 'compact'
+        self.emit('encoding_set', {
+            'encoding': encoding,
+            'reason': 'Encoding set successfully.',
+        })
+
     def on_statement(self, room_slug, text):
         """Add the given statement to the chat room."""
 
@@ -52,7 +199,7 @@ class ChatNamespace(BaseNamespace):
 
         # Get the room.
         try:
-            room = Room.objects.get(id=room_slug)
+            room = Room.objects.get_cached(room_slug)
         except Room.DoesNotExist:
             self.emit('error', {
                 'reason': 'Room %s does not exist.' % room_slug,
@@ -60,7 +207,7 @@ class ChatNamespace(BaseNamespace):
             return
 
         # Create a new message object.
-        Event.objects.create(
+        Event.objects.record(
             message=text,
             event_type='statement',
             room=room,
@@ -72,66 +219,91 @@ class ChatNamespace(BaseNamespace):
             'reason': 'Message posted successfully.',    
         })
 
-    def on_join(self, room_slug):
+    def on_join(self, room_slug, last_seen=None):
         """Connect to the given chat room.
 
         This involves subscribing this connection to receive all new chats in
         this particular room.
+
+        A client that is rejoining after its connection dropped can send the
+        sequence number (`seq`) of the last event it saw in the room, and
+        it will be sent only what it missed, rather than the whole backlog.
         """
 
         # First, retreive the chat room.
         # We're not being particularly interested in security, as this is
         #   only an example, so we're going to be extremely permissive about
         #   room existence and permissions.
-        room, new = Room.objects.get_or_create(id=room_slug)
-
-        # Stop the previous listener. We'll be spawning a new one
-        #   once we subscribe to the new room.
-        # Note: This has to come *before* we call subscribe, or strange
-        #   things happen. General rule about `redis_pubsub.subscribe` and
-        #   `redis_pubsub.listen` -- if you're listening, don't do anything
-        #   else. If you need to change subscriptions, stop listening, change,
-        #   and start listening again.
-        if hasattr(self, '_greenlet'):
-            self._greenlet.kill()
-
-        # Now we "subscribe" to the room in Redis; this means that as
-        #   notifications go through that Redis key, we'll hear about them
-        #   (because `redis.listen()` is being run in our `self._listen`
-        #   thread).
-        # Note the comment above about subscription tracking -- we need to
-        #   subscribe to *every* room in Redis that we're watching.
-        if room.redis_key not in self._subscribed_rooms:
-            self._subscribed_rooms.append(room.redis_key)
-        self.redis_pubsub.subscribe(self._subscribed_rooms)
-
-        # Now spawn a listener thread.
-        # This is what will actually monitor Redis and send things down
-        #   to the browser when Redis publishes.
+        # Rooms are cached in-process, so usually this costs us nothing.
+        room = Room.objects.get_or_create_cached(room_slug)
+
+        # Now we "subscribe" to the room; this means that as notifications
+        #   go through that room's key, we'll hear about them.
+        # The process-wide broker is what actually monitors Redis (or
+        #   whatever carries events, see `CHAT_BROKER`); it calls our
+        #   `deliver` method for every event in the room, which
+        #   sends it down to the browser.
         # In other words, this is what actually solves the "last mile
         #   problem".
-        self._greenlet = self.spawn(self._listen)
-
-        # Retrieve the previous events for this room.
-        backlog = [dict(ev) for ev in Event.objects.filter(
-            event_type__in=('statement', 'topic_set'),
-            room=room,
-        ).order_by('-created')[0:50]]
-        backlog.reverse()  # I hate that `list.reverse` reverses in-place.
+        # Joining is incremental: we only ever subscribe to the one room
+        #   being joined, and only if we aren't in it already.
+        # We also put ourselves on the room's list of members. Before we do,
+        #   look to see whether this user is on it already (see below).
+        presence = get_presence()
+        present = self.user_name in presence.members(room.id)
+        if room.id not in self._rooms:
+            self._rooms.add(room.id)
+            get_broker().subscribe(room.redis_key, self)
+            presence.join(room.id, self.socket.sessid, self.user_name)
+
+        # Retrieve the previous events for this room (or, if we're
+        #   rejoining, just the ones we missed).
+        # These usually come out of the broker's backlog cache rather than
+        #   the database; see `Room.get_backlog`.
+        try:
+            last_seen = int(last_seen) if last_seen is not None else None
+        except ValueError:
+            last_seen = None
+        if last_seen is None:
+            backlog, complete = room.get_backlog(), True
+        else:
+            backlog, complete = room.get_events_since(last_seen)
+
+        # If this user dropped out of the room only a moment ago, nobody has
+        #   been told that they left yet (see `recv_disconnect`). Call that
+        #   off, and don't tell anybody that they're back, either.
+        # Often, though, we haven't even noticed that they dropped out: a
+        #   polling client's old connection isn't given up on until its
+        #   heartbeat times out, long after the browser has reconnected. It
+        #   is still on the room's list of members, so this user never left,
+        #   as far as anybody else knows; when it does go, it won't say so
+        #   either (see `_leave_later`), since we're still here.
+        returning = present
+        if settings.CHAT_PRESENCE_GRACE:
+            returning = get_broker().pop_marker(
+                room.leaving_key(self.user_name),
+            ) or returning
 
         # Create an event saying that we have joined the chat room.
         # N.B. This means that we will immediately receive this message,
         #   since we subscribed above.
-        Event.objects.create(
-            event_type='user_joined',
-            room=room,
-            user_name=self.user_name,
-        )
+        if not returning:
+            Event.objects.record(
+                event_type='user_joined',
+                room=room,
+                user_name=self.user_name,
+            )
 
         # Now send down a private success message.
+        # If the client asked only for what it missed, `complete` says
+        #   whether that's what it got; if it missed more than the backlog
+        #   holds, it can get the rest with `history`.
         self.emit('room_joined', {
-            'backlog': backlog,
+            'backlog': [self._encode(event) for event in backlog],
+            'complete': complete,
             'reason': 'Joined room %s.' % room.id,
+            'members': get_presence().count(room.id),
+            'resumed': last_seen is not None,
             'room': dict(room),
         })
 
@@ -142,7 +314,7 @@ class ChatNamespace(BaseNamespace):
         # We assume at this point that the room exists, and fail out if
         #   it does not.
         try:
-            room = Room.objects.get(id=room_slug)
+            room = Room.objects.get_cached(room_slug)
         except Room.DoesNotExist:
             self.emit('error', {
                 'reason': 'Room %s does not exist.' % room_slug,
@@ -157,7 +329,7 @@ class ChatNamespace(BaseNamespace):
         room.save()
 
         # ...and now we send an event announcing the new topic.
-        Event.objects.create(
+        Event.objects.record(
             event_type='topic_set',
             message=text,
             room=room,
@@ -170,6 +342,137 @@ class ChatNamespace(BaseNamespace):
             'room': dict(room),    
         })
 
+    def on_history(self, room_slug, before_id=None, before_timestamp=None,
+                   limit=None):
+        """Send down a page of older events from the given room.
+
+        The browser passes the `id` and/or `created` timestamp of the oldest
+        event it has (or nothing at all, to start from the most recent), and
+        gets back up to `limit` events from before that, oldest first, along
+        with the cursor to pass in order to get the page before those.
+        """
+
+        try:
+            room = Room.objects.get_cached(room_slug)
+        except Room.DoesNotExist:
+            self.emit('error', {
+                'reason': 'Room %s does not exist.' % room_slug,
+            })
+            return
+
+        try:
+            events, cursor = Event.objects.history(room,
+                before_id=before_id,
+                before_timestamp=before_timestamp,
+                limit=limit,
+            )
+        except ValueError:
+            self.emit('error', {
+                'reason': 'Invalid history cursor.',
+            })
+            return
+
+        self.emit('history', {
+            'cursor': cursor,
+            'events': [
+                event.pack() if self._compact else dict(event)
+                for event in reversed(events)
+            ],
+            'room': room.id,
+        })
+
+    def on_search(self, query, room_slug=None, user_name=None,
+                  before_id=None, before_timestamp=None, limit=None):
+        """Send down a page of the statements and topic changes that contain
+        every word of `query`, newest first, optionally just those in one
+        room, or by one user (see `SearchTermManager.search`).
+
+        Paging works just as it does for `history`: pass back the cursor
+        that came with one page to get the next.
+        """
+
+        try:
+            events, cursor = SearchTerm.objects.search(query,
+                room=room_slug,
+                user_name=user_name,
+                before_id=before_id,
+                before_timestamp=before_timestamp,
+                limit=limit,
+            )
+        except ValueError as ex:
+            self.emit('error', {
+                'reason': 'Invalid search: %s' % ex,
+            })
+            return
+
+        self.emit('search', {
+            'cursor': cursor,
+            'events': [
+                event.pack() if self._compact else dict(event)
+                for event in events
+            ],
+            'query': query,
+            'room': room_slug,
+            'user': user_name,
+        })
+
+    def on_signal(self, room_slug, signal_type, value=None):
+        """Pass an ephemeral signal on to everyone else in a room we are
+        in: that we are typing (`typing`, with `true`, or `false` once we
+        stop), or that we have read up to a point (`read`, with the `seq`
+        of the last event we saw).
+
+        Signals are not events. They go straight to the room's channel
+        (see `chat/signals.py`) and are never saved, so they cost the
+        database nothing. Repeats within the signal type's coalescing
+        window are collapsed into one (see `Coalescer`), and each type has
+        a rate limit of its own, past which signals are quietly dropped;
+        see `CHAT_SIGNALS`. Nothing is sent back.
+        """
+
+        if signal_type not in settings.CHAT_SIGNALS:
+            self.emit('error', {
+                'reason': 'Unknown signal %s.' % signal_type,
+            })
+            return
+        if not isinstance(value, (bool, int, long, float, type(None))):
+            self.emit('error', {
+                'reason': 'Invalid value for signal %s.' % signal_type,
+            })
+            return
+        if room_slug not in self._rooms:
+            return
+
+        key = (signal_type, room_slug)
+        coalescer = self._coalescers.get(key)
+        if coalescer is None:
+            coalescer = self._coalescers[key] = Coalescer(
+                settings.CHAT_SIGNALS[signal_type][0],
+                lambda value: self._send_signal(signal_type, room_slug,
+                                                value),
+            )
+        coalescer.put(value)
+
+    def _send_signal(self, signal_type, room_slug, value):
+        """Publish a signal that has made it through its coalescer, if it
+        is within its rate limit."""
+
+        window, rate, burst = settings.CHAT_SIGNALS[signal_type]
+        name = 'signal:%s' % signal_type
+        if not self._allow(name, rate, burst):
+            _rate_limited[name].inc()
+            return
+        if room_slug in self._rooms:
+            signals.publish(room_slug, signal_type, self.user_name, value)
+
+    def _cancel_signals(self, room_slug=None):
+        """Forget the signals we are holding back, for one room or for
+        all of them."""
+
+        for key in list(self._coalescers):
+            if room_slug is None or key[1] == room_slug:
+                self._coalescers.pop(key).cancel()
+
     def on_leave(self, room_slug, announce_only=False):
         """Unsubscribe from a given chat room."""
 
@@ -178,29 +481,23 @@ class ChatNamespace(BaseNamespace):
         #   we are already subscribed, so if the room does not already
         #   exist, we error out.
         try:
-            room = Room.objects.get(id=room_slug)
+            room = Room.objects.get_cached(room_slug)
         except Room.DoesNotExist:
             self.emit('error', {
                 'reason': 'Room %s does not exist.' % room_slug,
             })
             return
 
-        # Okay, now create an event saying that this user
-        # has left the room.
-        Event.objects.create(
-            event_type='user_left',
-            room=room,
-            user_name=self.user_name,
-        )
-
         if not announce_only:
-            # Remove the room from subscribed rooms.
-            if room.redis_key in self._subscribed_rooms:
-                ix = self._subscribed_rooms.index(room.redis_key)
-                self._subscribed_rooms.pop(ix)
-
-            # And now actually unsubscribe from the room.
-            self.redis_pubsub.subscribe(self._subscribed_rooms)
+            # Remove the room from subscribed rooms, take ourselves off of
+            #   its list of members, and actually unsubscribe from it (and
+            #   only it).
+            if room.id in self._rooms:
+                self._rooms.discard(room.id)
+                self._cancel_signals(room.id)
+                get_broker().unsubscribe(room.redis_key, self)
+                get_presence().leave(room.id, self.socket.sessid,
+                                     self.user_name)
 
             # Send back a private success notification.
             self.emit('room_left', {
@@ -208,6 +505,32 @@ class ChatNamespace(BaseNamespace):
                 'room': dict(room),
             })
 
+        # Okay, now create an event saying that this user
+        # has left the room -- unless they're still in it, on another
+        # connection (another tab, or the connection that replaced this
+        # one; see `on_join`), in which case, as far as anybody else is
+        # concerned, they haven't.
+        if self.user_name not in get_presence().members(room.id):
+            Event.objects.record(
+                event_type='user_left',
+                room=room,
+                user_name=self.user_name,
+            )
+
+    def on_who(self, room_slug):
+        """Send down the names of the users in the given room.
+
+        This comes out of the presence store (see `chat/presence.py`), not
+        the database, so it's cheap to ask as often as you like.
+        """
+
+        users = get_presence().members(room_slug)
+        self.emit('who', {
+            'count': len(users),
+            'room': room_slug,
+            'users': users,
+        })
+
     def on_ping(self, *args):
         """A test method. Upon receiving this, it will send the same arguments
         back as a list."""
@@ -223,27 +546,248 @@ class ChatNamespace(BaseNamespace):
         #   but there's no need to actually perform the disconnection because
         #   the connection has gone (or is going) away.
         # Therefore, just send the announcement.
-        for redis_key in self._subscribed_rooms:
-            room_slug = redis_key[5:]
+        # Note that gevent-socketio may call this more than once for the same
+        #   connection; emptying our room set means we only announce once.
+        # Connections drop and come straight back all the time, though, so
+        #   unless the grace period is turned off, the announcement waits;
+        #   if the user rejoins in the meantime, it never happens.
+        # We stay on each room's list of members until the announcement
+        #   is made.
+        rooms, self._rooms = self._rooms, set()
+        for room_slug in rooms:
+            if settings.CHAT_PRESENCE_GRACE:
+                self._leave_later(room_slug, settings.CHAT_PRESENCE_GRACE)
+            else:
+                get_presence().leave(room_slug, self.socket.sessid,
+                                     self.user_name)
+                self.on_leave(room_slug, announce_only=True)
+
+        # We're gone, so stop routing room events to this connection.
+        get_broker().unsubscribe_all(self)
+        connections.discard(self)
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+        if self._releaser is not None:
+            self._releaser.kill(block=False)
+        self._cancel_signals()
+        self._held.clear()
+        self._missed = {}
+
+    def _leave_later(self, room_slug, grace):
+        """Announce that we have left the given room in `grace` seconds,
+        unless we rejoin it before then (from this connection or any other,
+        in any process)."""
+
+        try:
+            room = Room.objects.get_cached(room_slug)
+        except Room.DoesNotExist:
+            return
+
+        # The marker tells `on_join` (in any process) that this user's
+        #   departure hasn't been announced yet, even if our entry on the
+        #   room's list of members is gone (if this process dies before the
+        #   grace period is up, say). It outlives the grace period a little,
+        #   so that it's certain to still be there until we take it down.
+        key = room.leaving_key(self.user_name)
+        get_broker().set_marker(key, grace * 2 + 1)
+
+        # The connection is gone from the room once the grace period is up,
+        #   and the user with it, unless they came back; if they did, it was
+        #   on a new connection, which has its own entry (so `on_leave` won't
+        #   announce anything).
+        def leave():
+            get_broker().pop_marker(key)
+            get_presence().leave(room_slug, self.socket.sessid,
+                                 self.user_name)
             self.on_leave(room_slug, announce_only=True)
 
+        # This can't be one of our own jobs (`self.spawn`), since those are
+        #   all killed when the socket goes away.
+        pending_leaves.add(gevent.spawn_later(grace, leave))
+
     def _despawn_all(self, *args):
         self.kill_local_jobs()
 
-    def _listen(self):
-        for block in self.redis_pubsub.listen():
-            # Sanity Check: Is this a real block?
-            if not block or 'data' not in block or not isinstance(
-              block['data'], (str, unicode),
-            ):
+    def deliver(self, data):
+        """Send a room event (already decoded, as a `WireEvent`) down to
+        the browser.
+
+        This is called by the process-wide broker for every event
+        published to a room that we are in.
+        """
+
+        # Ephemeral signals (see `on_signal`) go straight down, unbatched,
+        #   to everyone but whoever sent them. If the browser is falling
+        #   behind, they are dropped instead; they would be stale by the
+        #   time it caught up, and there is nothing to catch up on later.
+        if data.ephemeral:
+            if data.as_dict()['user'] == self.user_name:
+                return
+            if self._held or \
+                    self.socket.client_queue.qsize() >= self._outbound_limit:
+                _dropped_signals.inc()
+                return
+            self.emit('signal', data.as_dict())
+            return
+
+        # If the browser isn't keeping up -- there are already plenty of
+        #   packets waiting to go down to it -- don't add to the pile; hold
+        #   on to the event ourselves until it catches up. Once we're
+        #   holding anything, everything after it waits its turn too.
+        depth = self.socket.client_queue.qsize()
+        _queue_depth.observe(depth)
+        if self._held or depth >= self._outbound_limit:
+            self._hold(data)
+            return
+
+        # If we aren't batching, just send it right away.
+        if not self._batch_window:
+            self._emit_room_event(data)
+            return
+
+        # Otherwise, hold on to it. If the batch is full, send it now;
+        #   otherwise make sure it goes out at the end of the window.
+        self._outbox.append(data)
+        if len(self._outbox) >= self._batch_size:
+            self.flush()
+        elif self._flusher is None:
+            self._flusher = gevent.spawn_later(self._batch_window, self.flush)
+
+    def flush(self):
+        """Send any batched room events down to the browser.
+
+        A batch of several events goes down as a single `room_events` event,
+        whose argument is the list of events; the browser unpacks it and
+        handles each one as though it had arrived on its own.
+        """
+
+        outbox, self._outbox = self._outbox, []
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None and flusher is not gevent.getcurrent():
+            flusher.kill(block=False)
+
+        if len(outbox) == 1:
+            self._emit_room_event(outbox[0])
+        elif outbox:
+            self.emit('room_events', [self._encode(data) for data in outbox])
+
+    def _hold(self, data):
+        """Hold on to a room event for a browser that is falling behind,
+        and make sure it is sent once the browser catches up.
+
+        We hold at most `CHAT_OUTBOUND_LIMIT` events; past that,
+        `CHAT_SLOW_CONSUMER_POLICY` decides what to give up on.
+        """
+
+        # Anything already batched is older than this, so it goes first.
+        if self._outbox:
+            self.flush()
+
+        if len(self._held) >= self._outbound_limit:
+            policy = settings.CHAT_SLOW_CONSUMER_POLICY
+            # (Anything we don't recognize is treated as drop_oldest; see
+            #   below.)
+            _slow_consumers.get(policy, _slow_consumers['drop_oldest']).inc()
+
+            # Drop this browser altogether. The actual disconnecting happens
+            #   in its own greenlet, since we're in the middle of the
+            #   broker's fan-out.
+            if policy == 'disconnect':
+                if not self._kicked:
+                    self._kicked = True
+                    gevent.spawn(self._kick)
+                return
+
+            # Throw away everything we're holding, but remember how much of
+            #   it there was, so that we can say so.
+            if policy == 'collapse':
+                dropped, self._held = self._held, deque()
+
+            # Throw away just the oldest event.
+            else:
+                dropped = [self._held.popleft()]
+
+            for held in dropped:
+                self._missed[held.room] = self._missed.get(held.room, 0) + 1
+            _dropped_events.inc(len(dropped))
+
+        self._held.append(data)
+        if self._releaser is None:
+            self._releaser = gevent.spawn(self._release)
+
+    def _release(self):
+        """Wait for the browser to catch up, and then send down whatever
+        we held back from it.
+
+        The browser has caught up once its queue is down to half the limit;
+        waiting for it to empty out entirely would just mean sending it
+        another flood all at once.
+        """
+
+        while self._held or self._missed:
+            if self.socket.client_queue.qsize() >= self._outbound_limit // 2:
+                gevent.sleep(0.1)
                 continue
 
-            # I am going to have a rule here that everything I send will
-            #   be JSON, and their event name will be determined by the
-            #   name of the room to which the event was posted.
-            # From there, I will dispatch my events to the handlers I write
-            #   for them as part of this class.
-            data = json.loads(block['data'])
-            if data and isinstance(data, dict):
-                event_name = '%s_event' % data['room']
-                self.emit(event_name, data)
\ No newline at end of file
+            # Tell the browser what it missed for good (see `_hold`), and
+            #   then send the rest in one packet.
+            missed, self._missed = self._missed, {}
+            held, self._held = list(self._held), deque()
+            for room_slug, count in sorted(missed.items()):
+                self.emit('room_missed', {'missed': count, 'room': room_slug})
+            if held:
+                self.emit('room_events', [self._encode(data) for data in held])
+        self._releaser = None
+
+    def _kick(self):
+        """Disconnect a browser that fell too far behind (see `_hold`)."""
+
+        logging.getLogger('socketio').warning(
+            'Disconnecting %s (%s); it has fallen too far behind.',
+            self.socket.sessid, self.user_name,
+        )
+
+        # Kill the socket outright, rather than just this namespace; there's
+        #   no point queueing a polite goodbye behind everything else it
+        #   hasn't read. Killing it calls `recv_disconnect`, which takes care
+        #   of leaving our rooms.
+        socket = self.socket
+        socket.kill()
+        socket.server.sockets.pop(socket.sessid, None)
+        gevent.killall(socket.jobs, block=False)
+
+    def _emit_room_event(self, data):
+        # I am going to have a rule here that everything I send will
+        #   be JSON, and their event name will be determined by the
+        #   name of the room to which the event was posted.
+        # From there, I will dispatch my events to the handlers I write
+        #   for them as part of this class.
+        event_name = '%s_event' % data.room
+        self.emit(event_name, self._encode(data))
+
+    def _encode(self, data):
+        # Room events come to us as `WireEvent`s, which can give us either
+        #   encoding (see `chat/wire.py`).
+        if self._compact:
+            return data.packed()
+        return data.as_dict()
+
+
+# How long each handler takes, and how often each event is refused for
+#   coming in too fast; see `ChatNamespace.process_event`. These are made
+#   once, here, for every event we handle (plus "unknown", which covers
+#   everything else), so that dispatching an event doesn't have to look
+#   them up by name.
+_handlers = ['unknown'] + [
+    name[len('on_'):] for name in dir(ChatNamespace) if name.startswith('on_')
+]
+_handler_seconds = dict([
+    (name, metrics.histogram('chat_handler_seconds', handler=name))
+    for name in _handlers
+])
+_rate_limited = dict([
+    (name, metrics.counter('chat_rate_limited_total', handler=name))
+    for name in _handlers + ['rejoin'] + [
+        'signal:%s' % signal_type for signal_type in settings.CHAT_SIGNALS
+    ]
+])
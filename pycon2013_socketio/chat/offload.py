@@ -0,0 +1,212 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.db import DatabaseError, connections
+from gevent import monkey
+from pycon2013_socketio.chat import metrics
+import os
+import sys
+import threading
+import time
+
+# Thread pools arrived in gevent 1.0; without one, we just run database
+#   calls inline, as we always have.
+try:
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
+# The real `thread.get_ident`, even if gevent has patched it to tell
+#   greenlets apart instead of threads.
+_get_ident = monkey.get_original('thread', 'get_ident')
+
+
+class DatabasePool(object):
+    """Runs database calls on a small pool of real threads.
+
+    gevent can make Python's own sockets cooperative, but not the ones
+    inside a database driver written in C (the sqlite3 module, MySQLdb, and
+    psycopg2 without psycogreen, for instance). A query on one of those
+    blocks the whole process -- every socket on it -- until it comes back.
+    Run on another thread, it only blocks the greenlet that asked for it;
+    everyone else carries on.
+
+    Each thread keeps its own database connection, and reuses it from one
+    call to the next (see `ThreadConnections`). Whatever a call leaves open
+    is committed when it finishes, so that no thread sits in the middle of
+    a transaction (holding locks, and seeing an ever-older snapshot) while
+    it waits for the next one. If a call fails with a database error, or
+    the commit does, the thread's connections are closed instead, in case
+    that's what the problem was; the next call on that thread opens new
+    ones.
+
+    Only ever hand this pure ORM work. Anything that touches gevent (Redis,
+    the broker, sockets) has to stay on the hub's own thread.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pool = ThreadPool(size)
+        self.pid = os.getpid()
+        self.connections = ThreadConnections.install()
+
+    def run(self, function, *args, **kwargs):
+        """Call `function` on one of the pool's threads, wait (cooperatively)
+        for it to finish, and return what it returned, or raise what it
+        raised."""
+
+        success, result = self.pool.apply(self._call, (function, args, kwargs))
+        if success:
+            return result
+        raise result[0], result[1], result[2]
+
+    def pending(self):
+        """Return the number of calls running or waiting to run."""
+
+        return len(self.pool)
+
+    def on_pool_thread(self):
+        """Return whether we are on one of the pool's threads."""
+
+        return self.connections.owns_thread()
+
+    def _call(self, function, args, kwargs):
+        # Exceptions are handed back rather than raised here, or gevent
+        #   would print a traceback for every `DoesNotExist`.
+        self.connections.claim_thread()
+        try:
+            return True, function(*args, **kwargs)
+        except DatabaseError:
+            self._close()
+            return False, sys.exc_info()
+        except Exception:
+            return False, sys.exc_info()
+        finally:
+            self._commit()
+
+    def _commit(self):
+        # Commit whatever the call left open on this thread's connections
+        #   (reads included; in Django 1.5, those leave a transaction open
+        #   too), unless the call is inside a transaction block of its own.
+        for conn in connections.all():
+            if conn.connection is None or conn.is_managed():
+                continue
+            try:
+                conn.commit_unless_managed()
+            except DatabaseError:
+                conn.close()
+
+    def _close(self):
+        for conn in connections.all():
+            conn.close()
+
+
+class ThreadConnections(object):
+    """Stands in for the object in which Django keeps each thread's
+    database connections (`connections._connections`), so that each of the
+    pool's threads gets connections of its own.
+
+    Django keeps them in a `threading.local`, which gevent's monkey-patching
+    turns into a greenlet-local, meant for greenlets on a single thread; it
+    doesn't keep real threads reliably apart. (gevent 1.0's local points
+    one shared `__dict__` at the current greenlet's values on every access,
+    so a thread that is interrupted halfway through can read another's.
+    Four threads hammering it see the wrong connection a few times in every
+    100,000 lookups.) So for the pool's threads, we keep the connections
+    ourselves, by real thread ID. Everyone else (the hub's own greenlets)
+    carries on using Django's original.
+
+    Django has no public way to do this; `_connections` is how Django 1.5
+    (which is pinned) keeps them, and this has to be looked at again if
+    that changes. Without a pool (`CHAT_DB_THREADS` is 0), it's never
+    installed.
+    """
+
+    def __init__(self, original):
+        self.__dict__['original'] = original
+        self.__dict__['threads'] = {}
+
+    @classmethod
+    def install(cls):
+        """Put a `ThreadConnections` in place (unless there already is
+        one), and return it."""
+
+        if not isinstance(connections._connections, cls):
+            connections._connections = cls(connections._connections)
+        return connections._connections
+
+    def claim_thread(self):
+        """Give the current thread a set of connections of its own (unless
+        it already has them)."""
+
+        self.threads.setdefault(_get_ident(), {})
+
+    def owns_thread(self):
+        return _get_ident() in self.threads
+
+    def __getattr__(self, name):
+        own = self.threads.get(_get_ident())
+        if own is None:
+            return getattr(self.original, name)
+        try:
+            return own[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        own = self.threads.get(_get_ident())
+        if own is None:
+            setattr(self.original, name, value)
+        else:
+            own[name] = value
+
+    def __delattr__(self, name):
+        own = self.threads.get(_get_ident())
+        if own is None:
+            delattr(self.original, name)
+        else:
+            own.pop(name, None)
+
+
+# How long database calls take, waiting for a thread included.
+_run_time = metrics.histogram('chat_db_offload_seconds')
+
+# The pool is created on first use, from the `CHAT_DB_THREADS` setting (under
+#   a lock, for the same reason as the broker). It is created again in a
+#   forked child, since the threads don't come along.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """Return the process-wide database thread pool, or `None` if database
+    calls are to be run inline."""
+
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid != os.getpid():
+            _pool = None
+        size = int(settings.CHAT_DB_THREADS)
+        if _pool is None and size and ThreadPool is not None:
+            _pool = DatabasePool(size)
+    return _pool
+
+
+metrics.gauge('chat_db_offload_pending',
+              lambda: _pool.pending() if _pool else 0)
+
+
+def run(function, *args, **kwargs):
+    """Run a function that talks to the database, on the database thread
+    pool if there is one (see `DatabasePool`), and inline otherwise."""
+
+    # If we're on one of the pool's threads already (`get_or_create` calls
+    #   `save`, for instance), just get on with it; waiting for another
+    #   thread from here could deadlock the pool.
+    if _pool is not None and _pool.on_pool_thread():
+        return function(*args, **kwargs)
+
+    pool = get_db_pool()
+    if pool is None:
+        return function(*args, **kwargs)
+    with _run_time.time():
+        return pool.run(function, *args, **kwargs)
@@ -0,0 +1,180 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.utils.importlib import import_module
+from pycon2013_socketio.chat.connections import get_redis
+from redis.exceptions import ConnectionError
+import gevent
+import logging
+import threading
+import time
+
+
+class BasePresence(object):
+    """Keeps track of who is in each room, without going anywhere near the
+    database.
+
+    Each connection in a room has one entry there, identifying both the
+    connection (by its socket.io session ID) and the user behind it; a user
+    with two tabs open is in the room twice, but listed once by `members`.
+
+    Every process remembers the entries it put in the store (`local`), so
+    that it can keep them alive (see `RedisPresence`), and take them all
+    out again in one go when it shuts down (`clear`).
+
+    Subclasses implement `_add`, `_remove`, `members` and `count`.
+    """
+
+    def __init__(self, heartbeat=10):
+        self.heartbeat = heartbeat
+        self.local = set()
+
+    def join(self, room_slug, sessid, user_name):
+        """Record that a connection (and its user) is in a room."""
+
+        entry = (room_slug, self._member(sessid, user_name))
+        self.local.add(entry)
+        self._add([entry])
+
+    def leave(self, room_slug, sessid, user_name):
+        """Record that a connection (and its user) has left a room."""
+
+        entry = (room_slug, self._member(sessid, user_name))
+        self.local.discard(entry)
+        self._remove([entry])
+
+    def clear(self):
+        """Take every entry this process put in the store out of it."""
+
+        entries, self.local = self.local, set()
+        if entries:
+            self._remove(list(entries))
+
+    def members(self, room_slug):
+        """Return the (distinct, sorted) names of the users in a room."""
+
+        raise NotImplementedError
+
+    def count(self, room_slug):
+        """Return the number of connections in a room."""
+
+        raise NotImplementedError
+
+    def _add(self, entries):
+        raise NotImplementedError
+
+    def _remove(self, entries):
+        raise NotImplementedError
+
+    def _member(self, sessid, user_name):
+        return '%s:%s' % (sessid, user_name)
+
+    def _names(self, members):
+        # Session IDs never have a colon in them; user names might.
+        return sorted(set([member.split(':', 1)[1] for member in members]))
+
+
+class RedisPresence(BasePresence):
+    """Presence, kept in Redis, so that every process sees every room's
+    members.
+
+    Each room is a sorted set, scored by the time at which each entry
+    expires. Every process refreshes its own entries every `heartbeat`
+    seconds, in a single round trip; if a process dies without cleaning up
+    after itself, its entries simply stop being refreshed, and are swept out
+    of each room in bulk (one ZREMRANGEBYSCORE) the next time anyone looks
+    at it.
+    """
+
+    def __init__(self, heartbeat=10):
+        super(RedisPresence, self).__init__(heartbeat=heartbeat)
+        self.ttl = heartbeat * 3
+        self._greenlet = gevent.spawn(self._run)
+
+    def members(self, room_slug):
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.zremrangebyscore(self._key(room_slug), '-inf', time.time())
+        pipe.zrange(self._key(room_slug), 0, -1)
+        return self._names(pipe.execute()[-1])
+
+    def count(self, room_slug):
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.zremrangebyscore(self._key(room_slug), '-inf', time.time())
+        pipe.zcard(self._key(room_slug))
+        return pipe.execute()[-1]
+
+    def _add(self, entries):
+        # N.B. `Redis.zadd` takes the member first, and then the score.
+        expires = time.time() + self.ttl
+        pipe = get_redis().pipeline(transaction=False)
+        for room_slug, member in entries:
+            pipe.zadd(self._key(room_slug), member, expires)
+        pipe.execute()
+
+    def _remove(self, entries):
+        pipe = get_redis().pipeline(transaction=False)
+        for room_slug, member in entries:
+            pipe.zrem(self._key(room_slug), member)
+        pipe.execute()
+
+    def _key(self, room_slug):
+        return 'presence_%s' % room_slug
+
+    def _run(self):
+        """Keep this process's entries alive, for as long as it lives."""
+
+        while True:
+            gevent.sleep(self.heartbeat)
+            if not self.local:
+                continue
+            try:
+                self._add(list(self.local))
+            except ConnectionError:
+                logging.getLogger('socketio').warning(
+                    'Could not refresh presence in Redis.', exc_info=True,
+                )
+
+
+class MemoryPresence(BasePresence):
+    """Presence, kept in this process. Like the memory broker, this only
+    works if the whole site is a single process; but then, the entries this
+    process knows about are all the entries there are."""
+
+    def __init__(self, heartbeat=10):
+        super(MemoryPresence, self).__init__(heartbeat=heartbeat)
+        self.rooms = {}
+
+    def members(self, room_slug):
+        return self._names(self.rooms.get(room_slug, ()))
+
+    def count(self, room_slug):
+        return len(self.rooms.get(room_slug, ()))
+
+    def _add(self, entries):
+        for room_slug, member in entries:
+            self.rooms.setdefault(room_slug, set()).add(member)
+
+    def _remove(self, entries):
+        for room_slug, member in entries:
+            members = self.rooms.get(room_slug, set())
+            members.discard(member)
+            if not members:
+                self.rooms.pop(room_slug, None)
+
+
+# The presence store is created on first use, from the `CHAT_PRESENCE`
+#   setting (under a lock, for the same reason as the broker).
+_presence = None
+_presence_lock = threading.Lock()
+
+
+def get_presence():
+    """Return the process-wide presence store."""
+
+    global _presence
+    with _presence_lock:
+        if _presence is None:
+            module_name, class_name = settings.CHAT_PRESENCE.rsplit('.', 1)
+            _presence = getattr(import_module(module_name), class_name)(
+                heartbeat=float(settings.CHAT_PRESENCE_HEARTBEAT),
+            )
+    return _presence
@@ -0,0 +1,157 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.utils.importlib import import_module
+from pycon2013_socketio.chat.connections import get_redis
+from redis.exceptions import ConnectionError, ResponseError
+import logging
+import threading
+import time
+
+
+class TokenBucket(object):
+    """A token bucket: it holds up to `burst` tokens, and refills at `rate`
+    tokens per second. Each event takes a token; when the bucket is empty,
+    events are refused until it refills.
+
+    The bucket isn't actually refilled in the background; it just works out
+    how much it would have refilled since it was last used, when it's next
+    used. So a bucket costs nothing at all while nobody is using it.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def take(self, now=None):
+        """Take a token, if there is one. Return whether there was."""
+
+        now = now or time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now):
+        """Return whether the bucket would be full by now (in which case
+        it's no different from a brand new one)."""
+
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class BaseLimiter(object):
+    """Keeps a token bucket for each key (usually an event and a user name)
+    and says whether each event is allowed through.
+
+    Subclasses implement `allow`.
+    """
+
+    def allow(self, key, rate, burst):
+        """Take a token from the bucket for `key` (which refills at `rate`
+        tokens per second, up to `burst`), and return whether there was
+        one to take."""
+
+        raise NotImplementedError
+
+
+class MemoryLimiter(BaseLimiter):
+    """Rate limits, kept in this process.
+
+    If the site runs in several processes, a user with connections to more
+    than one of them gets the limit in each; that's usually close enough.
+    """
+
+    # How often (in seconds) we throw away buckets that have refilled.
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self.buckets = {}
+        self._swept = time.time()
+
+    def allow(self, key, rate, burst):
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        allowed = bucket.take(now)
+
+        # A bucket that has refilled is the same as no bucket at all, so
+        #   there's no need to keep it around; every so often, get rid of
+        #   those, so that we aren't keeping one for everybody who has
+        #   ever said anything.
+        if now - self._swept > self.SWEEP_INTERVAL:
+            self._swept = now
+            for stale_key, stale in list(self.buckets.items()):
+                if stale.full(now):
+                    del self.buckets[stale_key]
+        return allowed
+
+
+class RedisLimiter(BaseLimiter):
+    """Rate limits, kept in Redis, so that a user gets the same limit
+    however many processes their connections are spread across.
+
+    Each bucket is a small hash, updated atomically by a Lua script in a
+    single round trip, and set to expire once it would have refilled (so,
+    as in memory, idle buckets cost nothing).
+
+    If Redis can't be reached, events are allowed through rather than
+    refused; we'd rather let a flood through for a moment than lock
+    everybody out.
+    """
+
+    SCRIPT = '\n'.join((
+        "local rate, burst, now = "
+        "tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])",
+        "local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')",
+        "local tokens = tonumber(bucket[1]) or burst",
+        "local stamp = tonumber(bucket[2]) or now",
+        "tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)",
+        "local allowed = 0",
+        "if tokens >= 1 then",
+        "    tokens = tokens - 1",
+        "    allowed = 1",
+        "end",
+        "redis.call('HMSET', KEYS[1], 'tokens', tokens, 'stamp', now)",
+        "redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)",
+        "return allowed",
+    ))
+
+    def __init__(self):
+        self._script = get_redis().register_script(self.SCRIPT)
+
+    def allow(self, key, rate, burst):
+        try:
+            return bool(self._script(
+                keys=['ratelimit_%s' % key],
+                args=[repr(float(rate)), repr(float(burst)),
+                      repr(time.time())],
+            ))
+        except (ConnectionError, ResponseError):
+            logging.getLogger('socketio').warning(
+                'Could not check rate limit in Redis.', exc_info=True,
+            )
+            return True
+
+
+# The limiter is created on first use, from the `CHAT_RATE_LIMITER` setting
+#   (under a lock, for the same reason as the broker).
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """Return the process-wide rate limiter."""
+
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            module_name, class_name = settings.CHAT_RATE_LIMITER.rsplit('.', 1)
+            _limiter = getattr(import_module(module_name), class_name)()
+    return _limiter
@@ -0,0 +1,203 @@
+from __future__ import unicode_literals
+from django.utils.autoreload import code_changed
+from gevent.socket import wait_read
+import ctypes
+import ctypes.util
+import errno
+import gevent
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+
+class InotifyWatcher(object):
+    """Watches the source files of every loaded module using inotify, so
+    that the kernel tells us when one changes, rather than us asking about
+    every one of them every second.
+
+    We watch the directories the files are in, rather than the files
+    themselves; editors very often save by writing a new file and renaming
+    it over the old one, which a watch on the old file would never see.
+
+    Changes are debounced: once something changes, we wait until nothing
+    else has for `debounce` seconds (a `git checkout` changes a lot of files,
+    one at a time) before saying so, once.
+
+    Raises `OSError` if inotify isn't available (we're not on Linux, say).
+    """
+
+    # From <sys/inotify.h>.
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE)
+
+    # Each event is a header (watch descriptor, mask, cookie, length of the
+    #   name), followed by the name, padded with NULs.
+    HEADER = struct.Struct(str('iIII'))
+
+    # How often (in seconds) we look for newly imported modules, whose
+    #   directories we might not be watching yet.
+    RESCAN_INTERVAL = 5
+
+    def __init__(self, debounce=0.2):
+        self.debounce = debounce
+        libc = ctypes.CDLL(ctypes.util.find_library(str('c')), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.files = set()
+        self.directories = {}
+        self._module_count = 0
+        self._rescan()
+
+    def run(self, callback):
+        """Wait for one of the files to change, and then call `callback`.
+
+        This blocks (cooperatively) until then; run it in its own greenlet.
+        """
+
+        changed_at = None
+        while True:
+            # Wait for something to happen: forever (give or take a rescan)
+            #   if nothing has changed yet, or until the end of the debounce
+            #   period if something has.
+            if changed_at is None:
+                timeout = self.RESCAN_INTERVAL
+            else:
+                timeout = max(changed_at + self.debounce - time.time(), 0)
+            try:
+                wait_read(self.fd, timeout)
+            except socket.timeout:
+                if changed_at is not None:
+                    os.close(self.fd)
+                    callback()
+                    return
+                self._rescan()
+                continue
+
+            if self._changed():
+                changed_at = time.time()
+
+    def _changed(self):
+        """Read whatever events are waiting, and return whether any of them
+        were about one of our files."""
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN:
+                return False
+            raise
+
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.HEADER.unpack_from(data, offset)
+            offset += self.HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self.directories.get(wd)
+            if directory and os.path.join(directory, name) in self.files:
+                changed = True
+        return changed
+
+    def _rescan(self):
+        """Watch the directory of any module imported since we last
+        looked."""
+
+        if len(sys.modules) == self._module_count:
+            return
+        self._module_count = len(sys.modules)
+        self.files = _module_files()
+
+        watched = set(self.directories.values())
+        for directory in set([os.path.dirname(f) for f in self.files]):
+            if directory in watched:
+                continue
+            wd = self._add_watch(self.fd, directory, self.MASK)
+            if wd >= 0:
+                self.directories[wd] = directory
+
+
+class PollingWatcher(object):
+    """Checks the modification time of every loaded module's source file
+    every `interval` seconds, the way Django's own reloader does.
+
+    This is only here for where inotify isn't; every check looks at every
+    file, on the same event loop that is serving the sockets.
+    """
+
+    def __init__(self, interval=1):
+        self.interval = interval
+
+    def run(self, callback):
+        while not code_changed():
+            gevent.sleep(self.interval)
+        callback()
+
+
+def _module_files():
+    """Return the source file of every loaded module (as byte strings, as
+    inotify reports them)."""
+
+    files = set()
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            continue
+        if filename.endswith(('.pyc', '.pyo')):
+            filename = filename[:-1]
+        if isinstance(filename, unicode):
+            filename = filename.encode(sys.getfilesystemencoding())
+        files.add(os.path.abspath(filename))
+    return files
+
+
+def watch(callback, debounce=0.2, interval=1):
+    """Call `callback`, once, as soon as the source of any loaded module
+    changes, and return the greenlet that is watching for that.
+
+    We use inotify if we can (see `InotifyWatcher`), and fall back to
+    polling every `interval` seconds if we can't.
+    """
+
+    try:
+        watcher = InotifyWatcher(debounce=debounce)
+    except OSError:
+        logging.getLogger('socketio').info(
+            'inotify is not available; polling for code changes instead.',
+        )
+        watcher = PollingWatcher(interval=interval)
+    return gevent.spawn(watcher.run, callback)
+
+
+def restart():
+    """Replace this process with a fresh copy of itself, run with the same
+    arguments.
+
+    This replaces the process in place, rather than starting a child and
+    waiting for it (as Django's own reloader does), so reloads don't pile
+    up one process inside another.
+    """
+
+    # Nothing we have open is any use to the new process, and the listening
+    #   sockets in particular would stop it from binding its own.
+    os.closerange(3, subprocess.MAXFD)
+    args = [sys.executable] + ['-W%s' % o for o in sys.warnoptions]
+    os.execv(sys.executable, args + sys.argv)
@@ -0,0 +1,156 @@
+from __future__ import unicode_literals
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from pycon2013_socketio.chat.models import Event
+import gevent
+import gzip
+import json
+import logging
+import os
+import time
+
+
+class Pruner(object):
+    """Delete old events from the database, according to per-event-type
+    retention policies.
+
+    `policies` maps each event type to a `timedelta`; events of that type
+    older than that are deleted. Types that aren't in `policies` (or whose
+    policy is `None`) are kept forever.
+
+    Events are deleted `batch_size` at a time, oldest first, with a pause of
+    `pause` milliseconds between batches. No single DELETE runs for long
+    or locks much, so people chatting (and the write-behind writer) are
+    never held up behind us for more than a moment.
+
+    If `archive_dir` is set, every event is written, as a line of JSON, to
+    a gzipped file in that directory before it is deleted. Archives outlive
+    everything else, so each line is just the event's fields (see
+    `archive_line`), whatever encoding the broker happens to be using.
+    """
+
+    def __init__(self, policies, batch_size=1000, pause=100,
+                 archive_dir=None):
+        self.policies = policies
+        self.batch_size = batch_size
+        self.pause = pause / 1000.0
+        self.archive_dir = archive_dir
+
+        # Counters, for keeping an eye on how we're doing.
+        self.deleted = {}
+        self.archived = 0
+        self.batches = 0
+
+    def prune(self):
+        """Delete every event that is past its retention period, and return
+        how many were deleted."""
+
+        log = logging.getLogger('socketio')
+        archive = None
+        total = 0
+        try:
+            for event_type, retention in sorted(self.policies.items()):
+                if not retention:
+                    continue
+                cutoff = timezone.now() - retention
+                while True:
+                    # Get the next batch. We only ever select a batch's
+                    #   worth of rows, however far behind we are.
+                    batch = list(Event.objects.filter(
+                        event_type=event_type,
+                        created__lt=cutoff,
+                    ).order_by('created')[0:self.batch_size])
+                    if not batch:
+                        break
+
+                    # Archive the batch, if we're archiving.
+                    if self.archive_dir:
+                        if archive is None:
+                            archive = self._open_archive()
+                        for event in batch:
+                            archive.write(archive_line(event) + '\n')
+                        archive.flush()
+                        self.archived += len(batch)
+
+                    # Delete it.
+                    Event.objects.filter(
+                        id__in=[event.id for event in batch],
+                    ).delete()
+                    self.deleted[event_type] = self.deleted.get(
+                        event_type, 0,
+                    ) + len(batch)
+                    self.batches += 1
+                    total += len(batch)
+                    log.debug('Pruned %d %s events.', len(batch), event_type)
+
+                    # Give everyone else a turn.
+                    if len(batch) < self.batch_size:
+                        break
+                    gevent.sleep(self.pause)
+        finally:
+            if archive is not None:
+                archive.close()
+        return total
+
+    def run_forever(self, interval=300):
+        """Prune, and then prune again every `interval` seconds.
+
+        This never returns; run it in its own greenlet.
+        """
+
+        log = logging.getLogger('socketio')
+        while True:
+            start = time.time()
+            try:
+                deleted = self.prune()
+            except Exception:
+                log.error('Exception while pruning events.', exc_info=True)
+            else:
+                log.info('Pruned %d events in %.1f seconds.', deleted,
+                         time.time() - start)
+            gevent.sleep(interval)
+
+    def _open_archive(self):
+        """Open a new archive file, named for the current time."""
+
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        filename = os.path.join(self.archive_dir, 'events-%s.jsonl.gz' % (
+            timezone.now().strftime('%Y%m%d-%H%M%S'),
+        ))
+        return gzip.open(filename, 'ab')
+
+
+def archive_line(event):
+    """Return the line of JSON that an event is archived as.
+
+    This is deliberately not `Event.serialize`, which follows
+    `CHAT_WIRE_FORMAT` (see `chat/wire.py`); an archive written today has to
+    be readable long after the wire format has changed.
+    """
+
+    return json.dumps({
+        'id': event.id,
+        'room': event.room_id,
+        'sequence': event.sequence,
+        'type': event.event_type,
+        'user': event.user_name,
+        'message': event.message,
+        'created': event.created.isoformat(),
+    }, sort_keys=True)
+
+
+def get_policies():
+    """Return the retention policies from the `CHAT_RETENTION_*` settings,
+    as `Pruner` expects them."""
+
+    presence = float(settings.CHAT_RETENTION_PRESENCE_HOURS)
+    statement = float(settings.CHAT_RETENTION_STATEMENT_DAYS)
+    topic = float(settings.CHAT_RETENTION_TOPIC_DAYS)
+    return {
+        'user_joined': presence and timedelta(hours=presence),
+        'user_left': presence and timedelta(hours=presence),
+        'statement': statement and timedelta(days=statement),
+        'topic_set': topic and timedelta(days=topic),
+    }
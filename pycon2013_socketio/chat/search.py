@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+import re
+
+
+# How messages are broken up into search terms.
+#
+# A term is a run of letters and digits (in any alphabet), lowercased.
+#   Single characters are left out (they match nearly everything, and would
+#   make for enormous posting lists), and anything longer than
+#   MAX_TERM_LENGTH is cut short, so that it fits the `SearchTerm.term`
+#   column; a search for the whole of a very long word still finds it,
+#   since the search is cut short the same way.
+#
+# Messages and queries go through exactly the same function, so whatever
+#   the index holds, a search for the same words will find it. Every term
+#   in a query has to be in a message for it to match.
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 40
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the distinct search terms in `text`, in the order in which
+    they first appear."""
+
+    answer = []
+    seen = set()
+    for word in _WORD.findall(text.lower()):
+        term = word[0:MAX_TERM_LENGTH]
+        if len(term) >= MIN_TERM_LENGTH and term not in seen:
+            seen.add(term)
+            answer.append(term)
+    return answer
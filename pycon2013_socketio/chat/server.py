@@ -0,0 +1,141 @@
+from __future__ import unicode_literals
+from pycon2013_socketio.chat.namespaces import pending_leaves
+from pycon2013_socketio.chat.presence import get_presence
+from pycon2013_socketio.chat.sessions import get_session_store
+from pycon2013_socketio.chat.writer import stop_writer
+from socketio.handler import SocketIOHandler
+from socketio.server import SocketIOServer
+import gevent
+import logging
+import time
+
+
+class ChatServer(SocketIOServer):
+    """A SocketIO server that looks sessions up in the session store (see
+    `CHAT_SESSION_STORE` and `chat/sessions.py`), rather than only in its
+    own memory."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('handler_class', ChatHandler)
+        super(ChatServer, self).__init__(*args, **kwargs)
+
+    def get_socket(self, sessid=''):
+        return get_session_store().get_socket(self, sessid)
+
+
+class ChatHandler(SocketIOHandler):
+    """The stock SocketIO handler, except that if the session store is
+    shared, each new session is connected as soon as it is handshaken.
+
+    The stock handler connects a session (starts its heartbeat, sends the
+    client the connect packet, and runs the WSGI application, which is what
+    routes it to our namespaces) on its first poll. That only works if the
+    first poll comes back to the same process; with a shared store, it may
+    well not, so we do all that here instead.
+    """
+
+    def _do_handshake(self, tokens):
+        if tokens['resource'] != self.server.resource:
+            self.log_error('socket.io URL mismatch')
+            return
+
+        socket = self.server.get_socket()
+        if get_session_store().shared:
+            self._connect(socket)
+        self.write_smart(('%s:%s:%s:%s' % (
+            socket.sessid,
+            self.config['heartbeat_timeout'] or '',
+            self.config['close_timeout'] or '',
+            ','.join(self.transports),
+        )).encode('utf-8'))
+
+    def _connect(self, socket):
+        socket.connection_established = True
+        socket.state = socket.STATE_CONNECTED
+        socket._spawn_heartbeat()
+        socket._spawn_watcher()
+
+        # The first poll (wherever it goes) picks up the connect packet.
+        #   (The websocket transport sends one of its own as well; clients
+        #   ignore the second.)
+        socket.put_client_msg('1::')
+
+        self.environ['socketio'] = socket
+        socket.wsgi_app_greenlet = gevent.spawn(
+            self.application, self.environ,
+            lambda status, headers, exc=None: None,
+        )
+
+
+def make_server(listener, application, policy_server=True):
+    """Create a SocketIO server for the given WSGI application.
+
+    `listener` is either a `(host, port)` tuple, or an already-bound socket
+    (which is how several worker processes share the same port).
+    """
+
+    return ChatServer(
+        listener,
+        application,
+        resource='socket.io',
+        policy_server=policy_server,
+    )
+
+
+def drain(server, timeout=10, wait_for_leaves=True):
+    """Shut a SocketIO server down gracefully.
+
+    We stop accepting new connections, then disconnect every socket that
+    is still connected. That runs each namespace's `recv_disconnect`, so
+    users are announced as having left their rooms, and their room
+    subscriptions are cleaned up. The browsers see their transport go away
+    and reconnect -- to another worker, if there is one.
+
+    Departures are announced after a grace period (`CHAT_PRESENCE_GRACE`),
+    in case the user reconnects -- which is exactly what we expect them to
+    do, elsewhere. We wait for those to play out; then anything queued for
+    writing to the database (see `CHAT_WRITE_BEHIND`) is flushed, and this
+    process's presence entries are removed. The whole thing is given
+    `timeout` seconds; whatever is left after that is abandoned.
+
+    If `wait_for_leaves` is off, departures still in their grace period are
+    dropped rather than waited for. That's for when the same process is
+    about to come straight back (see `runserver`), and the users with it.
+    """
+
+    log = logging.getLogger('socketio')
+    deadline = time.time() + timeout
+    server.stop_accepting()
+
+    # Disconnect each socket in its own greenlet, so one slow socket
+    #   doesn't hold up the others.
+    sockets = list(server.sockets.values())
+    log.info('Draining %d connected sockets.', len(sockets))
+    jobs = [gevent.spawn(_disconnect, socket) for socket in sockets]
+    gevent.joinall(jobs, timeout=max(deadline - time.time(), 0))
+    gevent.killall(jobs, block=False)
+
+    # Anyone who hasn't turned up anywhere else by the end of their grace
+    #   period gets announced as having left.
+    if wait_for_leaves:
+        pending_leaves.join(timeout=max(deadline - time.time(), 0))
+    else:
+        pending_leaves.kill(block=False)
+
+    # Whatever is left of this process's presence entries (and sessions)
+    #   goes, too.
+    get_presence().clear()
+    get_session_store().clear()
+
+    # Write out anything still waiting to be written.
+    stop_writer(timeout=max(deadline - time.time(), 0))
+
+    # Stopping (rather than just killing) the server closes the Flash policy
+    #   server's port as well as our own.
+    server.stop(timeout=0)
+
+
+def _disconnect(socket):
+    socket.kill()
+    socket.server.sockets.pop(socket.sessid, None)
+    gevent.killall(socket.jobs, block=False)
@@ -0,0 +1,374 @@
+from __future__ import unicode_literals
+from collections import deque
+from django.conf import settings
+from django.utils.importlib import import_module
+from gevent.event import AsyncResult
+from gevent.queue import Empty
+from pycon2013_socketio.chat import metrics
+from pycon2013_socketio.chat.connections import get_redis, get_ring
+from redis.exceptions import ConnectionError
+from socketio.server import SocketIOServer
+import gevent
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+
+
+class BaseSessionStore(object):
+    """Finds the socket.io session (the `Socket`) that each request to the
+    SocketIO server belongs to.
+
+    Subclasses implement `get_socket`. A store that lets any process serve
+    requests for any session sets `shared`, and the server then connects
+    each new session as soon as it has been handshaken (see `ChatHandler`
+    in `chat/server.py`), rather than waiting for its first poll, which may
+    go to another process.
+    """
+
+    shared = False
+
+    def get_socket(self, server, sessid=''):
+        """Return the socket for the session `sessid`, or `None` if there is
+        no such session. With no `sessid` (for a handshake), start a new
+        session on `server`, and return its socket."""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Forget every session this process started (it is shutting
+        down)."""
+
+
+class MemorySessionStore(BaseSessionStore):
+    """Sessions, kept in the process that handshook them, as gevent-socketio
+    has always done.
+
+    This costs nothing, but a polling client's requests must then all reach
+    the same process; if the site runs in several, the load balancer has to
+    be told to stick each client to one of them.
+    """
+
+    def get_socket(self, server, sessid=''):
+        return SocketIOServer.get_socket(server, sessid)
+
+
+class RedisSessionStore(BaseSessionStore):
+    """Sessions that any process can serve requests for, so that polling
+    clients don't need to stick to one process.
+
+    A session's socket (and its namespaces, and their greenlets) can't leave
+    the process that handshook it, its owner. What is shared is a registry,
+    in Redis, of which process owns each session, and a way for the others
+    to reach it: every process listens on a pub/sub channel of its own, and
+    a poll or a post that lands somewhere else is relayed to the owner's
+    channel (see `RemoteSocket`). The owner answers a relayed poll, on the
+    asker's channel, with whatever it would have sent down itself. If the
+    asker has given up waiting by the time the answer arrives, it sends the
+    messages back to the owner, to go down with the next poll instead.
+
+    A request that does reach the owner is served straight from the socket,
+    at no extra cost. A relayed post costs a lookup and a publish; a relayed
+    poll costs one more publish, for the answer. (See `manage.py
+    sessionbench`.)
+
+    Each process refreshes its registry entries every `REFRESH_INTERVAL`
+    seconds, and removes those for sessions that have ended; the entries of
+    a process that dies without cleaning up expire by themselves.
+    """
+
+    shared = True
+
+    # How often (in seconds) registry entries are refreshed, and how much
+    #   longer than a relayed poll's own timeout (in seconds) we wait for
+    #   its answer before giving up on it.
+    REFRESH_INTERVAL = 10
+    RELAY_TIMEOUT = 5
+
+    def __init__(self, channel=None):
+        # Each process listens on a channel named for it, unless told
+        #   otherwise (the tests play two processes in one).
+        self.sockets = {}
+        self.waiting = {}
+        self.ttl = self.REFRESH_INTERVAL * 3
+        self.channel = channel or 'sessions_%s_%d' % (socket.gethostname(),
+                                                      os.getpid())
+        self._ids = itertools.count()
+
+        self.pubsub = get_redis(self.channel).pubsub()
+        self.pubsub.subscribe(self.channel)
+        self._listener = gevent.spawn(self._run)
+        self._refresher = gevent.spawn(self._refresh_forever)
+
+    def get_socket(self, server, sessid=''):
+        # Requests for sessions that we own, including handshakes (which
+        #   start a new session here), are served just as they always were.
+        local = SocketIOServer.get_socket(server, sessid)
+        if not sessid:
+            self.sockets[local.sessid] = local
+            key = self._key(local.sessid)
+            get_redis(key).setex(key, value=self.channel, time=self.ttl)
+        if local is not None:
+            return local
+
+        # Otherwise, is it someone else's?
+        owner = get_redis(self._key(sessid)).get(self._key(sessid))
+        if owner is None:
+            return None
+        return RemoteSocket(self, sessid, owner, server.config)
+
+    def clear(self):
+        sessids = list(self.sockets)
+        self.sockets = {}
+        self._pipelines([(self._key(sessid), 'delete') for sessid in sessids])
+
+    def relay(self, channel, message):
+        """Publish `message` to another process's channel, and return
+        whether anyone was listening."""
+
+        _relayed[message['type']].inc()
+        return bool(get_redis(channel).publish(channel, json.dumps(message)))
+
+    def poll(self, owner, sessid, timeout=None):
+        """Ask the process that owns a session (on its channel, `owner`)
+        for whatever is waiting to go down to the client, waiting up to
+        `timeout` seconds for something to turn up, and return it.
+
+        If the owner isn't there to ask, we say the socket has been closed
+        (with a `None`), just as a socket of our own would.
+        """
+
+        request_id = next(self._ids)
+        answer = self.waiting[request_id] = AsyncResult()
+        try:
+            if not self.relay(owner, {
+                'type': 'poll',
+                'sessid': sessid,
+                'id': request_id,
+                'reply_to': self.channel,
+                'timeout': timeout,
+            }):
+                return [None]
+            return answer.get(
+                timeout=(timeout or self.ttl) + self.RELAY_TIMEOUT,
+            )
+        except gevent.Timeout:
+            return []
+        finally:
+            self.waiting.pop(request_id, None)
+
+    def _key(self, sessid):
+        return 'session_%s' % sessid
+
+    def _local(self, sessid):
+        """Return the socket for one of our own sessions, if it's still
+        connected."""
+
+        local = self.sockets.get(sessid)
+        if local is not None and sessid in local.server.sockets:
+            return local
+        return None
+
+    def _run(self):
+        """Listen forever, reconnecting to Redis if the connection drops."""
+
+        while True:
+            try:
+                self._listen()
+            except ConnectionError:
+                logging.getLogger('socketio').warning(
+                    'Lost the Redis subscription for sessions; reconnecting.',
+                    exc_info=True,
+                )
+            gevent.sleep(1)
+            self.pubsub.reset()
+            try:
+                self.pubsub.subscribe(self.channel)
+            except ConnectionError:
+                pass
+
+    def _listen(self):
+        for block in self.pubsub.listen():
+            if not block or block.get('type') != 'message':
+                continue
+            try:
+                message = json.loads(block['data'])
+            except ValueError:
+                continue
+
+            # Answers to our own polls go to whoever is waiting for them.
+            #   If nobody is (the poll timed out, or its request went away),
+            #   the messages in the answer have already been taken off the
+            #   owner's queue, and would be lost; give them back to the
+            #   owner.
+            if message['type'] == 'answer':
+                answer = self.waiting.get(message['id'])
+                if answer is not None:
+                    answer.set(message['messages'])
+                elif [m for m in message['messages'] if m is not None]:
+                    self.relay(message['owner'], {
+                        'type': 'requeue',
+                        'sessid': message['sessid'],
+                        'messages': message['messages'],
+                    })
+                continue
+
+            # Anything else is for one of our sessions.
+            # Messages given back from an answer nobody took go back on the
+            #   queue for the client (at the back of it, behind anything
+            #   that has turned up since).
+            local = self._local(message['sessid'])
+            if message['type'] == 'send' and local is not None:
+                for packet in message['messages']:
+                    local.put_server_msg(packet)
+            elif message['type'] == 'requeue' and local is not None:
+                for packet in message['messages']:
+                    local.put_client_msg(packet)
+            elif message['type'] == 'poll':
+                gevent.spawn(self._answer, local, message)
+
+    def _answer(self, local, message):
+        """Answer a poll relayed from another process."""
+
+        answer = [None]
+        if local is not None:
+            local.heartbeat()
+            try:
+                answer = local.get_multiple_client_msgs(
+                    timeout=message['timeout'],
+                )
+            except Empty:
+                answer = []
+        self.relay(message['reply_to'], {
+            'type': 'answer',
+            'id': message['id'],
+            'sessid': message['sessid'],
+            'owner': self.channel,
+            'messages': answer,
+        })
+
+    def _refresh_forever(self):
+        """Keep this process's registry entries alive, for as long as it
+        lives, and take out those of sessions that have ended."""
+
+        while True:
+            gevent.sleep(self.REFRESH_INTERVAL)
+            commands = []
+            for sessid in list(self.sockets):
+                if self._local(sessid) is None:
+                    del self.sockets[sessid]
+                    commands.append((self._key(sessid), 'delete'))
+                else:
+                    commands.append((self._key(sessid), 'expire'))
+            try:
+                self._pipelines(commands)
+            except ConnectionError:
+                logging.getLogger('socketio').warning(
+                    'Could not refresh sessions in Redis.', exc_info=True,
+                )
+
+    def _pipelines(self, commands):
+        """Run `(key, command)` pairs, in one round trip to each node."""
+
+        pipes = {}
+        for key, command in commands:
+            node = get_ring().get_node(key)
+            if node not in pipes:
+                pipes[node] = get_redis(node=node).pipeline(transaction=False)
+            if command == 'expire':
+                pipes[node].expire(key, self.ttl)
+            else:
+                pipes[node].delete(key)
+        for pipe in pipes.values():
+            pipe.execute()
+
+
+class RemoteSocket(object):
+    """Stands in for a socket that lives in another process, relaying
+    everything to it through the session store.
+
+    This is just as much of `socketio.virtsocket.Socket` as the transports
+    use; the socket itself (its namespaces, its heartbeat) is looked after
+    by its owner.
+    """
+
+    # The owner connects the socket at the handshake.
+    connection_established = True
+
+    def __init__(self, store, sessid, owner, config):
+        self.store = store
+        self.sessid = sessid
+        self.owner = owner
+        self.config = config
+        self.jobs = []
+        self._buffer = deque()
+
+    def heartbeat(self):
+        # Every relayed poll counts as a heartbeat at the other end.
+        pass
+
+    def put_server_msg(self, msg):
+        self.store.relay(self.owner, {
+            'type': 'send',
+            'sessid': self.sessid,
+            'messages': [msg],
+        })
+
+    def get_multiple_client_msgs(self, timeout=None):
+        messages = self.store.poll(self.owner, self.sessid, timeout=timeout)
+        if not messages:
+            raise Empty
+        return messages
+
+    def get_client_msg(self, **kwargs):
+        # The streaming transports take messages one at a time, and wait
+        #   for as long as it takes; we wait a heartbeat at a time, so that
+        #   we notice if the owner goes away.
+        while not self._buffer:
+            try:
+                self._buffer.extend(self.get_multiple_client_msgs(
+                    timeout=self.config['heartbeat_interval'],
+                ))
+            except Empty:
+                pass
+        return self._buffer.popleft()
+
+    def disconnect(self, silent=False):
+        self.put_server_msg('0::')
+
+    def spawn(self, fn, *args, **kwargs):
+        job = gevent.spawn(fn, *args, **kwargs)
+        self.jobs.append(job)
+        return job
+
+
+# How many messages have been relayed between processes, of each type.
+_relayed = dict([
+    (message_type, metrics.counter('chat_session_relayed_total',
+                                   type=message_type))
+    for message_type in ('answer', 'poll', 'requeue', 'send')
+])
+
+# The session store is created on first use, from the `CHAT_SESSION_STORE`
+#   setting (under a lock, for the same reason as the broker).
+_store = None
+_store_lock = threading.Lock()
+
+
+metrics.gauge('chat_sessions_owned',
+              lambda: len(getattr(_store, 'sockets', ())))
+
+
+def get_session_store():
+    """Return the process-wide session store."""
+
+    global _store
+    with _store_lock:
+        if _store is None:
+            module_name, class_name = settings.CHAT_SESSION_STORE.rsplit(
+                '.', 1,
+            )
+            _store = getattr(import_module(module_name), class_name)()
+    return _store
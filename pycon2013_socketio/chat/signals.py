@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+from pycon2013_socketio.chat import metrics, wire
+from pycon2013_socketio.chat.brokers import get_broker
+from pycon2013_socketio.chat.models import Room
+import gevent
+
+
+class Coalescer(object):
+    """Passes a stream of values on to `send`, at most once every `window`
+    seconds.
+
+    The first value goes straight through. Anything that comes in after it,
+    within the window, is held back, and only the latest of those is sent,
+    once the window is up (which starts a new window). So someone typing
+    away costs one signal per window, however fast they type, and a run of
+    read markers comes out as the last one.
+
+    Like a token bucket, a coalescer that nobody is using costs nothing; it
+    only has a greenlet while a window is open.
+    """
+
+    # Stands in for "nothing held back", since `None` is a fine value.
+    _NOTHING = object()
+
+    def __init__(self, window, send):
+        self.window = window
+        self.send = send
+        self.pending = self._NOTHING
+        self._timer = None
+
+    def put(self, value):
+        """Send `value`, now or at the end of the window."""
+
+        self.pending = value
+        if self._timer is None:
+            self._flush()
+
+    def cancel(self):
+        """Forget anything held back, and close the window."""
+
+        self.pending = self._NOTHING
+        if self._timer is not None:
+            self._timer.kill(block=False)
+            self._timer = None
+
+    def _flush(self):
+        value, self.pending = self.pending, self._NOTHING
+        if value is self._NOTHING:
+            self._timer = None
+            return
+        self._timer = gevent.spawn_later(self.window, self._flush)
+        self.send(value)
+
+
+def publish(room_slug, signal_type, user_name, value):
+    """Publish an ephemeral signal straight to a room's channel.
+
+    There is no `Event`, so nothing is saved, numbered, or pushed onto the
+    room's backlog; it's a single PUBLISH (with the Redis broker), and only
+    the sockets in the room right now ever see it.
+    """
+
+    get_broker().publish(Room(id=room_slug).redis_key,
+                         wire.signal(room_slug, signal_type, user_name, value))
+    metrics.counter('chat_signals_published_total', type=signal_type).inc()
@@ -0,0 +1,23 @@
+-- Brings a `chat_event` table from before sequence numbers up to date.
+--
+-- `syncdb` only creates tables that don't exist yet; it never changes one
+--   that does. Run this once, by hand, on a database created before events
+--   had a `sequence` column (and before the composite indexes):
+--
+--     ./manage.py dbshell < pycon2013_socketio/chat/sql/upgrade_event_sequence.sql
+--
+-- It is safe to run with the old code still serving: the new column is
+--   nullable, and nothing old ever reads it. Run it before starting the new
+--   code, which does. (Events from before then keep a NULL sequence; see
+--   `Room.next_sequence`.)
+--
+-- The index names are the ones `syncdb` would have given them, so that
+--   `./manage.py sqlindexes chat` agrees with what's in the database.
+
+ALTER TABLE chat_event ADD COLUMN sequence integer NULL CHECK (sequence >= 0);
+
+-- `EventManager.history` and `Room.get_backlog` walk down this one.
+CREATE INDEX chat_event_f33210fc ON chat_event (room_id, event_type, created);
+
+-- `Room.next_sequence` finds where a room's sequence left off with this one.
+CREATE INDEX chat_event_e4226e85 ON chat_event (room_id, sequence);
@@ -0,0 +1,21 @@
+-- Gives a `chat_event` table from before events had keys their `uuid`
+--   column.
+--
+-- `syncdb` only creates tables that don't exist yet; it never changes one
+--   that does. Run this once, by hand, on a database created before events
+--   had a `uuid` column (after `upgrade_event_sequence.sql`, if that one is
+--   needed too):
+--
+--     ./manage.py dbshell < pycon2013_socketio/chat/sql/upgrade_event_uuid.sql
+--
+-- It is safe to run with the old code still serving: the new column is
+--   nullable, and nothing old ever reads it. Run it before starting the new
+--   code, which does. (Events from before then keep a NULL key; they were
+--   indexed for searching when they were written, and don't need one.)
+
+ALTER TABLE chat_event ADD COLUMN uuid varchar(32) NULL;
+
+-- `syncdb` makes the column UNIQUE; this is the same thing, for a table
+--   that already exists. `EventManager.bulk_created` reads events back by
+--   their keys with it.
+CREATE UNIQUE INDEX chat_event_uuid ON chat_event (uuid);
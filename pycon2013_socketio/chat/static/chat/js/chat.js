@@ -36,9 +36,124 @@ $(document).ready(function() {
         // For the other side of this concept, scroll down to the bottom
         //   of this file (or search for "socket.on" in your text editor).
         socket.emit('nick', user_name)
+
+        // Ask for room events in the compact encoding (see `unpack`, below).
+        socket.emit('encoding', 'compact')
+
+        // If this is a reconnection (our connection dropped, and socket.io
+        //   brought it back), the server has forgotten which rooms we were
+        //   in. Rejoin each of them, and tell the server the last event we
+        //   saw in each, so that it only sends down what we missed.
+        for (var room_name in last_seen) {
+            socket.emit('join', room_name, last_seen[room_name])
+        }
     })
 
 
+    // Room events come down in the compact encoding: a list of fields,
+    //   rather than a dictionary that repeats every key in every event.
+    //   This turns one back into the dictionary that the rest of this
+    //   file expects. (The `chat/wire.py` module is the other half.)
+    var EVENT_TYPES = ['statement', 'user_joined', 'user_left', 'topic_set']
+    var unpack = function(fields) {
+        if (!$.isArray(fields)) {
+            return fields
+        }
+        var created = new Date(fields[6] / 1000)
+        var ev = {
+            'id': fields[0],
+            'seq': fields[1],
+            'room': fields[2],
+            'type': EVENT_TYPES[fields[3]],
+            'user': fields[4],
+            'message': fields[5],
+            'timestamp': created.toISOString().replace('T', ' ').slice(0, 19)
+        }
+        if (ev.type === 'topic_set') {
+            ev.topic = ev.message
+            ev.message = ev.user + ' set the topic to "' + ev.topic + '".'
+        }
+        return ev
+    }
+
+
+    // The sequence number (`seq`) of the last event we saw in each room
+    //   we're in.
+    var last_seen = {}
+
+
+    // Who is typing in each room, and how far each user has read, as the
+    //   server's ephemeral signals tell us (see `socket.on('signal')`,
+    //   below). Neither is ever saved anywhere; if we miss a signal, we
+    //   just don't know.
+    // Someone typing keeps telling us so, every couple of seconds; if we
+    //   haven't heard from them for TYPING_TIMEOUT milliseconds, we assume
+    //   they have stopped.
+    var TYPING_TIMEOUT = 5000
+    var typing = {}
+    var read = {}
+
+
+    // Show who is typing in the active room, and who has read everything
+    //   in it, under the room.
+    var show_status = function() {
+        var room_name = get_active_room()
+        var status = []
+        if (room_name !== null) {
+            var typists = []
+            for (var user in typing[room_name] || {}) {
+                typists.push(user)
+            }
+            if (typists.length === 1) {
+                status.push(typists[0] + ' is typing...')
+            } else if (typists.length > 1) {
+                status.push(typists.join(', ') + ' are typing...')
+            }
+
+            var readers = []
+            for (var user in read[room_name] || {}) {
+                if (read[room_name][user] >= (last_seen[room_name] || 0)) {
+                    readers.push(user)
+                }
+            }
+            if (readers.length) {
+                status.push('Seen by ' + readers.join(', ') + '.')
+            }
+        }
+        $('#room-status').text(status.join(' '))
+    }
+
+
+    // Tell the room that we're typing (or, with `false`, that we've
+    //   stopped). While we're typing, we say so at most once a second;
+    //   the server collapses repeats further still.
+    var typing_sent = {}
+    var send_typing = function(room_name, value) {
+        var now = new Date().getTime()
+        if (value && now - (typing_sent[room_name] || 0) < 1000) {
+            return
+        }
+        if (!value && !typing_sent[room_name]) {
+            return
+        }
+        typing_sent[room_name] = value ? now : 0
+        socket.emit('signal', room_name, 'typing', value)
+    }
+
+
+    // Tell the room how far we've read, if we're looking at it, and have
+    //   read further than we last said.
+    var read_sent = {}
+    var send_read = function(room_name) {
+        var seq = last_seen[room_name] || 0
+        if (room_name !== get_active_room() || seq <= (read_sent[room_name] || 0)) {
+            return
+        }
+        read_sent[room_name] = seq
+        socket.emit('signal', room_name, 'read', seq)
+    }
+
+
     // Function to activate a room.
     // This causes one room to become active and all other rooms
     //   to become inactive.
@@ -56,6 +171,10 @@ $(document).ready(function() {
             $(this).removeClass('active')
         })
         $('.room-tab[data-name="' + room_name + '"]').addClass('active')
+
+        // We're looking at the room now, so we've read it.
+        send_read(room_name)
+        show_status()
     }
 
 
@@ -94,7 +213,13 @@ $(document).ready(function() {
         //   be defined so I can call it on the backlog that we get when
         //   we successfully join the room.
         var on_room_event = function(ev) {
+            ev = unpack(ev)
             var $room = $('.room[data-name="' + room_name + '"]')
+
+            // Remember where we are in the room, in case we have to rejoin.
+            if (ev.seq && ev.seq > (last_seen[room_name] || 0)) {
+                last_seen[room_name] = ev.seq
+            }
             
             // This is a bit tricky. The room might not exist in our DOM
             // yet, so call this function recursively on a timeout until
@@ -158,6 +283,15 @@ $(document).ready(function() {
             if (ev.type === 'topic_set') {
                 $room.find('.topic').text(ev.topic)
             }
+
+            // Whoever said something has stopped typing (for now), and if
+            //   we're looking at the room, we've read it.
+            if (ev.type === 'statement' && typing[room_name]) {
+                window.clearTimeout(typing[room_name][ev.user])
+                delete typing[room_name][ev.user]
+            }
+            send_read(room_name)
+            show_status()
         }
 
         socket.emit('join', room_name)
@@ -203,6 +337,9 @@ $(document).ready(function() {
             // Activate this room.
             activate_room(room_name)
 
+            // From now on, we rejoin this room whenever we reconnect.
+            last_seen[room_name] = last_seen[room_name] || 0
+
             // Add all the stuff in the backlog to the DOM.
             for (var i = 0; i < ev.backlog.length; i += 1) {
                 on_room_event(ev.backlog[i])
@@ -213,7 +350,7 @@ $(document).ready(function() {
         //   in this room. This is, of course, the big deal -- we want
         //   to be told about things that happen in the rooms to which
         //   we are subscribed.
-        // The `self._listen` method in our Python namespace defines
+        // The `self.deliver` method in our Python namespace defines
         //   for is that room events come down with the event named
         //   `"%s_event" % room.id` ("foo_event", "bar_event", etc.)
         //   so we'll subscribe to that. Our handler needs to handle
@@ -251,6 +388,7 @@ $(document).ready(function() {
         // Send the message to our server. Again, this is an emit
         //   on our side which will map to `on_statement` on the other.
         socket.emit('statement', room_name, message)
+        send_typing(room_name, false)
 
         // Once we get back a success, we know that our message has been
         //   delivered. This means we can make the user facing act as if
@@ -264,11 +402,13 @@ $(document).ready(function() {
         })
     })
 
-    // make the enter button auto-submit
+    // make the enter button auto-submit; anything else means we're typing
     $('#input input').keypress(function(event) {
         if (event.which == 13) {
             event.preventDefault()
             $("#send").click()
+        } else if (get_active_room() !== null) {
+            send_typing(get_active_room(), true)
         }
     })
 
@@ -295,6 +435,68 @@ $(document).ready(function() {
     })
 
 
+    // If the server is batching room events, several of them come down
+    //   together as one `room_events` event. Unpack them, and hand each
+    //   one to the listener for its room, exactly as if it had come down
+    //   on its own.
+    // (`$emit` is how socket.io triggers our own listeners locally,
+    //   rather than sending anything to the server.)
+    socket.on('room_events', function(events) {
+        for (var i = 0; i < events.length; i += 1) {
+            var ev = unpack(events[i])
+            socket.$emit(ev.room + '_event', ev)
+        }
+    })
+
+
+    // If we fall too far behind, the server gives up on sending us some of
+    //   the room's events, and tells us how many we missed instead. Show
+    //   that in the room, like any other notification.
+    socket.on('room_missed', function(data) {
+        socket.$emit(data.room + '_event', {
+            'message': 'You missed ' + data.missed + ' messages.',
+            'room': data.room,
+            'timestamp': '',
+            'type': 'missed'
+        })
+    })
+
+
+    // When we rejoin a room after reconnecting, the room is already on the
+    //   page; all we have to do is add the events we missed, exactly as if
+    //   they had come down as they happened.
+    socket.on('room_joined', function(ev) {
+        if (!ev.resumed) {
+            return
+        }
+        for (var i = 0; i < ev.backlog.length; i += 1) {
+            socket.$emit(ev.room.slug + '_event', ev.backlog[i])
+        }
+    })
+
+
+    // Ephemeral signals from everyone else in our rooms: who is typing,
+    //   and how far each of them has read. These aren't room events;
+    //   they're never saved, and never come down in a backlog.
+    socket.on('signal', function(data) {
+        if (data.signal === 'typing') {
+            var room_typing = typing[data.room] = typing[data.room] || {}
+            window.clearTimeout(room_typing[data.user])
+            delete room_typing[data.user]
+            if (data.value) {
+                room_typing[data.user] = window.setTimeout(function() {
+                    delete room_typing[data.user]
+                    show_status()
+                }, TYPING_TIMEOUT)
+            }
+        } else if (data.signal === 'read') {
+            read[data.room] = read[data.room] || {}
+            read[data.room][data.user] = data.value
+        }
+        show_status()
+    })
+
+
     // Spit out everything that the socket sends as an error to our
     //   JavaScript console.
     // Note that "error" is the first argument to `self.emit` in the
@@ -0,0 +1,16 @@
+from __future__ import unicode_literals
+from django import template
+from pycon2013_socketio.chat.assets import asset_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def asset(name):
+    """Output the URL of a static file, by its hashed name if we serve it
+    (see `chat/assets.py`), so that browsers can cache it forever:
+
+        {% asset "chat/js/chat.js" %}
+    """
+
+    return asset_url(name)
@@ -0,0 +1,748 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+# Everything but threads is made cooperative, as it is in the servers.
+#   Threads are left alone, since Django ties each database connection to
+#   the thread that opened it, and patched, every greenlet is a thread.
+from gevent import monkey; monkey.patch_all(thread=False)  # must run first
+from datetime import datetime, timedelta
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from gevent.queue import Empty, Queue
+from pycon2013_socketio.chat import views, wire
+from pycon2013_socketio.chat.brokers import RedisBroker
+from pycon2013_socketio.chat.connections import HashRing, get_redis
+from pycon2013_socketio.chat.metrics import Histogram
+from pycon2013_socketio.chat.models import Event, Room, SearchTerm
+from pycon2013_socketio.chat.namespaces import ChatNamespace, connections
+from pycon2013_socketio.chat.presence import get_presence
+from pycon2013_socketio.chat.ratelimit import TokenBucket
+from pycon2013_socketio.chat.retention import Pruner
+from pycon2013_socketio.chat.search import tokenize
+from pycon2013_socketio.chat.sessions import RedisSessionStore, RemoteSocket
+from pycon2013_socketio.chat.signals import Coalescer
+from pycon2013_socketio.chat.writer import Writer, stop_writer
+from redis.exceptions import ConnectionError
+from socketio.server import SocketIOServer
+import gevent
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+
+class Recorder(object):
+    """Stands in for a namespace, and keeps whatever is delivered to it."""
+
+    def __init__(self):
+        self.received = []
+
+    def deliver(self, data):
+        self.received.append(data)
+
+
+class Broken(object):
+    """Stands in for a namespace that blows up on every delivery."""
+
+    def deliver(self, data):
+        raise RuntimeError('Broken.')
+
+
+def wait_for(condition, timeout=2):
+    """Wait (cooperatively) until `condition()` is true, or give up."""
+
+    with gevent.Timeout(timeout, False):
+        while not condition():
+            gevent.sleep(0.01)
+    return condition()
+
+
+class WireTests(SimpleTestCase):
+    """The compact encoding has to come back out exactly as the JSON one
+    went in (see `chat/wire.py`), or browsers that asked for different
+    encodings would see different things."""
+
+    def setUp(self):
+        self.created = datetime(2013, 3, 16, 14, 30, 5, 123456,
+                                tzinfo=timezone.utc)
+
+    def test_round_trip(self):
+        fields = wire.pack(7, 3, 'lobby', 'statement', 'luke', 'Hello!',
+                           self.created)
+        self.assertEqual(fields, [7, 3, 'lobby', 0, 'luke', 'Hello!',
+                                  1363444205123456])
+        self.assertEqual(wire.unpack(fields), {
+            'id': 7,
+            'created': '2013-03-16T14:30:05.123456+00:00',
+            'seq': 3,
+            'room': 'lobby',
+            'type': 'statement',
+            'user': 'luke',
+            'message': 'Hello!',
+            'timestamp': '2013-03-16 14:30:05',
+        })
+
+    def test_topic_set(self):
+        # Topic changes carry just the topic in the compact encoding, and
+        #   get their message (and `topic` key) back when unpacked.
+        fields = wire.pack(8, 4, 'lobby', 'topic_set', 'luke', 'PyCon',
+                           self.created)
+        self.assertEqual(fields[5], 'PyCon')
+        event = wire.unpack(fields)
+        self.assertEqual(event['topic'], 'PyCon')
+        self.assertEqual(event['message'], 'luke set the topic to "PyCon".')
+
+        # ...and pack again to the same thing.
+        self.assertEqual(wire.WireEvent(data=event).packed(), fields)
+
+    def test_loads(self):
+        fields = wire.pack(7, 3, 'lobby', 'user_joined', 'luke',
+                           'luke has joined the room.', self.created)
+        compact = wire.loads(json.dumps(fields))
+        full = wire.loads(json.dumps(wire.unpack(fields)))
+        for event in (compact, full):
+            self.assertFalse(event.ephemeral)
+            self.assertEqual(event.room, 'lobby')
+            self.assertEqual(event.type, 'user_joined')
+            self.assertEqual(event.seq, 3)
+            self.assertEqual(event.created_at, 1363444205.123456)
+        self.assertEqual(compact.as_dict(), full.as_dict())
+        self.assertEqual(compact.packed(), full.packed())
+
+    def test_loads_signal(self):
+        signal = wire.loads(wire.signal('lobby', 'typing', 'luke', True))
+        self.assertTrue(signal.ephemeral)
+        self.assertEqual(signal.room, 'lobby')
+        self.assertEqual(signal.type, 'typing')
+        self.assertEqual(signal.as_dict()['value'], True)
+
+    def test_loads_garbage(self):
+        for payload in ('{"room": "lobby"}', '[1, 2, 3]', '"hello"',
+                        '[7, 3, "lobby", 9, "luke", "Hi", 0]'):
+            self.assertRaises(ValueError, wire.loads, payload)
+
+
+class HashRingTests(SimpleTestCase):
+    NODES = ['10.0.0.1:6379', '10.0.0.2:6379', '10.0.0.3:6379']
+
+    def setUp(self):
+        self.keys = ['room_{room%d}' % i for i in range(0, 3000)]
+
+    def test_stable(self):
+        # Every process has to agree on where every key lives.
+        first, second = HashRing(self.NODES), HashRing(self.NODES)
+        for key in self.keys:
+            self.assertEqual(first.get_node(key), second.get_node(key))
+
+    def test_hash_tags(self):
+        ring = HashRing(self.NODES)
+        for i in range(0, 100):
+            self.assertEqual(ring.get_node('room_{room%d}' % i),
+                             ring.get_node('backlog_{room%d}' % i))
+
+    def test_distribution(self):
+        ring = HashRing(self.NODES)
+        counts = dict([(node, 0) for node in self.NODES])
+        for key in self.keys:
+            counts[ring.get_node(key)] += 1
+        for node, count in counts.items():
+            self.assertTrue(600 < count < 1400, (node, count))
+
+    def test_adding_a_node(self):
+        # Only the keys that move to the new node move at all, and only
+        #   about a quarter of them do.
+        before = HashRing(self.NODES)
+        after = HashRing(self.NODES + ['10.0.0.4:6379'])
+        moved = 0
+        for key in self.keys:
+            if before.get_node(key) != after.get_node(key):
+                self.assertEqual(after.get_node(key), '10.0.0.4:6379')
+                moved += 1
+        self.assertTrue(400 < moved < 1200, moved)
+
+    def test_one_node(self):
+        self.assertEqual(HashRing(self.NODES[0:1]).get_node('anything'),
+                         self.NODES[0])
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_refill(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        now = bucket.stamp
+        self.assertTrue(bucket.take(now))
+        self.assertTrue(bucket.take(now))
+        self.assertFalse(bucket.take(now))
+
+        # Half a second buys half a token, which isn't enough...
+        self.assertFalse(bucket.take(now + 0.5))
+
+        # ...but the other half comes a half second later.
+        self.assertTrue(bucket.take(now + 1.0))
+        self.assertFalse(bucket.take(now + 1.0))
+
+    def test_burst_cap(self):
+        # However long it sits unused, a bucket holds no more than `burst`.
+        bucket = TokenBucket(rate=10, burst=3)
+        now = bucket.stamp + 3600
+        self.assertTrue(bucket.full(now))
+        for i in range(0, 3):
+            self.assertTrue(bucket.take(now))
+        self.assertFalse(bucket.take(now))
+
+
+class Joiner(ChatNamespace):
+    """A chat connection that only keeps track of the rooms it is asked to
+    join."""
+
+    def initialize(self):
+        super(Joiner, self).initialize()
+        self.joined = []
+
+    def on_join(self, room_slug, last_seen=None):
+        self.joined.append(room_slug)
+
+
+class RateLimitTests(SimpleTestCase):
+    def setUp(self):
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            connections.discard(conn)
+
+    def connect(self, sessid, address):
+        conn = Joiner({'socketio': FakeSocket(sessid),
+                       'REMOTE_ADDR': address}, '/chat')
+        conn.initialize()
+        self.connections.append(conn)
+        return conn
+
+    def join(self, conn, room_slug, *args):
+        conn.process_event({
+            'type': 'event',
+            'name': 'join',
+            'args': [room_slug] + list(args),
+        })
+
+    def test_shared_by_address(self):
+        # Two connections from the same address share a limit, whatever
+        #   they call themselves.
+        address = '10.0.0.1'
+        first = self.connect('first', address)
+        first.user_name = 'luke'
+        second = self.connect('second', address)
+        second.user_name = 'leia'
+        for i in range(0, 6):
+            self.join(first, 'room-%d' % i)
+            self.join(second, 'room-%d' % i)
+        self.assertEqual(len(first.joined) + len(second.joined), 10)
+
+    def test_rejoin(self):
+        # A browser coming back after its connection dropped rejoins every
+        #   room it was in at once, which is more than a fresh join allows.
+        conn = self.connect('rejoin', '10.0.0.2')
+        for i in range(0, 20):
+            self.join(conn, 'room-%d' % i, 42)
+        self.assertEqual(len(conn.joined), 20)
+
+
+class TokenizeTests(SimpleTestCase):
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Hello, World! Hello again, world.'),
+                         ['hello', 'world', 'again'])
+
+    def test_short_and_long_terms(self):
+        self.assertEqual(tokenize('a b cd'), ['cd'])
+        self.assertEqual(tokenize('x' * 50), ['x' * 40])
+
+    def test_unicode(self):
+        self.assertEqual(tokenize('Ça va? Überall grüße'),
+                         ['ça', 'va', 'überall', 'grüße'])
+
+    def test_nothing(self):
+        self.assertEqual(tokenize(''), [])
+        self.assertEqual(tokenize('?! ...'), [])
+
+
+class CoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.coalescer = Coalescer(0.05, self.sent.append)
+
+    def test_leading_and_trailing(self):
+        # The first value goes straight out; of the rest, within the
+        #   window, only the last does, once the window is up.
+        self.coalescer.put(1)
+        self.coalescer.put(2)
+        self.coalescer.put(3)
+        self.assertEqual(self.sent, [1])
+        gevent.sleep(0.08)
+        self.assertEqual(self.sent, [1, 3])
+
+        # Once a window passes with nothing in it, the next value goes
+        #   straight out again.
+        gevent.sleep(0.08)
+        self.coalescer.put(None)
+        self.assertEqual(self.sent, [1, 3, None])
+
+    def test_cancel(self):
+        self.coalescer.put(1)
+        self.coalescer.put(2)
+        self.coalescer.cancel()
+        gevent.sleep(0.08)
+        self.assertEqual(self.sent, [1])
+        self.coalescer.put(3)
+        self.assertEqual(self.sent, [1, 3])
+
+
+@override_settings(CHAT_DB_THREADS=0, CHAT_BACKLOG_SIZE=50,
+                   CHAT_HISTORY_MAX_LIMIT=200)
+class PageTests(TestCase):
+    """The cursor handling that `history` and `search` share."""
+
+    def test_limits(self):
+        parse = Event.objects.parse_page
+        self.assertEqual(parse(None, None, None), (None, None, 50))
+        self.assertEqual(parse(None, None, '20'), (None, None, 20))
+        self.assertEqual(parse(None, None, '1000'), (None, None, 200))
+        self.assertEqual(parse(None, None, '-5'), (None, None, 1))
+        self.assertRaises(ValueError, parse, None, None, 'lots')
+
+    def test_timestamps(self):
+        before_id, before_timestamp, limit = Event.objects.parse_page(
+            None, '2013-03-16T14:30:05', None,
+        )
+        self.assertEqual(before_timestamp,
+                         datetime(2013, 3, 16, 14, 30, 5,
+                                  tzinfo=timezone.utc))
+        self.assertRaises(ValueError, Event.objects.parse_page,
+                          None, 'yesterday', None)
+        self.assertRaises(ValueError, Event.objects.parse_page,
+                          'seven', None, None)
+
+    def test_id_only(self):
+        # Given just an ID, we look its timestamp up; given an ID that
+        #   isn't there, we start from the top.
+        room = Room.objects.create(id='lobby', topic='')
+        created = timezone.now() - timedelta(hours=1)
+        Event.objects.bulk_create([Event(
+            room=room,
+            user_name='luke',
+            event_type='statement',
+            message='Hello!',
+            created=created,
+            modified=created,
+            sequence=1,
+        )])
+        event = Event.objects.get()
+        self.assertEqual(Event.objects.parse_page(event.id, None, None),
+                         (event.id, created, 50))
+        self.assertEqual(Event.objects.parse_page(event.id + 1, None, None),
+                         (None, None, 50))
+
+    def test_paginate(self):
+        now = timezone.now()
+        events = [Event(id=10 - i, created=now - timedelta(seconds=i))
+                  for i in range(0, 5)]
+
+        # One more than the limit means there is another page...
+        page, cursor = Event.objects.paginate(events, 4)
+        self.assertEqual(page, events[0:4])
+        self.assertEqual(cursor, {
+            'before_id': 7,
+            'before_timestamp': events[3].created.isoformat(),
+        })
+
+        # ...and anything less means that was everything.
+        self.assertEqual(Event.objects.paginate(events, 5), (events, None))
+        self.assertEqual(Event.objects.paginate([], 5), ([], None))
+
+
+class HistogramTests(SimpleTestCase):
+    def test_buckets(self):
+        histogram = Histogram('test_seconds', {}, buckets=(1, 2, 5))
+        for value in (0.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+
+        # Bounds are inclusive, and anything past the last one goes in
+        #   the overflow bucket.
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 16.0)
+
+    def test_percentiles(self):
+        histogram = Histogram('test_seconds', {}, buckets=(1, 2, 5))
+        self.assertEqual(histogram.percentile(50), 0.0)
+        for value in (0.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(40), 1)
+        self.assertEqual(histogram.percentile(50), 2)
+        self.assertEqual(histogram.percentile(100), 5)
+
+    def test_time(self):
+        histogram = Histogram('test_seconds', {})
+        with histogram.time():
+            gevent.sleep(0.01)
+        self.assertEqual(histogram.count, 1)
+        self.assertTrue(0.01 <= histogram.sum < 0.5)
+
+
+@override_settings(CHAT_METRICS_ALLOWED_IPS=['10.0.0.5'])
+class MetricsViewTests(SimpleTestCase):
+    def test_allowed(self):
+        request = RequestFactory().get('/metrics/', REMOTE_ADDR='10.0.0.5')
+        response = views.metrics(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('chat_handler_seconds', response.content)
+
+    def test_refused(self):
+        request = RequestFactory().get('/metrics/', REMOTE_ADDR='10.0.0.6')
+        self.assertEqual(views.metrics(request).status_code, 403)
+
+
+class SubscriberTests(SimpleTestCase):
+    """The process has only the one subscriber per Redis node; nothing that
+    arrives on it may stop it listening."""
+
+    def setUp(self):
+        # These need a real Redis (the one in `REDIS_NODES`); without one,
+        #   they're skipped. (This can't be checked at import time: the
+        #   host name is resolved in a thread, which would wait forever on
+        #   the import lock.)
+        try:
+            get_redis().ping()
+        except ConnectionError:
+            self.skipTest('Redis is not available.')
+
+        self.broker = RedisBroker()
+        self.channel = 'room_{test_%d}' % os.getpid()
+        self.payload = json.dumps(wire.unpack(wire.pack(
+            1, 1, 'test', 'statement', 'luke', 'Hello!', timezone.now(),
+        )))
+
+        # Keep the (expected) tracebacks out of the test output.
+        logging.getLogger('socketio').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('socketio').disabled = False
+        for subscriber in self.broker.subscribers.values():
+            subscriber._greenlet.kill()
+            subscriber.pubsub.reset()
+
+    def test_bad_message(self):
+        # Looks like an event, but has no timestamp.
+        recorder = Recorder()
+        self.broker.subscribe(self.channel, recorder)
+        redis = get_redis(self.channel)
+        redis.publish(self.channel, '{"room": "test", "type": "statement"}')
+        redis.publish(self.channel, self.payload)
+        self.assertTrue(wait_for(lambda: len(recorder.received) == 1))
+
+    def test_broken_namespace(self):
+        recorder = Recorder()
+        self.broker.subscribe(self.channel, Broken())
+        self.broker.subscribe(self.channel, recorder)
+        redis = get_redis(self.channel)
+        redis.publish(self.channel, self.payload)
+        redis.publish(self.channel, self.payload)
+        self.assertTrue(wait_for(lambda: len(recorder.received) == 2))
+
+
+class FakeSocket(object):
+    """Stands in for a socket.io socket, and keeps the packets sent down
+    it."""
+
+    def __init__(self, sessid):
+        self.sessid = sessid
+        self.session = {}
+        self.client_queue = Queue()
+        self.packets = []
+
+    def send_packet(self, packet):
+        self.packets.append(packet)
+
+
+@override_settings(CHAT_DB_THREADS=0, CHAT_PRESENCE_GRACE=0.05,
+                   CHAT_WRITE_BEHIND=False)
+class PresenceGraceTests(TestCase):
+    """A user who comes back on a new connection, before the old one is
+    given up on, never left as far as anybody else is concerned."""
+
+    def setUp(self):
+        try:
+            get_redis().ping()
+        except ConnectionError:
+            self.skipTest('Redis is not available.')
+        self.room_slug = 'test-%d-%s' % (os.getpid(), self._testMethodName)
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.recv_disconnect()
+        gevent.sleep(0.1)
+        room = Room(id=self.room_slug)
+        get_redis().delete('presence_%s' % self.room_slug, room.backlog_key,
+                           room.sequence_key)
+
+    def connect(self, sessid):
+        conn = ChatNamespace({'socketio': FakeSocket(sessid)}, '/chat')
+        conn.initialize()
+        conn.user_name = 'luke'
+        self.connections.append(conn)
+        return conn
+
+    def disconnect(self, conn):
+        self.connections.remove(conn)
+        conn.recv_disconnect()
+
+    def announced(self, event_type):
+        return Event.objects.filter(
+            event_type=event_type,
+            room=self.room_slug,
+        ).count()
+
+    def test_rejoin_before_disconnect(self):
+        # The old connection is still there when the new one joins, and
+        #   only goes away afterwards.
+        old = self.connect('old')
+        old.on_join(self.room_slug)
+        new = self.connect('new')
+        new.on_join(self.room_slug)
+        self.disconnect(old)
+        gevent.sleep(0.1)
+        self.assertEqual(self.announced('user_joined'), 1)
+        self.assertEqual(self.announced('user_left'), 0)
+        self.assertEqual(get_presence().members(self.room_slug), ['luke'])
+
+    def test_rejoin_within_grace(self):
+        old = self.connect('old')
+        old.on_join(self.room_slug)
+        self.disconnect(old)
+        new = self.connect('new')
+        new.on_join(self.room_slug)
+        gevent.sleep(0.1)
+        self.assertEqual(self.announced('user_joined'), 1)
+        self.assertEqual(self.announced('user_left'), 0)
+
+    def test_leave(self):
+        # Once the last connection goes, the user is gone.
+        old = self.connect('old')
+        old.on_join(self.room_slug)
+        new = self.connect('new')
+        new.on_join(self.room_slug)
+        self.disconnect(old)
+        self.disconnect(new)
+        gevent.sleep(0.1)
+        self.assertEqual(self.announced('user_left'), 1)
+        self.assertEqual(get_presence().members(self.room_slug), [])
+
+
+class SessionHandoffTests(SimpleTestCase):
+    """A session handshaken by one worker can be served by another, which
+    relays everything to the first through Redis."""
+
+    def setUp(self):
+        try:
+            get_redis().ping()
+        except ConnectionError:
+            self.skipTest('Redis is not available.')
+
+        # Two workers, each with its own server and session store.
+        self.stores = []
+        self.servers = []
+        for worker in ('owner', 'other'):
+            self.stores.append(RedisSessionStore(
+                channel='sessions_test_%s_%d' % (worker, os.getpid()),
+            ))
+            self.servers.append(SocketIOServer(('127.0.0.1', 0), None,
+                resource='socket.io',
+                policy_server=False,
+            ))
+        self.owner, self.other = self.stores
+
+        # The handshake goes to the owner...
+        self.socket = self.owner.get_socket(self.servers[0])
+
+        # ...and the next request to the other.
+        self.remote = self.other.get_socket(self.servers[1],
+                                            self.socket.sessid)
+
+    def tearDown(self):
+        for store in self.stores:
+            store._listener.kill()
+            store._refresher.kill()
+            store.pubsub.reset()
+            store.clear()
+
+    def test_remote(self):
+        self.assertTrue(isinstance(self.remote, RemoteSocket))
+        self.assertEqual(self.remote.owner, self.owner.channel)
+
+    def test_unknown_session(self):
+        self.assertEqual(self.other.get_socket(self.servers[1], 'nope'),
+                         None)
+
+    def test_post(self):
+        self.remote.put_server_msg('5:::{"name": "ping"}')
+        self.assertEqual(self.socket.server_queue.get(timeout=2),
+                         '5:::{"name": "ping"}')
+
+    def test_poll(self):
+        self.socket.put_client_msg('5:::{"name": "pong"}')
+        self.assertEqual(self.remote.get_multiple_client_msgs(timeout=1),
+                         ['5:::{"name": "pong"}'])
+
+    def test_empty_poll(self):
+        with self.assertRaises(Empty):
+            self.remote.get_multiple_client_msgs(timeout=0.1)
+
+    def test_late_answer(self):
+        # An answer that turns up after its poll has given up goes back to
+        #   the owner, to be sent down with the next poll.
+        self.owner.relay(self.other.channel, {
+            'type': 'answer',
+            'id': -1,
+            'sessid': self.socket.sessid,
+            'owner': self.owner.channel,
+            'messages': ['5:::{"name": "pong"}'],
+        })
+        self.assertEqual(self.remote.get_multiple_client_msgs(timeout=1),
+                         ['5:::{"name": "pong"}'])
+
+
+@override_settings(CHAT_DB_THREADS=0)
+class WriterTests(TestCase):
+    """The write-behind writer writes each batch once, and then indexes
+    it, whatever happens to the indexing."""
+
+    def setUp(self):
+        self.room = Room.objects.create(id='test', topic='Testing')
+        self.writer = Writer(interval=10, retries=2)
+
+    def put(self, count):
+        for i in range(1, count + 1):
+            event = Event(
+                room=self.room,
+                user_name='luke',
+                event_type='statement',
+                message='Hello, number %d!' % i,
+                created=timezone.now(),
+                sequence=i,
+            )
+            event.prepare()
+            self.writer.put(event)
+        self.writer.stop(timeout=5)
+
+    def test_indexed(self):
+        self.put(3)
+        self.assertEqual(Event.objects.count(), 3)
+        self.assertEqual(SearchTerm.objects.filter(term='hello').count(), 3)
+
+    def test_duplicate_sequence(self):
+        # Sequence numbers can repeat (if Redis forgets where a room's
+        #   sequence was, for instance); the index has to point at the
+        #   events it was given all the same.
+        Event.objects.bulk_create([Event(
+            room=self.room,
+            user_name='leia',
+            event_type='statement',
+            message='Goodbye!',
+            created=timezone.now(),
+            modified=timezone.now(),
+            sequence=1,
+        )])
+        self.put(1)
+        term = SearchTerm.objects.get(term='hello')
+        self.assertEqual(term.event.message, 'Hello, number 1!')
+
+    def test_indexing_fails(self):
+        def index(events):
+            raise RuntimeError('Broken.')
+        SearchTerm.objects.index = index
+        logging.getLogger('socketio').disabled = True
+        try:
+            self.put(3)
+        finally:
+            del SearchTerm.objects.index
+            logging.getLogger('socketio').disabled = False
+
+        # Written once, and not retried.
+        self.assertEqual(Event.objects.count(), 3)
+        self.assertEqual(self.writer.written, 3)
+        self.assertEqual(self.writer.failed, 0)
+        self.assertEqual(SearchTerm.objects.count(), 0)
+
+
+@override_settings(CHAT_DB_THREADS=0, CHAT_WRITE_BEHIND=False)
+class SaveTests(TestCase):
+    """Saving an event (without write-behind) costs the sender its own
+    write, and nothing more; the search index is written later."""
+
+    def setUp(self):
+        try:
+            get_redis().ping()
+        except ConnectionError:
+            self.skipTest('Redis is not available.')
+        self.room = Room.objects.create(id='test-%d' % os.getpid(),
+                                        topic='Testing')
+
+    def tearDown(self):
+        stop_writer(timeout=5)
+        get_redis().delete(self.room.backlog_key, self.room.sequence_key)
+
+    def test_indexed_later(self):
+        Event.objects.create(
+            room=self.room,
+            user_name='luke',
+            event_type='statement',
+            message='Hello, world!',
+        )
+        self.assertEqual(SearchTerm.objects.count(), 0)
+        stop_writer(timeout=5)
+        self.assertEqual(sorted(SearchTerm.objects.values_list('term',
+                                                                flat=True)),
+                         ['hello', 'world'])
+
+
+@override_settings(CHAT_DB_THREADS=0, CHAT_WIRE_FORMAT='compact')
+class ArchiveTests(TestCase):
+    """Archived events are plain JSON, whatever the wire format."""
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        room = Room.objects.create(id='lobby', topic='')
+        created = datetime(2013, 3, 16, 14, 30, 5, tzinfo=timezone.utc)
+        Event.objects.bulk_create([Event(
+            room=room,
+            user_name='luke',
+            event_type='statement',
+            message='Hello!',
+            created=created,
+            modified=created,
+            sequence=1,
+        )])
+        self.id = Event.objects.get().id
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def test_archive(self):
+        pruner = Pruner({'statement': timedelta(days=1)},
+                        archive_dir=self.archive_dir)
+        self.assertEqual(pruner.prune(), 1)
+        self.assertEqual(Event.objects.count(), 0)
+
+        filename, = os.listdir(self.archive_dir)
+        archive = gzip.open(os.path.join(self.archive_dir, filename))
+        self.assertEqual([json.loads(line) for line in archive], [{
+            'id': self.id,
+            'room': 'lobby',
+            'sequence': 1,
+            'type': 'statement',
+            'user': 'luke',
+            'message': 'Hello!',
+            'created': '2013-03-16T14:30:05+00:00',
+        }])
@@ -1,8 +1,14 @@
 from __future__ import unicode_literals
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.conf import settings
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden)
 from django.template.response import TemplateResponse
+from pycon2013_socketio.chat import metrics as chat_metrics
+from pycon2013_socketio.chat.models import Event, Room, SearchTerm
 from pycon2013_socketio.chat.namespaces import ChatNamespace
 from socketio import socketio_manage
+import json
+import logging
 
 
 def home(request):
@@ -12,6 +18,85 @@ def home(request):
     return TemplateResponse(request, 'chat/home.html')
 
 
+def history(request, room_slug):
+    """Return a page of older events from the given room, as JSON.
+
+    This is the same thing as the `history` socket event, for anyone who
+    would rather not hold a socket open to get it. It takes `before_id`,
+    `before_timestamp` and `limit` query parameters.
+    """
+
+    try:
+        room = Room.objects.get_cached(room_slug)
+    except Room.DoesNotExist:
+        raise Http404
+
+    try:
+        events, cursor = Event.objects.history(room,
+            before_id=request.GET.get('before_id'),
+            before_timestamp=request.GET.get('before_timestamp'),
+            limit=request.GET.get('limit'),
+        )
+    except ValueError:
+        return HttpResponseBadRequest('Invalid history cursor.')
+
+    return HttpResponse(json.dumps({
+        'cursor': cursor,
+        'events': [dict(event) for event in reversed(events)],
+        'room': room.id,
+    }), content_type='application/json')
+
+
+def search(request):
+    """Return a page of the statements and topic changes that contain every
+    word of the `q` query parameter, newest first, as JSON.
+
+    This is the same thing as the `search` socket event. It also takes
+    `room` and `user` query parameters, to narrow the search, and the same
+    `before_id`, `before_timestamp` and `limit` parameters as `history`.
+    """
+
+    try:
+        events, cursor = SearchTerm.objects.search(request.GET.get('q', ''),
+            room=request.GET.get('room'),
+            user_name=request.GET.get('user'),
+            before_id=request.GET.get('before_id'),
+            before_timestamp=request.GET.get('before_timestamp'),
+            limit=request.GET.get('limit'),
+        )
+    except ValueError as ex:
+        return HttpResponseBadRequest('Invalid search: %s' % ex)
+
+    return HttpResponse(json.dumps({
+        'cursor': cursor,
+        'events': [dict(event) for event in events],
+        'query': request.GET.get('q', ''),
+        'room': request.GET.get('room'),
+        'user': request.GET.get('user'),
+    }), content_type='application/json')
+
+
+def metrics(request):
+    """Report the metrics this process has collected (see
+    `chat/metrics.py`), in the Prometheus text format, or as JSON if the
+    `format=json` query parameter is given.
+
+    Metrics are per-process; under `manage.py serve`, each request is
+    answered by whichever worker happens to accept it. Only the addresses
+    in `CHAT_METRICS_ALLOWED_IPS` may ask.
+    """
+
+    if request.META.get('REMOTE_ADDR') not in \
+            settings.CHAT_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden('Metrics are not available to you.')
+
+    if request.GET.get('format') == 'json':
+        return HttpResponse(json.dumps(chat_metrics.snapshot()),
+                            content_type='application/json')
+    return HttpResponse(chat_metrics.prometheus(),
+                        content_type='text/plain; version=0.0.4')
+
+
 def socketio(request):
     """Handle SocketIO connections."""
 
@@ -0,0 +1,210 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import calendar
+import json
+import time
+
+
+# How room events look on the wire.
+#
+# The JSON encoding is just the event's dictionary (see `Event.__iter__`),
+#   which repeats every key in every event, and carries its time twice,
+#   as strings.
+# The compact encoding is a list of fields in a fixed order, with the event
+#   type as a small integer and the time as an integer count of
+#   microseconds since the epoch:
+#
+#     [id, seq, room, type, user, message, created]
+#
+#   For topic changes, `message` is just the new topic; the rest of the
+#   dictionary is rebuilt from the fields on the other end.
+#
+# Either one may be published to the broker (see `CHAT_WIRE_FORMAT`); since
+#   one starts with `{` and the other with `[`, whoever receives a payload
+#   can always tell which it is. Each browser separately asks for the
+#   encoding it wants (see `ChatNamespace.on_encoding`).
+#
+# Ephemeral signals (someone is typing, someone has read up to a point) go
+#   through the same channels as room events, but are never saved, and have
+#   only the one encoding, a small dictionary with a `signal` key (see
+#   `WireSignal`).
+FORMATS = ('json', 'compact')
+EVENT_TYPES = ('statement', 'user_joined', 'user_left', 'topic_set')
+TOPIC_MESSAGE = '{user} set the topic to "{topic}".'
+
+
+class WireEvent(object):
+    """A room event, decoded from the wire.
+
+    It holds whichever encoding it arrived in, and only works out the other
+    one if somebody asks for it -- and then only once, however many sockets
+    need it. The handful of fields that the server itself looks at (`room`,
+    `type` and `seq`) are available directly either way.
+    """
+
+    # Room events are saved, and numbered; see `WireSignal`.
+    ephemeral = False
+
+    def __init__(self, data=None, fields=None):
+        self._data = data
+        self._fields = fields
+
+    @property
+    def room(self):
+        if self._fields is not None:
+            return self._fields[2]
+        return self._data['room']
+
+    @property
+    def type(self):
+        if self._fields is not None:
+            return EVENT_TYPES[self._fields[3]]
+        return self._data['type']
+
+    @property
+    def created_at(self):
+        """When the event was created, in seconds since the epoch."""
+
+        if self._fields is not None:
+            return self._fields[6] / 1000000.0
+        return to_epoch(parse_datetime(self._data['created'])) / 1000000.0
+
+    @property
+    def seq(self):
+        if self._fields is not None:
+            return self._fields[1]
+        return self._data.get('seq')
+
+    def as_dict(self):
+        """Return the event as a dictionary, exactly like the one
+        `Event.__iter__` gives."""
+
+        if self._data is None:
+            self._data = unpack(self._fields)
+        return self._data
+
+    def packed(self):
+        """Return the compact encoding of the event, as a list."""
+
+        if self._fields is None:
+            data = self._data
+            self._fields = pack(
+                data['id'], data.get('seq'), data['room'], data['type'],
+                data['user'], data.get('topic', data['message']),
+                parse_datetime(data['created']),
+            )
+        return self._fields
+
+
+class WireSignal(object):
+    """An ephemeral signal, decoded from the wire: a user in a room is
+    typing (or has stopped), or has read up to a point in the room's
+    sequence.
+
+    Signals are never saved, numbered or kept in the backlog, and they go
+    down to the browser as they came, whichever encoding it asked for:
+
+        {"signal": "typing", "room": "lobby", "user": "luke",
+         "value": true, "at": 1363795200.0}
+
+    It has just as much of `WireEvent` as the broker and the namespaces
+    look at.
+    """
+
+    ephemeral = True
+    seq = None
+
+    def __init__(self, data):
+        self._data = data
+
+    @property
+    def room(self):
+        return self._data['room']
+
+    @property
+    def type(self):
+        return self._data['signal']
+
+    @property
+    def created_at(self):
+        return self._data['at']
+
+    def as_dict(self):
+        return self._data
+
+    packed = as_dict
+
+
+def signal(room, signal_type, user, value):
+    """Return the payload for an ephemeral signal (see `WireSignal`)."""
+
+    return json.dumps({
+        'at': time.time(),
+        'room': room,
+        'signal': signal_type,
+        'user': user,
+        'value': value,
+    }, separators=(',', ':'))
+
+
+def pack(id, seq, room, event_type, user, message, created):
+    """Return the compact encoding of an event, as a list."""
+
+    return [id, seq, room, EVENT_TYPES.index(event_type), user, message,
+            to_epoch(created)]
+
+
+def unpack(fields):
+    """Turn the compact encoding of an event back into a dictionary."""
+
+    id, seq, room, event_type, user, message, created = fields
+    created = from_epoch(created)
+    event = {
+        'id': id,
+        'created': created.isoformat(),
+        'seq': seq,
+        'room': room,
+        'type': EVENT_TYPES[event_type],
+        'user': user,
+        'message': message,
+        'timestamp': created.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    if event['type'] == 'topic_set':
+        event['topic'] = message
+        event['message'] = TOPIC_MESSAGE.format(topic=message, user=user)
+    return event
+
+
+def loads(payload):
+    """Decode a published event, in either encoding, into a `WireEvent`
+    (or a signal into a `WireSignal`).
+
+    Raises `ValueError` if the payload isn't an event at all.
+    """
+
+    data = json.loads(payload)
+    if isinstance(data, dict) and 'room' in data and 'signal' in data:
+        return WireSignal(data)
+    if isinstance(data, dict) and 'room' in data and 'type' in data:
+        return WireEvent(data=data)
+    if isinstance(data, list) and len(data) == 7 and \
+            0 <= data[3] < len(EVENT_TYPES):
+        return WireEvent(fields=data)
+    raise ValueError('Not an event.')
+
+
+def to_epoch(value):
+    """Return an aware datetime as integer microseconds since the epoch."""
+
+    return calendar.timegm(value.utctimetuple()) * 1000000 + value.microsecond
+
+
+def from_epoch(value):
+    """Return integer microseconds since the epoch as an aware datetime."""
+
+    return datetime.utcfromtimestamp(value // 1000000).replace(
+        microsecond=value % 1000000,
+        tzinfo=timezone.utc,
+    )
@@ -0,0 +1,188 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from gevent.queue import Empty, Queue
+from pycon2013_socketio.chat import metrics, offload
+import gevent
+import logging
+import time
+
+
+class Writer(object):
+    """Write model instances to the database in the background, in batches.
+
+    Instances are `put` on a queue, and a single greenlet takes them off
+    again, writing them with one `bulk_create` call per batch. A batch is
+    written as soon as it is full, or once it has been waiting for
+    `interval` milliseconds, whichever comes first.
+
+    Note that `bulk_create` does not call `save`, so nothing that happens
+    there (publishing events to Redis, for instance) happens again here.
+    Anything that does need doing once a batch is written, the model's
+    manager can do in a `bulk_created` method (see `EventManager`).
+
+    Instances of more than one model can share the queue (events, and the
+    search index's postings, say); each model's share of a batch gets its
+    own `bulk_create`.
+    """
+
+    # Put on the queue to tell the writer greenlet to finish up and exit.
+    _STOP = object()
+
+    def __init__(self, interval=100, batch_size=100, retries=5):
+        self.interval = interval / 1000.0
+        self.batch_size = batch_size
+        self.retries = retries
+        self.queue = Queue()
+
+        # Counters, for keeping an eye on how we're doing.
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_flush = 0.0
+        self.max_flush = 0.0
+
+        self._greenlet = gevent.spawn(self._run)
+
+    def put(self, instance):
+        """Queue a model instance to be written to the database."""
+
+        self.queue.put(instance)
+
+    def stop(self, timeout=None):
+        """Write everything still in the queue, and stop the writer.
+
+        This blocks until the queue has been flushed (or until `timeout`
+        seconds have passed).
+        """
+
+        self.queue.put(self._STOP)
+        self._greenlet.join(timeout)
+
+    def stats(self):
+        """Return a dictionary describing the state of the writer."""
+
+        return {
+            'queue_depth': self.queue.qsize(),
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+            'last_flush_ms': self.last_flush * 1000,
+            'max_flush_ms': self.max_flush * 1000,
+        }
+
+    def _run(self):
+        while True:
+            # Wait (for as long as it takes) for the first instance
+            #   in the batch...
+            batch = [self.queue.get()]
+
+            # ...and then give the batch until the deadline to fill up.
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(deadline - time.time(), 0),
+                    ))
+                except Empty:
+                    break
+
+            # If we've been told to stop, write out whatever else is
+            #   still sitting in the queue, and then we're done.
+            if batch[-1] is self._STOP:
+                batch.pop()
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                self._write([i for i in batch if i is not self._STOP])
+                return
+
+            self._write(batch)
+
+    def _write(self, batch):
+        """Write a batch of instances to the database, one `bulk_create`
+        per model."""
+
+        models = []
+        instances = {}
+        for instance in batch:
+            model = type(instance)
+            if model not in instances:
+                models.append(model)
+                instances[model] = []
+            instances[model].append(instance)
+        for model in models:
+            self._write_model(model, instances[model])
+
+    def _write_model(self, model, batch):
+        """Write a batch of instances of `model` to the database, retrying
+        with exponential backoff if the write fails."""
+
+        log = logging.getLogger('socketio')
+        name = model._meta.verbose_name_plural
+        for attempt in range(0, self.retries + 1):
+            start = time.time()
+            try:
+                offload.run(model.objects.bulk_create, batch)
+            except Exception:
+                if attempt == self.retries:
+                    self.failed += len(batch)
+                    log.error('Giving up on writing %d %s.', len(batch), name,
+                              exc_info=True)
+                    return
+                log.warning('Writing %d %s failed; retrying.', len(batch),
+                            name, exc_info=True)
+                gevent.sleep(0.1 * 2 ** attempt)
+            else:
+                break
+
+        # Keep track of how long that took.
+        self.last_flush = time.time() - start
+        self.max_flush = max(self.max_flush, self.last_flush)
+        _write_time.observe(self.last_flush)
+        self.written += len(batch)
+        self.batches += 1
+        log.debug('Wrote %d %s in %.1f ms; %d still queued.', len(batch),
+                  name, self.last_flush * 1000, self.queue.qsize())
+
+        # The batch is in the database now, whatever happens next. Anything
+        #   else that needs doing with it is never retried (that would mean
+        #   writing it again); if it fails, we say so, and move on.
+        bulk_created = getattr(model.objects, 'bulk_created', None)
+        if bulk_created is not None:
+            try:
+                bulk_created(batch)
+            except Exception:
+                log.error('Exception after writing %d %s.', len(batch),
+                          name, exc_info=True)
+
+
+# How long each batch takes to write.
+_write_time = metrics.histogram('chat_db_write_seconds', op='bulk_create')
+
+# The writer (and its greenlet) are created on first use.
+_writer = None
+
+
+def get_writer():
+    """Return the process-wide write-behind writer."""
+
+    global _writer
+    if _writer is None:
+        _writer = Writer(
+            interval=int(settings.CHAT_WRITE_BEHIND_INTERVAL),
+            batch_size=int(settings.CHAT_WRITE_BEHIND_BATCH),
+            retries=int(settings.CHAT_WRITE_BEHIND_RETRIES),
+        )
+    return _writer
+
+
+metrics.gauge('chat_writer_queue_depth',
+              lambda: _writer.queue.qsize() if _writer else 0)
+
+
+def stop_writer(timeout=None):
+    """Flush and stop the write-behind writer, if there is one."""
+
+    global _writer
+    if _writer is not None:
+        _writer.stop(timeout)
+        _writer = None
@@ -34,6 +34,213 @@ REDIS_PORT = int(os.environ.get('SOCKETIO_REDIS_PORT', 6379))
 REDIS_DB = int(os.environ.get('SOCKETIO_REDIS_DB', 0))
 REDIS_PASSWORD = os.environ.get('SOCKETIO_REDIS_PASSWORD', None)
 
+# Redis pub/sub is single-threaded, and copies every message to every
+#   subscriber, so one node only carries so many room events. To spread
+#   rooms across several nodes, list them all here ("host:port/db", comma
+#   separated); each room's channel, backlog and sequence counter live on
+#   the node its name hashes to. Everything else (presence, rate limits)
+#   stays on the first node. All processes must list the same nodes, in
+#   the same order.
+REDIS_NODES = [node.strip() for node in os.environ.get('SOCKETIO_REDIS_NODES',
+    '%s:%d/%d' % (REDIS_HOST, REDIS_PORT, REDIS_DB),
+).split(',') if node.strip()]
+
+# Redis connection pool settings.
+# All publishing in the process shares one pool of connections. If every
+#   connection is busy, callers wait up to REDIS_POOL_TIMEOUT seconds for
+#   one to be released before giving up.
+REDIS_POOL_SIZE = int(os.environ.get('SOCKETIO_REDIS_POOL_SIZE', 20))
+REDIS_POOL_TIMEOUT = float(os.environ.get('SOCKETIO_REDIS_POOL_TIMEOUT', 5))
+
+# Chat settings.
+# The broker carries room events to every socket in the room. The Redis
+#   broker works across any number of processes (and machines); the memory
+#   broker skips Redis entirely, but only works if the whole site runs in a
+#   single process.
+#   * pycon2013_socketio.chat.brokers.RedisBroker
+#   * pycon2013_socketio.chat.brokers.MemoryBroker
+CHAT_BROKER = os.environ.get('SOCKETIO_BROKER',
+    'pycon2013_socketio.chat.brokers.RedisBroker',
+)
+
+# How room events are encoded when they are published to the broker (and
+#   cached in backlogs): "json" (the event as a dictionary) or "compact" (a
+#   list of fields; see `chat/wire.py`). Processes using either can share
+#   the same broker. Browsers choose their own encoding separately.
+CHAT_WIRE_FORMAT = os.environ.get('SOCKETIO_WIRE_FORMAT', 'json')
+
+# The number of recent statements (and topic changes) sent down to someone
+#   who joins a room. These are cached in Redis, one capped list per room.
+CHAT_BACKLOG_SIZE = int(os.environ.get('SOCKETIO_BACKLOG_SIZE', 50))
+
+# Older history is fetched a page at a time (see the `history` event and
+#   view). This is the most events a client may ask for in a single page.
+CHAT_HISTORY_MAX_LIMIT = int(os.environ.get('SOCKETIO_HISTORY_MAX_LIMIT', 200))
+
+# Presence: who is in each room right now. As with the broker, the Redis
+#   store works across processes, and the memory store only works if the
+#   whole site is a single process.
+#   * pycon2013_socketio.chat.presence.RedisPresence
+#   * pycon2013_socketio.chat.presence.MemoryPresence
+# Each process refreshes its entries in Redis every CHAT_PRESENCE_HEARTBEAT
+#   seconds; entries that go unrefreshed for three heartbeats (because
+#   their process died, say) are swept away.
+CHAT_PRESENCE = os.environ.get('SOCKETIO_PRESENCE',
+    'pycon2013_socketio.chat.presence.RedisPresence',
+)
+CHAT_PRESENCE_HEARTBEAT = float(os.environ.get(
+    'SOCKETIO_PRESENCE_HEARTBEAT', 10,
+))
+
+# Sessions: which process a socket.io session lives in. gevent-socketio keeps
+#   each one in the process that did its handshake, so with the memory store,
+#   every poll from a client has to go back to that process (the load
+#   balancer must stick clients to processes). With the Redis store, any
+#   process can take any client's polls, and relays them to the right one.
+#   * pycon2013_socketio.chat.sessions.MemorySessionStore
+#   * pycon2013_socketio.chat.sessions.RedisSessionStore
+CHAT_SESSION_STORE = os.environ.get('SOCKETIO_SESSION_STORE',
+    'pycon2013_socketio.chat.sessions.MemorySessionStore',
+)
+
+# When a connection drops, we wait this many seconds before announcing that
+#   the user has left its rooms. If they reconnect (and rejoin) in the
+#   meantime, as flaky mobile connections do constantly, neither the leave
+#   nor the rejoin is announced. Set to 0 to announce everything right away.
+CHAT_PRESENCE_GRACE = float(os.environ.get('SOCKETIO_PRESENCE_GRACE', 5))
+
+# Outbound batching of room events.
+# By default, each room event is sent down to each browser the moment it
+#   arrives. If CHAT_EMIT_BATCH_WINDOW (in milliseconds) is set, events for a
+#   connection are instead collected for that long (or until there are
+#   CHAT_EMIT_BATCH_SIZE of them) and sent down together, in one packet.
+CHAT_EMIT_BATCH_WINDOW = int(os.environ.get('SOCKETIO_EMIT_BATCH_WINDOW', 0))
+CHAT_EMIT_BATCH_SIZE = int(os.environ.get('SOCKETIO_EMIT_BATCH_SIZE', 50))
+
+# Slow consumers.
+# Each browser's socket has a queue of packets waiting to go down to it. Once
+#   CHAT_OUTBOUND_LIMIT packets are waiting, we stop adding room events to
+#   it and hold them ourselves until the browser catches up. If we are
+#   holding CHAT_OUTBOUND_LIMIT events as well, CHAT_SLOW_CONSUMER_POLICY
+#   decides what happens next:
+#   * drop_oldest: the oldest held event is thrown away.
+#   * collapse: every held event is thrown away.
+#   * disconnect: the browser is disconnected.
+# Whatever is thrown away, the browser is told how many events it missed in
+#   each room once it catches up.
+CHAT_OUTBOUND_LIMIT = int(os.environ.get('SOCKETIO_OUTBOUND_LIMIT', 200))
+CHAT_SLOW_CONSUMER_POLICY = os.environ.get('SOCKETIO_SLOW_CONSUMER_POLICY',
+    'collapse',
+)
+
+# Flood protection.
+# Each of these events may only be sent so fast: each is allowed a burst of
+#   so many events, and then so many per second after that, given here as
+#   (per second, burst). Events past the limit are refused with an error.
+#   Each connection gets its own limit, and so does each client address,
+#   across all of its connections (and across processes too, with the Redis
+#   limiter; the memory limiter only counts within each process).
+#   "rejoin" is a join that says where the browser left off: the browser
+#   rejoining all of its rooms after its connection dropped.
+#   * pycon2013_socketio.chat.ratelimit.RedisLimiter
+#   * pycon2013_socketio.chat.ratelimit.MemoryLimiter
+CHAT_RATE_LIMITER = os.environ.get('SOCKETIO_RATE_LIMITER',
+    'pycon2013_socketio.chat.ratelimit.MemoryLimiter',
+)
+CHAT_RATE_LIMITS = {
+    'history': (2, 10),
+    'join': (1, 10),
+    'nick': (0.5, 5),
+    'rejoin': (1, 50),
+    'search': (1, 5),
+    'statement': (2, 10),
+    'topic': (0.2, 3),
+}
+
+# Ephemeral signals: typing indicators and read markers (see the `signal`
+#   event). These skip the database altogether, and go straight to the
+#   room's channel. Repeats of a signal (in the same room, from the same
+#   connection) within its coalescing window, in seconds, are collapsed
+#   into one, and each type of signal also has a rate limit of its own,
+#   past which signals are quietly dropped. Each is given here as
+#   (window, per second, burst).
+CHAT_SIGNALS = {
+    'read': (2, 1, 5),
+    'typing': (2, 1, 5),
+}
+
+# Rooms are cached in each process, so we don't have to look them up on
+#   every single chat event. This is how long (in seconds) a cached room
+#   may be used before we look it up again.
+CHAT_ROOM_CACHE_TTL = float(os.environ.get('SOCKETIO_ROOM_CACHE_TTL', 60))
+
+# Write-behind persistence of chat events.
+# If turned on, events are published to the room immediately and written to
+#   the database afterwards, in batches, by a background greenlet. A batch is
+#   written every CHAT_WRITE_BEHIND_INTERVAL milliseconds or as soon as it
+#   holds CHAT_WRITE_BEHIND_BATCH events, whichever comes first. Failed
+#   writes are retried (with backoff) up to CHAT_WRITE_BEHIND_RETRIES times.
+CHAT_WRITE_BEHIND = bool(int(os.environ.get('SOCKETIO_WRITE_BEHIND', 0)))
+CHAT_WRITE_BEHIND_INTERVAL = int(os.environ.get(
+    'SOCKETIO_WRITE_BEHIND_INTERVAL', 100,
+))
+CHAT_WRITE_BEHIND_BATCH = int(os.environ.get('SOCKETIO_WRITE_BEHIND_BATCH', 100))
+CHAT_WRITE_BEHIND_RETRIES = int(os.environ.get(
+    'SOCKETIO_WRITE_BEHIND_RETRIES', 5,
+))
+
+# Metrics: each process keeps histograms of how long the hot paths take,
+#   served up at /metrics/. If CHAT_METRICS_LOG_INTERVAL is set, a summary
+#   is also logged (to the "socketio" logger) every that many seconds.
+CHAT_METRICS_LOG_INTERVAL = float(os.environ.get(
+    'SOCKETIO_METRICS_LOG_INTERVAL', 0,
+))
+
+# Only these addresses may read /metrics/ (which tells anyone who can see it
+#   rather a lot about how busy we are), given as a comma-separated list in
+#   SOCKETIO_METRICS_ALLOWED_IPS. By default, that's just this machine; put
+#   the address of whatever scrapes it here too.
+CHAT_METRICS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get(
+    'SOCKETIO_METRICS_ALLOWED_IPS', '127.0.0.1,::1',
+).split(',') if ip.strip()]
+
+# Database calls are run on a pool of this many threads, so that a database
+#   driver that gevent can't make cooperative (most of them are written in
+#   C) doesn't hold up every other socket in the process while it waits for
+#   a query. Set to 0 to run them inline. (This needs gevent 1.0 or later;
+#   with older versions, database calls always run inline.)
+CHAT_DB_THREADS = int(os.environ.get('SOCKETIO_DB_THREADS', 4))
+
+# Every CHAT_HUB_PROBE_INTERVAL milliseconds, we check how late the event
+#   loop is in waking us up; that's how long it was blocked for. Lags are
+#   recorded (see /metrics/), and any over CHAT_HUB_BLOCKED_WARNING
+#   milliseconds are logged. Set the interval to 0 to turn this off.
+CHAT_HUB_PROBE_INTERVAL = float(os.environ.get(
+    'SOCKETIO_HUB_PROBE_INTERVAL', 100,
+))
+CHAT_HUB_BLOCKED_WARNING = float(os.environ.get(
+    'SOCKETIO_HUB_BLOCKED_WARNING', 100,
+))
+
+# Retention of old events, enforced by `manage.py prune`.
+# Joins and leaves are most of the events there are, and of little interest
+#   after the fact, so they go after CHAT_RETENTION_PRESENCE_HOURS hours;
+#   statements and topic changes are kept for their own number of days.
+#   Set any of these to 0 to keep those events forever.
+# If CHAT_RETENTION_ARCHIVE_DIR is set, pruned events are written there
+#   (as gzipped JSON lines) before they are deleted.
+CHAT_RETENTION_PRESENCE_HOURS = float(os.environ.get(
+    'SOCKETIO_RETENTION_PRESENCE_HOURS', 24,
+))
+CHAT_RETENTION_STATEMENT_DAYS = float(os.environ.get(
+    'SOCKETIO_RETENTION_STATEMENT_DAYS', 30,
+))
+CHAT_RETENTION_TOPIC_DAYS = float(os.environ.get(
+    'SOCKETIO_RETENTION_TOPIC_DAYS', 0,
+))
+CHAT_RETENTION_ARCHIVE_DIR = os.environ.get('SOCKETIO_RETENTION_ARCHIVE_DIR',
+                                            '')
+
 # --------------------------
 # -- Stuff to Leave Alone --
 # --------------------------
@@ -71,6 +278,14 @@ STATICFILES_FINDERS = (
     'django.contrib.staticfiles.finders.AppDirectoriesFinder',
 )
 
+# Static files are served by the socket.io server itself, from memory,
+#   gzipped, with cache validators, and under hashed names that can be cached
+#   forever (see `chat/assets.py`), unless SOCKETIO_STATIC_ASSETS is 0 (in
+#   which case Django's own static files handler serves them from disk).
+# With CHAT_STATIC_RELOAD on, files that change on disk are read again.
+CHAT_STATIC_ASSETS = bool(int(os.environ.get('SOCKETIO_STATIC_ASSETS', 1)))
+CHAT_STATIC_RELOAD = DEBUG
+
 # Can anyone explain to me what this does or why it's here? It seems like
 #   its only purpose is to embarrass people who publish it on GitHub,
 #   which is precisely what I am going to do. :)
@@ -118,7 +333,11 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -126,5 +345,9 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'socketio': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     }
 }
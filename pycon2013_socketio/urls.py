@@ -4,5 +4,9 @@ from pycon2013_socketio.chat.namespaces import *
 
 urlpatterns = patterns('pycon2013_socketio',
     url(r'^/?$', 'chat.views.home', name='home'),
+    url(r'^rooms/(?P<room_slug>[\w-]+)/history/$', 'chat.views.history',
+        name='history'),
+    url(r'^search/$', 'chat.views.search', name='search'),
+    url(r'^metrics/$', 'chat.views.metrics', name='metrics'),
     url(r'^socket\.io/', 'chat.views.socketio', name='socket.io'),
 )
\ No newline at end of file